@@ -0,0 +1,253 @@
+"""
+Analytics Engine - Columnar in-memory snapshot of the match table for the leaderboard queries
+"""
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from datetime import datetime
+from itertools import accumulate, compress
+from threading import Lock
+import operator
+
+from flask import current_app
+from sqlalchemy.orm import aliased
+
+from models import db, Match, MatchSet, Team, Player
+from utils import get_data_versions
+from identity_map import IDENTITY_DATA
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_seconds(value):
+    """Convert a naive datetime to seconds since the epoch"""
+    return (value - EPOCH).total_seconds()
+
+
+class MatchSnapshot:
+    """Every match held as parallel typed arrays, plus player totals per tournament"""
+
+    def __init__(self, version):
+        self.version = version
+        self.player_ids = array('q')        # Dense player index -> player id
+        self.player_names = []
+        self.match_types = []               # Match type code -> match type name
+        self.tournament_ids = array('q')    # Dense tournament index -> tournament id
+
+        # One entry per match
+        self.match_ids = array('q')
+        self.match_tournament = array('l')  # Dense tournament index
+        self.match_type = array('l')        # Match type code
+        self.timestamp = array('d')         # Seconds since the epoch
+        self.month = array('l')             # year * 12 + month - 1
+        self.team1_players = (array('l'), array('l'))  # Dense player index, -1 for singles
+        self.team2_players = (array('l'), array('l'))
+        self.team1_won = array('b')
+        self.team1_points = array('l')
+        self.team2_points = array('l')
+
+        # Per-set points, the sets of match i are set_offsets[i]:set_offsets[i + 1]
+        self.set_offsets = array('q', [0])
+        self.set_team1_points = array('l')
+        self.set_team2_points = array('l')
+
+        # One entry per cell (player index * number of match types + match type code) and tournament,
+        # ordered by cell; the entries of cell c are cell_offsets[c]:cell_offsets[c + 1]
+        self.group_tournament = array('l')  # Dense tournament index
+        self.group_matches = array('l')
+        self.group_wins = array('l')
+        self.group_scored = array('l')
+        self.group_conceded = array('l')
+        self.cell_offsets = array('q', [0])
+
+    def __len__(self):
+        return len(self.match_ids)
+
+    def match_sets(self, index):
+        """List the (team1, team2) points of each set of the match at the given position"""
+        start, end = self.set_offsets[index], self.set_offsets[index + 1]
+        return list(zip(self.set_team1_points[start:end], self.set_team2_points[start:end]))
+
+    def match_mask(self, tournament_ids=None, since=None):
+        """Flag the matches that belong to the given tournaments and were played since the given datetime"""
+        if tournament_ids is None:
+            mask = b'\x01' * len(self)
+        else:
+            visible = bytes(tournament_id in tournament_ids for tournament_id in self.tournament_ids)
+            mask = bytes(map(visible.__getitem__, self.match_tournament))
+
+        if since is not None:
+            recent = bytes(map(to_seconds(since).__le__, self.timestamp))
+            mask = bytes(map(operator.and_, mask, recent))
+
+        return mask
+
+    def player_totals(self, tournament_ids=None):
+        """Sum matches, wins and points for every player and match type over the given tournaments
+
+        The groups are ordered by cell, so a cell's total is the difference of a column's running
+        total at the cell's two boundaries: a few passes over whole columns, none per group.
+        """
+        if tournament_ids is None:
+            counted = b'\x01' * len(self.group_tournament)
+        else:
+            visible = bytes(tournament_id in tournament_ids for tournament_id in self.tournament_ids)
+            counted = bytes(map(visible.__getitem__, self.group_tournament))
+
+        # Boundaries of every cell among the groups that are counted
+        kept = array('q', accumulate(counted, initial=0))
+        bounds = array('q', map(kept.__getitem__, self.cell_offsets))
+
+        def cell_sums(values):
+            running = array('q', accumulate(compress(values, counted), initial=0))
+            ends = array('q', map(running.__getitem__, bounds))
+            return array('l', map(operator.sub, ends[1:], ends[:-1]))
+
+        return tuple(cell_sums(column) for column in
+                     (self.group_matches, self.group_wins, self.group_scored, self.group_conceded))
+
+    def player_stats(self, tournament_ids=None):
+        """Build the get_player_stats rows of every player with a match in the given tournaments"""
+        matches, wins, scored, conceded = self.player_totals(tournament_ids)
+        type_count = len(self.match_types)
+
+        players = []
+        for index, player_id in enumerate(self.player_ids):
+            start = index * type_count
+            played = sum(matches[start:start + type_count])
+            if not played:
+                continue
+
+            won = sum(wins[start:start + type_count])
+            match_types = {}
+            for code, match_type in enumerate(self.match_types):
+                if matches[start + code]:
+                    match_types[match_type] = {
+                        'matches': matches[start + code],
+                        'wins': wins[start + code],
+                        'win_rate': round((wins[start + code] / matches[start + code]) * 100, 1)
+                    }
+
+            players.append({
+                'id': player_id,
+                'name': self.player_names[index],
+                'matches': played,
+                'wins': won,
+                'losses': played - won,
+                'win_rate': round((won / played) * 100, 1),
+                'points_scored': sum(scored[start:start + type_count]),
+                'points_conceded': sum(conceded[start:start + type_count]),
+                'match_types': match_types,
+                'recent_matches': []
+            })
+
+        return players
+
+    def monthly_counts(self, tournament_ids=None, since=None):
+        """Count matches per 'YYYY-MM' month over the given tournaments"""
+        counts = Counter(compress(self.month, self.match_mask(tournament_ids, since)))
+        return {f"{month // 12:04d}-{month % 12 + 1:02d}": count for month, count in counts.items()}
+
+
+def build_snapshot(version):
+    """Load the match table into a new snapshot"""
+    snapshot = MatchSnapshot(version)
+
+    player_index = {}
+    for player_id, name in db.session.query(Player.id, Player.name).order_by(Player.id):
+        player_index[player_id] = len(snapshot.player_ids)
+        snapshot.player_ids.append(player_id)
+        snapshot.player_names.append(name)
+
+    team1 = aliased(Team)
+    team2 = aliased(Team)
+    rows = db.session.query(
+        Match.id, Match.tournament_id, Match.match_type, Match.timestamp,
+        team1.player1_id, team1.player2_id, team2.player1_id, team2.player2_id,
+        Match.winner_team_id == Match.team1_id, Match.team1_points, Match.team2_points
+    ).join(team1, Match.team1_id == team1.id).join(team2, Match.team2_id == team2.id).order_by(Match.id).all()
+
+    type_codes = {match_type: code for code, match_type in enumerate(sorted({row[2] for row in rows}))}
+    snapshot.match_types = sorted(type_codes, key=type_codes.get)
+    type_count = len(type_codes)
+
+    tournament_index = {}
+    groups = {}  # (cell, tournament index) -> [matches, wins, scored, conceded]
+    for (match_id, tournament_id, match_type, timestamp, t1p1, t1p2, t2p1, t2p2,
+         team1_won, t1_points, t2_points) in rows:
+        if tournament_id not in tournament_index:
+            tournament_index[tournament_id] = len(snapshot.tournament_ids)
+            snapshot.tournament_ids.append(tournament_id)
+
+        code = type_codes[match_type]
+        snapshot.match_ids.append(match_id)
+        snapshot.match_tournament.append(tournament_index[tournament_id])
+        snapshot.match_type.append(code)
+        snapshot.timestamp.append(to_seconds(timestamp))
+        snapshot.month.append(timestamp.year * 12 + timestamp.month - 1)
+        snapshot.team1_won.append(bool(team1_won))
+        snapshot.team1_points.append(t1_points)
+        snapshot.team2_points.append(t2_points)
+
+        sides = (
+            ((t1p1, t1p2), snapshot.team1_players, bool(team1_won), t1_points, t2_points),
+            ((t2p1, t2p2), snapshot.team2_players, not team1_won, t2_points, t1_points),
+        )
+        for player_ids, columns, won, points_for, points_against in sides:
+            for player_id, column in zip(player_ids, columns):
+                index = player_index.get(player_id, -1)
+                column.append(index)
+                if index < 0:
+                    continue
+                totals = groups.setdefault((index * type_count + code, tournament_index[tournament_id]), [0, 0, 0, 0])
+                totals[0] += 1
+                totals[1] += won
+                totals[2] += points_for
+                totals[3] += points_against
+
+    # Order the groups by cell so per-cell totals are differences of running totals
+    keys = sorted(groups)
+    snapshot.group_tournament = array('l', (tournament for cell, tournament in keys))
+    for column, values in zip(
+        ('group_matches', 'group_wins', 'group_scored', 'group_conceded'), zip(*map(groups.__getitem__, keys))
+    ):
+        setattr(snapshot, column, array('l', values))
+    cells = array('l', (cell for cell, tournament in keys))
+    snapshot.cell_offsets = array('q', (
+        bisect_left(cells, cell) for cell in range(len(snapshot.player_ids) * type_count + 1)
+    ))
+
+    # Sets arrive ordered by match id like the matches, so offsets can be filled in one pass
+    set_rows = db.session.query(
+        MatchSet.match_id, MatchSet.team1_points, MatchSet.team2_points
+    ).order_by(MatchSet.match_id, MatchSet.set_number)
+    position = 0
+    for match_id, t1_points, t2_points in set_rows:
+        while position < len(snapshot.match_ids) and snapshot.match_ids[position] < match_id:
+            snapshot.set_offsets.append(len(snapshot.set_team1_points))
+            position += 1
+        if position < len(snapshot.match_ids) and snapshot.match_ids[position] == match_id:
+            snapshot.set_team1_points.append(t1_points)
+            snapshot.set_team2_points.append(t2_points)
+    while position < len(snapshot.match_ids):
+        snapshot.set_offsets.append(len(snapshot.set_team1_points))
+        position += 1
+
+    return snapshot
+
+
+def get_snapshot():
+    """Get the snapshot of the current match data, rebuilding it if matches or player names changed since it was built"""
+    state = current_app.extensions.setdefault('analytics_engine', {'snapshot': None, 'lock': Lock()})
+    # The snapshot holds player names, which merges and name rewrites change without touching matches
+    version = get_data_versions('matches', IDENTITY_DATA)
+
+    snapshot = state['snapshot']
+    if snapshot is None or snapshot.version != version:
+        with state['lock']:
+            snapshot = state['snapshot']
+            if snapshot is None or snapshot.version != version:
+                snapshot = build_snapshot(version)
+                state['snapshot'] = snapshot
+
+    return snapshot
@@ -15,9 +15,11 @@ from routes.match import match_bp
 from routes.sharing import sharing_bp
 from routes.analytics import analytics_bp
 from routes.admin import admin_bp
+from profiling import init_profiling
+from metrics import init_metrics
 
 
-def create_app():
+def create_app(config=None):
     app = Flask(__name__)
 
     # Load environment variables
@@ -31,6 +33,39 @@ def create_app():
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URI', 'sqlite:///badminton.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'uploads')
+    # Result files at least this large are imported by a background job
+    app.config['BACKGROUND_IMPORT_MIN_BYTES'] = int(os.environ.get('BACKGROUND_IMPORT_MIN_BYTES', 1024 * 1024))
+    # Queued or running imports whose worker process has not checked in for this long are reported as failed
+    app.config['IMPORT_JOB_STALE_SECONDS'] = int(os.environ.get('IMPORT_JOB_STALE_SECONDS', 300))
+    # Number of players whose rival lists are kept in memory
+    app.config['RIVALRY_CACHE_SIZE'] = int(os.environ.get('RIVALRY_CACHE_SIZE', 1024))
+    # Where cached analytics data is kept: 'memory' for each process, or 'file' to share it between processes
+    app.config['RESPONSE_CACHE_STORE'] = os.environ.get('RESPONSE_CACHE_STORE', 'memory')
+    app.config['RESPONSE_CACHE_DIR'] = os.environ.get('RESPONSE_CACHE_DIR')
+    # Number of cached analytics entries, and the seconds each is kept at most
+    app.config['RESPONSE_CACHE_SIZE'] = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+    app.config['RESPONSE_CACHE_SECONDS'] = int(os.environ.get('RESPONSE_CACHE_SECONDS', 300))
+    # How long a request waits for an identical analytics computation already running before doing its own
+    app.config['RESPONSE_CACHE_WAIT_SECONDS'] = float(os.environ.get('RESPONSE_CACHE_WAIT_SECONDS', 30))
+    # JSON API responses at least this large are gzipped for clients that accept it
+    app.config['JSON_COMPRESS_MIN_BYTES'] = int(os.environ.get('JSON_COMPRESS_MIN_BYTES', 1024))
+    # Rows deleted per statement and transaction by the maintenance cleanups
+    app.config['CLEANUP_CHUNK_SIZE'] = int(os.environ.get('CLEANUP_CHUNK_SIZE', 500))
+    # Opt-in SQL profiling of every request, shown on the admin performance page
+    app.config['SQL_PROFILING'] = os.environ.get('SQL_PROFILING', '').lower() in ('1', 'true', 'yes')
+    # Profiled requests over either threshold are logged with their most repeated statements
+    app.config['SQL_PROFILE_SLOW_MS'] = float(os.environ.get('SQL_PROFILE_SLOW_MS', 500))
+    app.config['SQL_PROFILE_MAX_QUERIES'] = int(os.environ.get('SQL_PROFILE_MAX_QUERIES', 50))
+    # Recent requests per endpoint the percentiles are computed from
+    app.config['SQL_PROFILE_SAMPLES'] = int(os.environ.get('SQL_PROFILE_SAMPLES', 1000))
+    # On-demand profiles of single requests (?__profile=1, admins only) kept for the admin profiles page
+    app.config['PROFILE_REPORTS_KEPT'] = int(os.environ.get('PROFILE_REPORTS_KEPT', 20))
+    # Bearer token Prometheus must send to read /metrics; only admins can read it when unset
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+    # Settings given by the caller (such as the tests) win, and must be in place before the database is set up
+    if config:
+        app.config.update(config)
 
     # Ensure upload directory exists
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -49,6 +84,12 @@ def create_app():
     app.register_blueprint(analytics_bp)
     app.register_blueprint(admin_bp)
 
+    # Per-request SQL profiling, when switched on
+    init_profiling(app)
+
+    # Prometheus metrics of requests, SQL, imports and caches at /metrics
+    init_metrics(app)
+
     # Error handlers
     @app.errorhandler(404)
     def page_not_found(e):
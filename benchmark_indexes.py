@@ -0,0 +1,171 @@
+"""
+Index Benchmark - Shows the query plans and timings of the hot queries with and without the model indexes.
+Builds a throwaway SQLite database filled with generated data, so it never touches badminton.db.
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+from sqlalchemy import func, text
+from sqlalchemy.schema import CreateIndex, DropIndex
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from models import db, User, Tournament, Player, Team, Match, SharedTournament, team_pair_key
+
+
+def fill_database(players, matches, tournaments, seed=1):
+    """Insert generated users, players, teams, tournaments and matches"""
+    rng = random.Random(seed)
+    db.session.execute(User.__table__.insert(), [
+        {'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': '-'} for i in range(1, 11)
+    ])
+    db.session.execute(Player.__table__.insert(), [{'name': f'Player {i}'} for i in range(1, players + 1)])
+    db.session.execute(Tournament.__table__.insert(), [
+        {'name': f'Tournament {i}', 'date': datetime(2020 + i % 5, 1, 1).date(), 'user_id': 1 + i % 10}
+        for i in range(1, tournaments + 1)
+    ])
+    db.session.execute(SharedTournament.__table__.insert(), [
+        {'tournament_id': i, 'owner_id': 1 + i % 10, 'shared_with_id': 1 + (i + 1) % 10}
+        for i in range(1, tournaments + 1, 3)
+    ])
+
+    team_keys = {}
+    team_rows = []
+    match_rows = []
+    start = datetime(2020, 1, 1)
+    for i in range(matches):
+        doubles = i % 2 == 0
+        chosen = rng.sample(range(1, players + 1), 4 if doubles else 2)
+        sides = [(chosen[0], chosen[1]), (chosen[2], chosen[3])] if doubles else [(chosen[0], None), (chosen[1], None)]
+        team_ids = []
+        for pair in sides:
+            key = team_pair_key(*pair)
+            if key not in team_keys:
+                team_keys[key] = len(team_rows) + 1
+                team_rows.append({'id': team_keys[key], 'player1_id': pair[0], 'player2_id': pair[1]})
+            team_ids.append(team_keys[key])
+
+        match_rows.append({
+            'tournament_id': 1 + i % tournaments,
+            'round_name': 'Round',
+            'team1_id': team_ids[0],
+            'team2_id': team_ids[1],
+            'winner_team_id': team_ids[i % 2],
+            'score1': '21-15, 21-18',
+            'score2': '15-21, 18-21',
+            'match_type': "Men's Doubles" if doubles else "Men's Singles",
+            'timestamp': start + timedelta(minutes=37 * i),
+            'team1_points': 42,
+            'team2_points': 33,
+            'total_points': 75,
+            'set_count': 2
+        })
+
+    db.session.execute(Team.__table__.insert(), team_rows)
+    db.session.execute(Match.__table__.insert(), match_rows)
+    db.session.commit()
+
+
+def hot_queries():
+    """The filters behind the analytics, match listing, sharing and import pages"""
+    low, high = Team.pair_key()
+    player_teams = db.session.query(Team.id).filter((Team.player1_id == 7) | (Team.player2_id == 7))
+    other_teams = db.session.query(Team.id).filter((Team.player1_id == 8) | (Team.player2_id == 8))
+    shared = db.session.query(SharedTournament.tournament_id).filter(SharedTournament.shared_with_id == 2)
+
+    return {
+        'Tournament match list': db.session.query(Match.id).filter(
+            Match.tournament_id == 5
+        ).order_by(Match.timestamp.desc()),
+        'Player match history': db.session.query(Match.id).filter(
+            Match.team1_id.in_(player_teams) | Match.team2_id.in_(player_teams)
+        ),
+        'Head-to-head': db.session.query(Match.id).filter(
+            (Match.team1_id.in_(player_teams) & Match.team2_id.in_(other_teams)) |
+            (Match.team1_id.in_(other_teams) & Match.team2_id.in_(player_teams))
+        ),
+        'Team lookup (process_team)': db.session.query(Team.id).filter(low == 3, high == 9),
+        'Player lookup by name': db.session.query(Player.id).filter(Player.name == 'Player 42'),
+        'Tournaments visible to a user': db.session.query(Tournament.id).filter(
+            (Tournament.user_id == 2) | Tournament.id.in_(shared)
+        ),
+        'Match types for a user': db.session.query(Match.match_type, func.count(Match.id)).join(
+            Tournament, Match.tournament_id == Tournament.id
+        ).filter(Tournament.user_id == 2).group_by(Match.match_type),
+        'Recent matches': db.session.query(Match.id).filter(
+            Match.timestamp >= datetime(2021, 6, 1)
+        ).order_by(Match.timestamp.desc()).limit(20)
+    }
+
+
+def measure(repeat):
+    """Return the query plan and best run time in milliseconds of every hot query"""
+    results = {}
+    for name, query in hot_queries().items():
+        sql = str(query.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        plan = [row[-1] for row in db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            db.session.execute(text(sql)).fetchall()
+            timings.append((time.perf_counter() - started) * 1000)
+        results[name] = (plan, min(timings))
+
+    # Release the connection so the next run sees the changed schema
+    db.session.remove()
+    return results
+
+
+def set_indexes(enabled):
+    """Drop or create every index declared in models.py"""
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if enabled:
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+                else:
+                    connection.execute(DropIndex(index, if_exists=True))
+        connection.execute(text("ANALYZE"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--players', type=int, default=2000)
+    parser.add_argument('--matches', type=int, default=50000)
+    parser.add_argument('--tournaments', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(directory, 'benchmark.db')}"
+        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(app)
+
+        with app.app_context():
+            db.create_all()
+            print(f"Generating {args.players} players and {args.matches} matches...")
+            fill_database(args.players, args.matches, args.tournaments)
+
+            set_indexes(False)
+            before = measure(args.repeat)
+            set_indexes(True)
+            after = measure(args.repeat)
+            db.engine.dispose()
+
+    for name in before:
+        (plan_before, time_before), (plan_after, time_after) = before[name], after[name]
+        print(f"\n=== {name}: {time_before:.2f} ms -> {time_after:.2f} ms")
+        print("  before: " + "; ".join(plan_before))
+        print("  after:  " + "; ".join(plan_after))
+
+
+if __name__ == "__main__":
+    main()
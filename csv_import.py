@@ -0,0 +1,314 @@
+"""
+CSV Import - Bulk import of post-tournament result files
+"""
+import time
+from datetime import datetime
+
+from models import db, Tournament, Match, MatchSet, summarize_scores, team_pair_key
+from identity_map import normalize_player_name, resolve_player_ids, resolve_team_ids
+from player_stats import add_match_deltas, add_rivalry_deltas, merge_deltas, merge_rivalry_deltas, team_player_ids
+from ratings import rate_new_matches
+from utils import bump_data_version, touch_tournaments
+from metrics import record_import
+from response_cache import TOURNAMENT_DATA
+
+# Columns looked up by header name, with the position used when the header is missing
+RESULT_COLUMNS = {
+    'team1': ('Team 1', 0),
+    'team2': ('Team 2', 1),
+    'score1': ('Score 1', 2),
+    'score2': ('Score 2', 3),
+    'round': ('Round', 4),
+    'match_type': ('Match Type', 5),
+    'tournament': ('Tournament', 6),
+    'year': ('Year', 7)
+}
+
+# Rows shown on the review page and problem rows listed there
+PREVIEW_ROWS = 50
+PREVIEW_ERRORS = 10
+
+
+def result_column_indexes(headers):
+    """Map each result field to its column position in the file"""
+    return {
+        field: headers.index(header) if header in headers else default
+        for field, (header, default) in RESULT_COLUMNS.items()
+    }
+
+
+def parse_result_row(row, indexes):
+    """Turn one CSV row into a result dictionary, raising ValueError for unusable rows"""
+    def cell(field, default):
+        index = indexes[field]
+        return row[index] if index < len(row) else default
+
+    def team(field):
+        names = [normalize_player_name(name) for name in cell(field, '').split(',')]
+        if not names[0]:
+            raise ValueError(f"{RESULT_COLUMNS[field][0]} has no player")
+        return (names[0], names[1] if len(names) > 1 and names[1] else None)
+
+    return {
+        'tournament': cell('tournament', "Unknown"),
+        'year': cell('year', ""),
+        'team1': team('team1'),
+        'team2': team('team2'),
+        'score1': cell('score1', "0-0"),
+        'score2': cell('score2', "0-0"),
+        'round': cell('round', "Unknown"),
+        'match_type': cell('match_type', "Unknown")
+    }
+
+
+class ResultImporter:
+    """Imports parsed result rows in batches, resolving players and teams with a few IN queries per batch"""
+
+    def __init__(self, user_id, batch_size=1000):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.player_ids = {}     # Player name -> id
+        self.team_ids = {}       # team_pair_key -> id
+        self.tournaments = {}    # "name_year" -> tournament id
+        self.match_count = 0
+        self.last_line = 1       # Line number of the last row read
+        self.errors = []         # (line number, message)
+
+    def resolve_players(self, names):
+        """Look up the given player names, creating the missing ones with one bulk insert"""
+        self.player_ids.update(resolve_player_ids(name for name in names if name not in self.player_ids))
+
+    def resolve_teams(self, pairs):
+        """Look up the given (player1_id, player2_id) teams, creating the missing ones with one bulk insert"""
+        self.team_ids.update(resolve_team_ids(pair for pair in pairs if team_pair_key(*pair) not in self.team_ids))
+
+    def team_id(self, pair):
+        """Id of an already resolved team"""
+        return self.team_ids[team_pair_key(*pair)]
+
+    def resolve_tournament(self, name, year):
+        """Find the user's tournament for a name and year, creating it when it does not exist"""
+        key = f"{name}_{year}"
+        if key not in self.tournaments:
+            existing = Tournament.query.filter_by(name=name, user_id=self.user_id).first()
+            if existing and str(existing.date.year) == year:
+                self.tournaments[key] = existing.id
+            else:
+                try:
+                    tournament_date = datetime(int(year), 1, 1).date() if year.isdigit() else datetime.now().date()
+                except ValueError:
+                    tournament_date = datetime.now().date()
+
+                tournament = Tournament(name=name, date=tournament_date, location="", user_id=self.user_id)
+                db.session.add(tournament)
+                db.session.flush()  # Get id
+                bump_data_version(TOURNAMENT_DATA)
+                self.tournaments[key] = tournament.id
+
+        return self.tournaments[key]
+
+    def import_batch(self, batch):
+        """Insert one batch of (line number, result) pairs in a single transaction"""
+        names = set()
+        for line, result in batch:
+            names.update(name for name in result['team1'] + result['team2'] if name)
+        self.resolve_players(names)
+
+        def team_key(team):
+            return (self.player_ids[team[0]], self.player_ids[team[1]] if team[1] else None)
+
+        self.resolve_teams({team_key(result[side]) for line, result in batch for side in ('team1', 'team2')})
+
+        match_rows = []
+        set_rows = {}            # (score1, score2) -> parsed sets
+        deltas = {}
+        rivalry_deltas = {}
+        for line, result in batch:
+            team1_id = self.team_id(team_key(result['team1']))
+            team2_id = self.team_id(team_key(result['team2']))
+            team1_players = team_player_ids(*team_key(result['team1']))
+            team2_players = team_player_ids(*team_key(result['team2']))
+
+            if result['match_type'].endswith('Doubles') and set(team1_players) & set(team2_players):
+                self.errors.append((line, "In doubles, the player cannot play against themselves "
+                                          f"({', '.join(filter(None, result['team1']))} vs "
+                                          f"{', '.join(filter(None, result['team2']))})"))
+                continue
+
+            tournament_id = self.resolve_tournament(result['tournament'], result['year'])
+            summary = summarize_scores(result['score1'], result['score2'])
+            match_rows.append({
+                'tournament_id': tournament_id,
+                'round_name': result['round'],
+                'team1_id': team1_id,
+                'team2_id': team2_id,
+                'score1': result['score1'],
+                'score2': result['score2'],
+                'match_type': result['match_type'],
+                'winner_team_id': team1_id if summary['team1_won'] else team2_id,
+                'team1_points': summary['team1_points'],
+                'team2_points': summary['team2_points'],
+                'total_points': summary['team1_points'] + summary['team2_points'],
+                'set_count': summary['set_count']
+            })
+            set_rows[result['score1'], result['score2']] = summary['sets']
+            add_match_deltas(deltas, tournament_id, result['match_type'], team1_players, team2_players,
+                             summary['team1_won'], summary['team1_points'], summary['team2_points'])
+            add_rivalry_deltas(rivalry_deltas, tournament_id, team1_players, team2_players,
+                               summary['team1_won'], summary['team1_points'], summary['team2_points'])
+
+        if match_rows:
+            # RETURNING rows come back in no particular order, but a match's sets only depend on its
+            # score strings, so each returned id is paired with the sets parsed from its own scores
+            inserted = db.session.execute(
+                Match.__table__.insert().returning(Match.id, Match.score1, Match.score2), match_rows
+            )
+            set_mappings = [
+                {'match_id': match_id, 'set_number': number, 'team1_points': team1_points, 'team2_points': team2_points}
+                for match_id, score1, score2 in inserted
+                for number, (team1_points, team2_points) in enumerate(set_rows[score1, score2], start=1)
+            ]
+            if set_mappings:
+                db.session.execute(MatchSet.__table__.insert(), set_mappings)
+            merge_deltas(deltas)
+            merge_rivalry_deltas(rivalry_deltas)
+            rate_new_matches()
+            touch_tournaments({row['tournament_id'] for row in match_rows})
+            bump_data_version()
+
+        db.session.commit()
+        self.match_count += len(match_rows)
+
+    def run(self, rows, on_batch=None):
+        """Import (line number, result or error message) pairs, committing every batch_size rows"""
+        batch = []
+        read = 0
+        started = time.perf_counter()
+        for line, result in rows:
+            self.last_line = line
+            read += 1
+            if isinstance(result, str):
+                self.errors.append((line, result))
+            else:
+                batch.append((line, result))
+
+            if read >= self.batch_size:
+                if batch:
+                    self._commit_batch(batch)
+                batch = []
+                read = 0
+                # The callback sees the progress so far and can stop the import between batches
+                if on_batch and on_batch(self):
+                    break
+        else:
+            # Only reached when the callback didn't stop the import
+            if batch:
+                self._commit_batch(batch)
+            if on_batch:
+                on_batch(self)
+
+        record_import(self.last_line - 1, self.match_count, time.perf_counter() - started)
+        return self
+
+    def _commit_batch(self, batch):
+        """Import a batch, splitting it in halves when it fails so good rows still get in and each bad row is reported"""
+        error_count = len(self.errors)
+        try:
+            self.import_batch(batch)
+        except Exception as e:
+            db.session.rollback()
+            # Tournaments, players and teams created in the failed batch were rolled back too,
+            # and its rows are checked again when the halves are retried
+            self.tournaments = {}
+            self.player_ids = {}
+            self.team_ids = {}
+            del self.errors[error_count:]
+            if len(batch) == 1:
+                self.errors.append((batch[0][0], f"could not be saved: {getattr(e, 'orig', None) or e}"))
+                return
+            middle = len(batch) // 2
+            self._commit_batch(batch[:middle])
+            self._commit_batch(batch[middle:])
+
+
+def read_result_rows(csv_reader):
+    """Yield (line number, parsed result or error message) for each data row of a results file"""
+    headers = next(csv_reader)
+    indexes = result_column_indexes(headers)
+
+    for line, row in enumerate(csv_reader, start=2):
+        if len(row) < 6:
+            continue
+        try:
+            yield line, parse_result_row(row, indexes)
+        except ValueError as e:
+            yield line, str(e)
+
+
+def preview_results(csv_reader, preview_rows=PREVIEW_ROWS, preview_errors=PREVIEW_ERRORS):
+    """Validate a results file in one pass, keeping only its first rows and first problems for display"""
+    headers = next(csv_reader)
+    indexes = result_column_indexes(headers)
+    preview = {
+        'headers': headers,
+        'rows': [],
+        'errors': [],
+        'row_count': 0,
+        'valid_count': 0,
+        'error_count': 0,
+        'ignored_count': 0,
+        'tournament_name': None
+    }
+
+    for line, row in enumerate(csv_reader, start=2):
+        preview['row_count'] += 1
+        if len(preview['rows']) < preview_rows:
+            preview['rows'].append(row)
+
+        if line == 2 and 'tournament' in (header.lower() for header in headers):
+            preview['tournament_name'] = _first_tournament_name(headers, row)
+
+        if len(row) < 6:
+            preview['ignored_count'] += 1
+            continue
+        try:
+            parse_result_row(row, indexes)
+            preview['valid_count'] += 1
+        except ValueError as e:
+            preview['error_count'] += 1
+            if len(preview['errors']) < preview_errors:
+                preview['errors'].append((line, str(e)))
+
+    return preview
+
+
+def _first_tournament_name(headers, row):
+    names = {header.lower(): index for index, header in enumerate(headers)}
+    name = row[names['tournament']] if names['tournament'] < len(row) else ''
+    if 'year' in names and names['year'] < len(row):
+        name = f"{name} {row[names['year']]}"
+    return name
+
+
+def import_player_names(csv_reader, batch_size=1000):
+    """Create the players named in the first column of a pre-tournament file, returning the number of names read"""
+    importer = ResultImporter(user_id=None)
+    next(csv_reader, None)  # Skip header row
+
+    count = 0
+    batch = set()
+    for row in csv_reader:
+        if len(row) >= 1 and row[0].strip():
+            batch.add(normalize_player_name(row[0]))
+            count += 1
+            if len(batch) >= batch_size:
+                importer.resolve_players(batch)
+                batch = set()
+    importer.resolve_players(batch)
+
+    return count
+
+
+def import_results(csv_reader, user_id, batch_size=1000, on_batch=None):
+    """Import a post-tournament results file and return the importer holding counts and row errors"""
+    return ResultImporter(user_id, batch_size).run(read_result_rows(csv_reader), on_batch)
@@ -1,13 +1,16 @@
 """
-Migration script to add the SharedTournament table to the database
-Run this after modifying models.py to include the SharedTournament model
+Migration script to bring an existing database up to date with models.py
+Run this after modifying models.py to create new tables and backfill derived data
 """
 
 import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from app import app, db
-from models import SharedTournament  # Import the model to ensure it's registered
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+from models import SharedTournament, PlayerStats, RivalryStats, Match, MatchSet, DataVersion, ImportJob, summarize_scores, \
+    PlayerRating, TeamRating, RatingHistory, PLAYER_SEARCH_DDL, fts5_trigram_supported  # Import the models to ensure they're registered
 
 def migrate_database():
     """Check if SharedTournament table exists, create it if not"""
@@ -25,5 +28,185 @@ def migrate_database():
             else:
                 print(f"Error checking SharedTournament table: {str(e)}")
 
+def migrate_match_scores(batch_size=1000):
+    """Add the structured score columns and MatchSet table, then backfill them from the score strings"""
+    with app.app_context():
+        existing_columns = {column['name'] for column in inspect(db.engine).get_columns('match')}
+        new_columns = {
+            'winner_team_id': 'INTEGER REFERENCES team (id)',
+            'team1_points': 'INTEGER NOT NULL DEFAULT 0',
+            'team2_points': 'INTEGER NOT NULL DEFAULT 0',
+            'total_points': 'INTEGER NOT NULL DEFAULT 0',
+            'set_count': 'INTEGER NOT NULL DEFAULT 0'
+        }
+        with db.engine.begin() as connection:
+            for name, definition in new_columns.items():
+                if name not in existing_columns:
+                    print(f"Adding match.{name} column...")
+                    connection.execute(text(f"ALTER TABLE match ADD COLUMN {name} {definition}"))
+
+        MatchSet.__table__.create(db.engine, checkfirst=True)
+        for index in Match.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+
+        print("Backfilling structured scores...")
+        last_id = 0
+        updated = 0
+        while True:
+            rows = db.session.query(
+                Match.id, Match.team1_id, Match.team2_id, Match.score1, Match.score2
+            ).filter(Match.id > last_id).order_by(Match.id).limit(batch_size).all()
+            if not rows:
+                break
+
+            match_ids = [row.id for row in rows]
+            MatchSet.query.filter(MatchSet.match_id.in_(match_ids)).delete(synchronize_session=False)
+
+            match_updates = []
+            set_rows = []
+            for row in rows:
+                summary = summarize_scores(row.score1, row.score2)
+                match_updates.append({
+                    'id': row.id,
+                    'winner_team_id': row.team1_id if summary['team1_won'] else row.team2_id,
+                    'team1_points': summary['team1_points'],
+                    'team2_points': summary['team2_points'],
+                    'total_points': summary['team1_points'] + summary['team2_points'],
+                    'set_count': summary['set_count']
+                })
+                for number, (team1_points, team2_points) in enumerate(summary['sets'], start=1):
+                    set_rows.append({
+                        'match_id': row.id,
+                        'set_number': number,
+                        'team1_points': team1_points,
+                        'team2_points': team2_points
+                    })
+
+            db.session.bulk_update_mappings(Match, match_updates)
+            db.session.bulk_insert_mappings(MatchSet, set_rows)
+            db.session.commit()
+
+            updated += len(rows)
+            last_id = match_ids[-1]
+
+        print(f"Structured scores stored for {updated} matches")
+
+def migrate_player_stats():
+    """Create the PlayerStats table if needed and fill it from the existing matches"""
+    from player_stats import rebuild_player_stats
+
+    with app.app_context():
+        PlayerStats.__table__.create(db.engine, checkfirst=True)
+        print("Building player statistics from existing matches...")
+        row_count = rebuild_player_stats()
+        db.session.commit()
+        print(f"PlayerStats table built with {row_count} rows")
+
+def migrate_rivalry_stats():
+    """Create the RivalryStats table if needed and fill it from the existing matches"""
+    from player_stats import rebuild_rivalry_stats
+
+    with app.app_context():
+        RivalryStats.__table__.create(db.engine, checkfirst=True)
+        print("Building head-to-head statistics from existing matches...")
+        row_count = rebuild_rivalry_stats()
+        db.session.commit()
+        print(f"RivalryStats table built with {row_count} rows")
+
+def migrate_player_search():
+    """Create the player name search index and its triggers if the database supports them"""
+    with app.app_context():
+        with db.engine.begin() as connection:
+            if not fts5_trigram_supported(connection):
+                print("Skipping player search index: SQLite 3.34+ with FTS5 is required")
+                return
+            # Every statement is idempotent, and the final 'rebuild' reindexes the existing players
+            for statement in PLAYER_SEARCH_DDL:
+                connection.exec_driver_sql(statement)
+        print("Player search index built")
+
+def migrate_data_versions():
+    """Create the DataVersion table used to invalidate in-memory analytics data"""
+    with app.app_context():
+        DataVersion.__table__.create(db.engine, checkfirst=True)
+        print("DataVersion table ready")
+
+def migrate_tournament_stamps():
+    """Add the data stamp the JSON APIs build per-tournament ETags from"""
+    with app.app_context():
+        existing_columns = {column['name'] for column in inspect(db.engine).get_columns('tournament')}
+        if 'data_stamp' not in existing_columns:
+            print("Adding tournament.data_stamp column...")
+            with db.engine.begin() as connection:
+                connection.execute(text("ALTER TABLE tournament ADD COLUMN data_stamp VARCHAR(32) NOT NULL DEFAULT ''"))
+                connection.execute(text("UPDATE tournament SET data_stamp = lower(hex(randomblob(16)))"))
+        print("Tournament data stamps ready")
+
+def migrate_player_names():
+    """Collapse the extra whitespace in player names saved before names were normalized"""
+    from identity_map import normalize_stored_names
+
+    with app.app_context():
+        renamed = normalize_stored_names()
+        db.session.commit()
+        print(f"Normalized {renamed} player names")
+
+def migrate_import_jobs():
+    """Create the ImportJob table used to track background imports"""
+    with app.app_context():
+        ImportJob.__table__.create(db.engine, checkfirst=True)
+        existing_columns = {column['name'] for column in inspect(db.engine).get_columns('import_job')}
+        with db.engine.begin() as connection:
+            for name, definition in (('runner_id', 'VARCHAR(100)'), ('heartbeat_at', 'DATETIME')):
+                if name not in existing_columns:
+                    print(f"Adding import_job.{name} column...")
+                    connection.execute(text(f"ALTER TABLE import_job ADD COLUMN {name} {definition}"))
+        print("ImportJob table ready")
+
+def migrate_indexes():
+    """Merge duplicate teams, then create any index declared in models.py that the database is missing"""
+    from utils import merge_duplicate_teams, bump_data_version
+    from identity_map import IDENTITY_DATA
+
+    with app.app_context():
+        # The unique team index cannot be built while the same pair of players has several teams
+        removed = merge_duplicate_teams()
+        if removed:
+            bump_data_version()
+            bump_data_version(IDENTITY_DATA)
+        db.session.commit()
+        print(f"Merged {removed} duplicate teams")
+
+        with db.engine.begin() as connection:
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+
+            # Refresh the statistics SQLite's query planner uses to choose between indexes
+            connection.execute(text("ANALYZE"))
+        print("Indexes up to date")
+
+def migrate_ratings():
+    """Create the rating tables if needed and rate every existing match in order"""
+    from ratings import replay_ratings
+
+    with app.app_context():
+        for model in (PlayerRating, TeamRating, RatingHistory):
+            model.__table__.create(db.engine, checkfirst=True)
+        print("Rating every match in order...")
+        match_count = replay_ratings()
+        db.session.commit()
+        print(f"Ratings built from {match_count} matches")
+
 if __name__ == "__main__":
-    migrate_database()
\ No newline at end of file
+    migrate_database()
+    migrate_match_scores()
+    migrate_player_stats()
+    migrate_rivalry_stats()
+    migrate_player_search()
+    migrate_data_versions()
+    migrate_tournament_stamps()
+    migrate_player_names()
+    migrate_import_jobs()
+    migrate_indexes()
+    migrate_ratings()
@@ -0,0 +1,240 @@
+"""
+Head-to-Head - Cached rival lists built from the RivalryStats table, and match pages computed in SQL
+"""
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, and_, or_, select
+from sqlalchemy.orm import Session, aliased
+
+from models import db, Tournament, Match, Team, Player, RivalryStats
+from utils import before_match
+
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = 200
+
+
+def player_team_ids(player_id):
+    """Subquery of the ids of every team a player belongs to"""
+    return select(Team.id).where((Team.player1_id == player_id) | (Team.player2_id == player_id))
+
+
+def versus_condition(player1_id, player2_id):
+    """Filter for matches with the two players on opposite sides, plus a flag for player 1 being in team 1"""
+    player1_teams = player_team_ids(player1_id)
+    player2_teams = player_team_ids(player2_id)
+    player1_in_team1 = Match.team1_id.in_(player1_teams)
+    condition = or_(
+        and_(player1_in_team1, Match.team2_id.in_(player2_teams)),
+        and_(Match.team1_id.in_(player2_teams), Match.team2_id.in_(player1_teams))
+    )
+    return condition, player1_in_team1
+
+
+class RivalryCache:
+    """Bounded LRU of rival lists by player id, from which the players of committed match writes are evicted"""
+
+    def __init__(self, max_players):
+        self.max_players = max_players
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, player_id, load):
+        """Get a player's rival list, loading it with load(player_id) when it is not cached"""
+        with self.lock:
+            if player_id in self.entries:
+                self.entries.move_to_end(player_id)
+                self.hits += 1
+                return self.entries[player_id]
+            self.misses += 1
+            generation = self.generation
+
+        rivals = load(player_id)
+        with self.lock:
+            # Don't keep a list loaded while an eviction was going on, it may predate the write
+            if generation == self.generation:
+                self.entries[player_id] = rivals
+                while len(self.entries) > self.max_players:
+                    self.entries.popitem(last=False)
+        return rivals
+
+    def evict(self, player_ids=None):
+        """Forget the rival lists of the given players, or of everyone when None"""
+        with self.lock:
+            self.generation += 1
+            if player_ids is None:
+                self.entries.clear()
+            else:
+                for player_id in player_ids:
+                    self.entries.pop(player_id, None)
+
+
+def get_rivalry_cache(app=None):
+    """Get the rival list cache of the application, creating it on first use"""
+    app = app or current_app._get_current_object()
+    if 'rivalry_cache' not in app.extensions:
+        app.extensions['rivalry_cache'] = RivalryCache(app.config.get('RIVALRY_CACHE_SIZE', 1024))
+    return app.extensions['rivalry_cache']
+
+
+def forget_rivals(player_ids=None):
+    """Evict the rival lists of players whose RivalryStats rows this transaction changes (everyone when None), once it commits"""
+    stale = db.session.info.setdefault('stale_rivals', set())
+    if player_ids is None:
+        db.session.info['stale_rivals'] = None
+    elif stale is not None:
+        stale.update(player_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _evict_stale_rivals(session):
+    if 'stale_rivals' not in session.info:
+        return
+    player_ids = session.info.pop('stale_rivals')
+    if has_app_context() and 'rivalry_cache' in current_app.extensions:
+        current_app.extensions['rivalry_cache'].evict(player_ids)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_stale_rivals(session, previous_transaction):
+    session.info.pop('stale_rivals', None)
+
+
+def load_rivals(player_id):
+    """Read a player's RivalryStats rows, grouped by opponent, with the tournament of each row"""
+    rows = db.session.query(
+        RivalryStats.opponent_id,
+        Player.name,
+        RivalryStats.tournament_id,
+        RivalryStats.matches,
+        RivalryStats.wins,
+        RivalryStats.losses,
+        RivalryStats.points_scored,
+        RivalryStats.points_conceded
+    ).join(
+        Player, RivalryStats.opponent_id == Player.id
+    ).filter(
+        RivalryStats.player_id == player_id
+    )
+
+    rivals = {}
+    for opponent_id, name, tournament_id, *totals in rows:
+        rivals.setdefault(opponent_id, {'name': name, 'tournaments': []})['tournaments'].append((tournament_id, *totals))
+    return rivals
+
+
+def _rival_record(opponent_id, rival, tournament_ids=None):
+    """Sum the per-tournament rows of one opponent, over the given tournaments only when given"""
+    sums = [0, 0, 0, 0, 0]
+    for tournament_id, *totals in rival['tournaments']:
+        if tournament_ids is None or tournament_id in tournament_ids:
+            sums = [total + value for total, value in zip(sums, totals)]
+    matches, wins, losses, scored, conceded = sums
+    if not matches:
+        return None
+    return {
+        'id': opponent_id,
+        'name': rival['name'],
+        'matches': matches,
+        'wins': wins,
+        'losses': losses,
+        'win_rate': round((wins / matches) * 100, 1),
+        'points_scored': scored,
+        'points_conceded': conceded
+    }
+
+
+def get_rivals(player_id, tournament_ids=None):
+    """Get every opponent a player has met with their record against them, sorted by meetings
+
+    When tournament_ids is given, only meetings in those tournaments count.
+    """
+    rivals = get_rivalry_cache().get(player_id, load_rivals)
+    records = filter(None, (_rival_record(opponent_id, rival, tournament_ids) for opponent_id, rival in rivals.items()))
+    return sorted(records, key=lambda record: (-record['matches'], record['name']))
+
+
+def rivalry_summary(player1_id, player2_id):
+    """Get the meetings, wins and points of two players from the cached rival list of the first"""
+    rival = get_rivalry_cache().get(player1_id, load_rivals).get(player2_id)
+    record = rival and _rival_record(player2_id, rival)
+    if not record:
+        return {'total_matches': 0, 'player1_wins': 0, 'player2_wins': 0, 'player1_points': 0, 'player2_points': 0}
+
+    return {
+        'total_matches': record['matches'],
+        'player1_wins': record['wins'],
+        'player2_wins': record['losses'],
+        'player1_points': record['points_scored'],
+        'player2_points': record['points_conceded']
+    }
+
+
+def rivalry_stamps(player1_id, player2_id):
+    """Data stamps of the tournaments two players met in, which change with any of their meetings"""
+    return tuple(tuple(row) for row in db.session.query(Tournament.id, Tournament.data_stamp).filter(
+        Tournament.id.in_(select(RivalryStats.tournament_id).where(
+            RivalryStats.player_id == player1_id, RivalryStats.opponent_id == player2_id
+        ))
+    ).order_by(Tournament.id))
+
+
+def rivalry_matches(player1_id, player2_id, limit=DEFAULT_PAGE_SIZE, offset=0, before_id=None):
+    """Get one page of the matches between two players, newest first"""
+    condition, player1_in_team1 = versus_condition(player1_id, player2_id)
+    team1, team2 = aliased(Team), aliased(Team)
+    team1_player1, team1_player2 = aliased(Player), aliased(Player)
+    team2_player1, team2_player2 = aliased(Player), aliased(Player)
+
+    query = db.session.query(
+        Match.id, Match.timestamp, Match.match_type, Match.score1, Match.score2,
+        Match.team1_id, Match.winner_team_id, player1_in_team1, Tournament.name,
+        team1_player1.name, team1_player2.name, team2_player1.name, team2_player2.name
+    ).join(
+        Tournament, Match.tournament_id == Tournament.id
+    ).join(
+        team1, Match.team1_id == team1.id
+    ).join(
+        team2, Match.team2_id == team2.id
+    ).join(
+        team1_player1, team1.player1_id == team1_player1.id
+    ).outerjoin(
+        team1_player2, team1.player2_id == team1_player2.id
+    ).join(
+        team2_player1, team2.player1_id == team2_player1.id
+    ).outerjoin(
+        team2_player2, team2.player2_id == team2_player2.id
+    ).filter(condition).order_by(Match.timestamp.desc(), Match.id.desc())
+
+    # Continuing after the last match seen keeps deep pages as cheap as the first one
+    if before_id is not None:
+        query = query.filter(before_match(before_id))
+    elif offset:
+        query = query.offset(offset)
+
+    matches = []
+    rows = query.limit(limit)
+    for (match_id, timestamp, match_type, score1, score2, team1_id, winner_team_id, in_team1, tournament,
+         t1p1, t1p2, t2p1, t2p2) in rows:
+        if winner_team_id is None:
+            winner_id = None
+        else:
+            winner_id = player1_id if (winner_team_id == team1_id) == bool(in_team1) else player2_id
+
+        matches.append({
+            'id': match_id,
+            'date': timestamp.strftime('%Y-%m-%d'),
+            'tournament': tournament,
+            'team1': ', '.join(filter(None, (t1p1, t1p2))),
+            'team2': ', '.join(filter(None, (t2p1, t2p2))),
+            'score1': score1,
+            'score2': score2,
+            'winner_id': winner_id,
+            'match_type': match_type
+        })
+
+    return matches
@@ -0,0 +1,206 @@
+"""
+Identity Map - App-wide cache of player ids by name and team ids by player pair
+"""
+from threading import Lock
+
+from flask import current_app, g
+from sqlalchemy import event, or_, update
+from sqlalchemy.orm import Session
+
+from models import db, Player, Team, team_pair_key
+from utils import get_data_version, bump_data_version
+from response_cache import PLAYER_DATA
+
+# Data set whose version changes whenever players or teams are merged or deleted
+IDENTITY_DATA = 'identities'
+
+# Keep IN lists well below SQLite's bound parameter limit
+IN_CHUNK_SIZE = 400
+
+
+def normalize_player_name(name):
+    """Strip a player name and collapse the whitespace inside it"""
+    return ' '.join(name.split())
+
+
+def split_team_names(team_names):
+    """Turn a 'Player A, Player B' string into a (name, name or None) pair of normalized names"""
+    names = [normalize_player_name(name) for name in team_names.split(',')]
+    return names[0], names[1] if len(names) > 1 and names[1] else None
+
+
+def _chunks(values, size=IN_CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class IdentityMap:
+    """Player ids by normalized name and team ids by team_pair_key, shared by every request"""
+
+    def __init__(self):
+        self.player_ids = {}
+        self.team_ids = {}
+        self.version = None
+        self.lock = Lock()
+
+    def sync(self, version):
+        """Drop everything when players or teams were merged or deleted since the map was filled"""
+        with self.lock:
+            if version != self.version:
+                self.player_ids.clear()
+                self.team_ids.clear()
+                self.version = version
+
+    def remember(self, version, player_ids, team_ids):
+        """Add ids read or created by a committed transaction"""
+        with self.lock:
+            if version == self.version:
+                self.player_ids.update(player_ids)
+                self.team_ids.update(team_ids)
+
+
+def get_identity_map(app=None):
+    """Get the identity map of the application, checking its version once per request"""
+    app = app or current_app._get_current_object()
+    identities = app.extensions.setdefault('identity_map', IdentityMap())
+    if not g.get('identity_map_synced'):
+        identities.sync(get_data_version(IDENTITY_DATA))
+        g.identity_map_synced = True
+    return identities
+
+
+def invalidate_identities():
+    """Forget every cached id after players or teams were merged or deleted"""
+    bump_data_version(IDENTITY_DATA)
+    identities = current_app.extensions.get('identity_map')
+    if identities:
+        identities.sync(None)
+
+
+def _pending(identities):
+    # Ids learned in the current transaction only become visible to other requests once it commits
+    pending = db.session.info.get('pending_identities')
+    if pending is None:
+        pending = db.session.info['pending_identities'] = (identities, identities.version, {}, {})
+    return pending[2], pending[3]
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_identities(session):
+    pending = session.info.pop('pending_identities', None)
+    if pending:
+        identities, version, player_ids, team_ids = pending
+        identities.remember(version, player_ids, team_ids)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_identities(session, previous_transaction):
+    session.info.pop('pending_identities', None)
+
+
+def resolve_player_ids(names):
+    """Map player names to ids, creating the missing players with one bulk insert"""
+    identities = get_identity_map()
+    pending_players, _ = _pending(identities)
+
+    player_ids = {}
+    missing = set()
+    for name in {normalize_player_name(name) for name in names}:
+        player_id = pending_players.get(name) or identities.player_ids.get(name)
+        if player_id:
+            player_ids[name] = player_id
+        else:
+            missing.add(name)
+
+    for chunk in _chunks(missing):
+        # Like a .first() lookup, the oldest player wins when names are duplicated
+        player_ids.update(db.session.query(Player.name, Player.id).filter(
+            Player.name.in_(chunk)
+        ).order_by(Player.id.desc()))
+
+    new_names = sorted(name for name in missing if name not in player_ids)
+    if new_names:
+        db.session.execute(Player.__table__.insert(), [{'name': name} for name in new_names])
+        # Player pickers and counts are cached; the identity map only gains ids, so it keeps its version
+        bump_data_version(PLAYER_DATA)
+        for chunk in _chunks(new_names):
+            player_ids.update(db.session.query(Player.name, Player.id).filter(Player.name.in_(chunk)))
+
+    pending_players.update((name, player_ids[name]) for name in missing)
+    return player_ids
+
+
+def normalize_stored_names(batch_size=1000):
+    """Rewrite player names saved before names were normalized, so lookups by normalized name find them"""
+    last_id = 0
+    renamed = 0
+    while True:
+        rows = db.session.query(Player.id, Player.name).filter(Player.id > last_id).order_by(Player.id).limit(batch_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        updates = [{'id': player_id, 'name': normalize_player_name(name)}
+                   for player_id, name in rows if name != normalize_player_name(name)]
+        if updates:
+            db.session.execute(update(Player), updates)
+            renamed += len(updates)
+
+    if renamed:
+        invalidate_identities()
+    return renamed
+
+
+def _load_team_ids(keys):
+    """Look up team ids by (low, high) player pair"""
+    low, high = Team.pair_key()
+    team_ids = {}
+    for chunk in _chunks(keys, IN_CHUNK_SIZE // 2):
+        condition = or_(*[(low == player_low) & (high == player_high) for player_low, player_high in chunk])
+        for team_id, player_low, player_high in db.session.query(Team.id, low, high).filter(condition):
+            team_ids[(player_low, player_high)] = team_id
+    return team_ids
+
+
+def resolve_team_ids(pairs):
+    """Map (player1_id, player2_id) pairs to team ids by team_pair_key, creating the missing teams with one bulk insert"""
+    identities = get_identity_map()
+    _, pending_teams = _pending(identities)
+
+    team_ids = {}
+    missing = {}
+    for pair in pairs:
+        key = team_pair_key(*pair)
+        team_id = pending_teams.get(key) or identities.team_ids.get(key)
+        if team_id:
+            team_ids[key] = team_id
+        else:
+            missing.setdefault(key, pair)
+    team_ids.update(_load_team_ids(missing))
+
+    new_teams = [pair for key, pair in missing.items() if key not in team_ids]
+    if new_teams:
+        db.session.execute(Team.__table__.insert(), [
+            {'player1_id': player1_id, 'player2_id': player2_id} for player1_id, player2_id in new_teams
+        ])
+        team_ids.update(_load_team_ids([team_pair_key(*pair) for pair in new_teams]))
+
+    pending_teams.update((key, team_ids[key]) for key in missing)
+    return team_ids
+
+
+def resolve_teams(team_strings):
+    """Find or create the teams named by 'Player A, Player B' strings, returning the Team of each string"""
+    names = {team_names: split_team_names(team_names) for team_names in team_strings}
+    player_ids = resolve_player_ids(name for pair in names.values() for name in pair if name)
+    keys = {
+        team_names: team_pair_key(player_ids[name1], player_ids[name2] if name2 else None)
+        for team_names, (name1, name2) in names.items()
+    }
+    pairs = [(player_ids[name1], player_ids[name2] if name2 else None) for name1, name2 in names.values()]
+    team_ids = resolve_team_ids(pairs)
+
+    teams = {}
+    for chunk in _chunks(set(team_ids.values())):
+        teams.update((team.id, team) for team in Team.query.filter(Team.id.in_(chunk)))
+    return {team_names: teams[team_ids[key]] for team_names, key in keys.items()}
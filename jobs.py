@@ -0,0 +1,192 @@
+"""
+Import Jobs - Runs large results file imports on a background thread with their state kept in the database
+"""
+import csv
+import json
+import os
+import socket
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import or_
+from werkzeug.utils import secure_filename
+
+from models import db, ImportJob
+from csv_import import import_results
+
+# Number of problem rows kept on the job for display
+MAX_JOB_ERRORS = 20
+
+
+class ImportJobRunner:
+    """Single worker thread that imports queued files one at a time"""
+
+    def __init__(self, app, max_workers=1):
+        self.app = app
+        # Unique per process start, so a restarted process with a reused pid doesn't claim the old jobs
+        self.id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='import-job')
+        self.futures = {}
+        self.lock = Lock()
+
+    def submit(self, job_id):
+        """Queue a job to run on the worker thread"""
+        # Held while submitting, so a job finishing straight away can't pop its future before it is stored
+        with self.lock:
+            future = self.futures[job_id] = self.executor.submit(self._run, job_id)
+        return future
+
+    def wait(self, job_id, timeout=None):
+        """Block until a submitted job has finished"""
+        with self.lock:
+            future = self.futures.get(job_id)
+        if future:
+            future.result(timeout)
+
+    def beat(self):
+        """Mark every queued and running job of this runner as still alive"""
+        ImportJob.query.filter(
+            ImportJob.runner_id == self.id, ImportJob.status.in_(['queued', 'running'])
+        ).update({'heartbeat_at': datetime.utcnow()}, synchronize_session=False)
+
+    def _run(self, job_id):
+        with self.app.app_context():
+            try:
+                run_import_job(job_id)
+            finally:
+                with self.lock:
+                    self.futures.pop(job_id, None)
+
+
+def get_job_runner(app=None):
+    """Get the job runner of the application, starting it on first use"""
+    app = app or current_app._get_current_object()
+    if 'import_jobs' not in app.extensions:
+        app.extensions['import_jobs'] = ImportJobRunner(app)
+    return app.extensions['import_jobs']
+
+
+def upload_path(user_id, filename):
+    """Where a user's uploaded file is kept; the user id prefix stops anyone else from importing it"""
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], f"{user_id}_{secure_filename(filename)}")
+
+
+def fail_interrupted_jobs(job_ids=None):
+    """Fail the queued or running jobs whose runner stopped sending heartbeats (of the given ids only, if any)
+
+    Jobs of live runners in other worker processes keep a recent heartbeat and are left alone.
+    Returns how many jobs were failed.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config.get('IMPORT_JOB_STALE_SECONDS', 300))
+    query = ImportJob.query.filter(
+        ImportJob.status.in_(['queued', 'running']),
+        or_(ImportJob.heartbeat_at.is_(None), ImportJob.heartbeat_at < cutoff)
+    )
+    if job_ids is not None:
+        query = query.filter(ImportJob.id.in_(job_ids))
+    count = query.update({
+        'status': 'failed',
+        'message': "Interrupted by a restart of the application; start the import again",
+        'finished_at': datetime.utcnow()
+    }, synchronize_session=False)
+    db.session.commit()
+    return count
+
+
+def count_data_rows(filepath):
+    """Count the rows after the header of a CSV file without keeping them in memory"""
+    with open(filepath, 'r', newline='') as f:
+        return max(sum(1 for row in csv.reader(f)) - 1, 0)
+
+
+def start_import_job(filepath, user_id):
+    """Record an import job for an uploaded file and queue it, returning the job"""
+    runner = get_job_runner()
+    job = ImportJob(
+        user_id=user_id,
+        filename=os.path.basename(filepath),
+        rows_total=count_data_rows(filepath),
+        runner_id=runner.id,
+        heartbeat_at=datetime.utcnow()
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    runner.submit(job.id)
+    return job
+
+
+def _record_progress(job, importer):
+    job.rows_processed = min(importer.last_line - 1, job.rows_total)
+    job.match_count = importer.match_count
+    job.error_count = len(importer.errors)
+    job.errors = json.dumps(importer.errors[:MAX_JOB_ERRORS])
+
+
+def run_import_job(job_id):
+    """Import the file of a queued job, recording progress after each batch"""
+    job = db.session.get(ImportJob, job_id)
+    if not job:
+        return
+
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], job.filename)
+    if job.status != 'queued':
+        # Cancelled while waiting in the queue
+        if job.status == 'cancelled' and os.path.exists(filepath):
+            os.remove(filepath)
+        return
+
+    runner = get_job_runner()
+    job.status = 'running'
+    job.started_at = datetime.utcnow()
+    runner.beat()
+    db.session.commit()
+
+    def on_batch(importer):
+        # Pick up a cancel request made by another request since the last batch
+        db.session.refresh(job)
+        _record_progress(job, importer)
+        runner.beat()
+        db.session.commit()
+        return job.cancel_requested
+
+    try:
+        with open(filepath, 'r', newline='') as f:
+            importer = import_results(csv.reader(f), job.user_id, on_batch=on_batch)
+
+        _record_progress(job, importer)
+        if job.cancel_requested:
+            job.status = 'cancelled'
+            job.message = f"Cancelled after importing {importer.match_count} matches"
+        else:
+            job.status = 'done'
+            job.rows_processed = job.rows_total
+            job.message = f"Successfully imported {importer.match_count} matches in {len(importer.tournaments)} tournaments"
+        os.remove(filepath)
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(ImportJob, job_id)
+        job.status = 'failed'
+        job.message = f"Error with results: {str(e)}"
+
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def cancel_import_job(job):
+    """Ask a queued or running job to stop, returning False if it has already finished"""
+    if job.status == 'queued':
+        job.status = 'cancelled'
+        job.cancel_requested = True
+        job.finished_at = datetime.utcnow()
+        job.message = "Cancelled before starting"
+    elif job.status == 'running':
+        job.cancel_requested = True
+    else:
+        return False
+
+    db.session.commit()
+    return True
@@ -0,0 +1,88 @@
+"""
+Database Maintenance - Counts and deletes unused rows with set-based statements
+"""
+from flask import current_app
+from sqlalchemy import delete, exists, func, select
+
+from models import db, User, Tournament, Player, Team, Match, SharedTournament
+from identity_map import invalidate_identities
+from utils import bump_data_version
+from response_cache import TOURNAMENT_DATA
+
+
+def orphaned_teams():
+    """Teams that play in no match"""
+    return ~exists().where(Match.team1_id == Team.id) & ~exists().where(Match.team2_id == Team.id)
+
+
+def inactive_players():
+    """Players that belong to no team"""
+    return ~exists().where(Team.player1_id == Player.id) & ~exists().where(Team.player2_id == Player.id)
+
+
+def empty_tournaments():
+    """Tournaments without matches"""
+    return ~exists().where(Match.tournament_id == Tournament.id)
+
+
+def users_without_tournaments():
+    """Users who have not organised a tournament"""
+    return ~exists().where(Tournament.user_id == User.id)
+
+
+# Each cleanup: the table it deletes from and the condition picking the unused rows
+CLEANUPS = {
+    'orphaned_teams': (Team, orphaned_teams),
+    'inactive_players': (Player, inactive_players),
+    'empty_tournaments': (Tournament, empty_tournaments),
+}
+
+# Conditions counted on the maintenance page, including ones with no cleanup
+REPORTS = dict(CLEANUPS, users_without_tournaments=(User, users_without_tournaments))
+
+
+def maintenance_counts():
+    """Count the rows every report would pick, in one statement"""
+    counts = [
+        select(func.count(model.id)).where(condition()).scalar_subquery().label(name)
+        for name, (model, condition) in REPORTS.items()
+    ]
+    return dict(db.session.execute(select(*counts)).one()._mapping)
+
+
+def _delete_dependents(name, ids):
+    """Delete rows that refer to the chosen rows and are not removed by the database itself"""
+    if name == 'empty_tournaments':
+        db.session.execute(delete(SharedTournament).where(SharedTournament.tournament_id.in_(ids)))
+
+
+def _after_cleanup(name):
+    """Invalidate the caches that can hold the deleted rows"""
+    if name == 'empty_tournaments':
+        bump_data_version(TOURNAMENT_DATA)
+    else:
+        invalidate_identities()
+
+
+def run_cleanup(name, dry_run=False, chunk_size=None):
+    """Delete the rows a cleanup picks, one committed chunk at a time, returning how many were (or would be) deleted"""
+    model, condition = CLEANUPS[name]
+    if dry_run:
+        return db.session.execute(select(func.count(model.id)).where(condition())).scalar()
+
+    chunk_size = chunk_size or current_app.config.get('CLEANUP_CHUNK_SIZE', 500)
+    deleted = 0
+    while True:
+        ids = select(model.id).where(condition()).order_by(model.id).limit(chunk_size).scalar_subquery()
+        _delete_dependents(name, ids)
+        # The condition is checked again so rows that gained a reference meanwhile are kept
+        result = db.session.execute(
+            delete(model).where(model.id.in_(ids), condition()).execution_options(synchronize_session=False)
+        )
+        if result.rowcount:
+            _after_cleanup(name)
+        db.session.commit()
+
+        deleted += result.rowcount
+        if result.rowcount < chunk_size:
+            return deleted
@@ -0,0 +1,285 @@
+"""
+Metrics - Request, SQL, import and cache counters of this process in the Prometheus text format
+"""
+import hmac
+import time
+from bisect import bisect_left
+from threading import Lock
+
+from flask import Response, abort, current_app, g, has_app_context, request
+
+from profiling import request_query_count
+from utils import is_admin_session
+
+# Upper bounds of the request latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Upper bounds of the SQL statements per request buckets
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Caches kept in app.extensions whose hits and misses are exported
+CACHES = {'analytics': 'response_cache', 'rivalry': 'rivalry_cache'}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """A metric family with one child per set of label values"""
+
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = Lock()
+
+    def child(self, *values):
+        # Children are only created under the family lock, then updated under their own
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for values, child in sorted(self.children.items()):
+            lines.extend(self._sample_lines(values, child))
+        return lines
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0
+        self.lock = Lock()
+
+    def add(self, amount):
+        with self.lock:
+            self.value += amount
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+
+class Counter(_Metric):
+    """Total that only goes up"""
+
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, *values, amount=1):
+        self.child(*values).add(amount)
+
+    def _sample_lines(self, values, child):
+        return [f'{self.name}{_labels(self.label_names, values)} {_number(child.value)}']
+
+
+class Gauge(Counter):
+    """Value that goes up and down"""
+
+    kind = 'gauge'
+
+    def dec(self, *values, amount=1):
+        self.child(*values).add(-amount)
+
+    def set(self, value, *values):
+        self.child(*values).set(value)
+
+
+class _Buckets:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.lock = Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += value
+
+
+class Histogram(_Metric):
+    """Count of observations per bucket, with their sum"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value, *values):
+        self.child(*values).observe(value)
+
+    def _sample_lines(self, values, child):
+        with child.lock:
+            counts, total = list(child.counts), child.total
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = _labels(self.label_names, values, [('le', _number(bound))])
+            lines.append(f'{self.name}_bucket{le} {cumulative}')
+        labels = _labels(self.label_names, values)
+        lines.append(f'{self.name}_sum{labels} {_number(total)}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """The metrics of one application"""
+
+    def __init__(self):
+        request_labels = ('blueprint', 'endpoint', 'method')
+        self.request_seconds = Histogram(
+            'badminton_request_duration_seconds', 'Time spent answering requests', request_labels
+        )
+        self.requests = Counter(
+            'badminton_requests_total', 'Requests answered, by status code', request_labels + ('status',)
+        )
+        self.request_queries = Histogram(
+            'badminton_request_sql_statements', 'SQL statements issued per request', request_labels, QUERY_BUCKETS
+        )
+        self.in_flight = Gauge('badminton_requests_in_flight', 'Requests being answered')
+        self.queries = Counter(
+            'badminton_sql_statements_total', 'SQL statements issued by requests, by blueprint', ('blueprint',)
+        )
+        self.import_rows = Counter('badminton_import_rows_total', 'Result file rows read by the CSV import')
+        self.import_matches = Counter('badminton_import_matches_total', 'Matches created by the CSV import')
+        self.import_seconds = Counter('badminton_import_seconds_total', 'Time spent importing result files')
+        self.import_rate = Gauge('badminton_import_rows_per_second', 'Rows per second of the latest import')
+
+    def families(self):
+        return [
+            self.request_seconds, self.requests, self.request_queries, self.in_flight, self.queries,
+            self.import_rows, self.import_matches, self.import_seconds, self.import_rate
+        ]
+
+
+def get_metrics(app=None):
+    """Get the metrics registry of the application"""
+    app = app or current_app._get_current_object()
+    registry = app.extensions.get('metrics')
+    if registry is None:
+        registry = app.extensions.setdefault('metrics', MetricsRegistry())
+    return registry
+
+
+def record_import(rows, matches, seconds):
+    """Count the rows and matches of a finished import and the time it took"""
+    if not has_app_context():
+        return
+    registry = get_metrics()
+    registry.import_rows.inc(amount=rows)
+    registry.import_matches.inc(amount=matches)
+    registry.import_seconds.inc(amount=seconds)
+    if seconds > 0:
+        registry.import_rate.set(round(rows / seconds, 1))
+
+
+def _cache_lines(app):
+    """Hits, misses and hit ratio of the caches the application has created so far"""
+    caches = [(name, app.extensions[key]) for name, key in CACHES.items() if key in app.extensions]
+    samples = {
+        'badminton_cache_hits_total': ('counter', 'Cache lookups answered from the cache', 'hits'),
+        'badminton_cache_misses_total': ('counter', 'Cache lookups that had to compute the value', 'misses'),
+    }
+    lines = []
+    for name, (kind, description, attribute) in samples.items():
+        lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+        lines += [f'{name}{{cache="{cache_name}"}} {getattr(cache, attribute)}' for cache_name, cache in caches]
+
+    lines += ['# HELP badminton_cache_hit_ratio Share of cache lookups answered from the cache',
+              '# TYPE badminton_cache_hit_ratio gauge']
+    for cache_name, cache in caches:
+        lookups = cache.hits + cache.misses
+        lines.append(f'badminton_cache_hit_ratio{{cache="{cache_name}"}} {_number(cache.hits / lookups if lookups else 0.0)}')
+
+    if 'response_cache' in app.extensions:
+        flights = app.extensions['response_cache'].metrics()
+        lines += ['# HELP badminton_cache_coalesced_total Analytics computations shared with an identical one running',
+                  '# TYPE badminton_cache_coalesced_total counter',
+                  f'badminton_cache_coalesced_total {flights["coalesced"]}']
+    return lines
+
+
+def render_metrics(app=None):
+    """All metrics of the application in the Prometheus text exposition format"""
+    app = app or current_app._get_current_object()
+    lines = []
+    for family in get_metrics(app).families():
+        lines.extend(family.expose())
+    lines.extend(_cache_lines(app))
+    return '\n'.join(lines) + '\n'
+
+
+def _request_labels():
+    return (request.blueprint or 'none', request.endpoint or 'unmatched', request.method)
+
+
+def _start_request():
+    g.metrics_started = time.perf_counter()
+    get_metrics().in_flight.inc()
+
+
+def _finish_request(response):
+    started = g.get('metrics_started')
+    if started is not None:
+        labels = _request_labels()
+        registry = get_metrics()
+        registry.request_seconds.observe(time.perf_counter() - started, *labels)
+        queries = request_query_count()
+        registry.request_queries.observe(queries, *labels)
+        registry.queries.inc(labels[0], amount=queries)
+        registry.requests.inc(*labels, str(response.status_code))
+    return response
+
+
+def _end_request(error=None):
+    if g.pop('metrics_started', None) is not None:
+        get_metrics().in_flight.dec()
+
+
+def metrics_endpoint():
+    """Prometheus scrape endpoint, behind a bearer token when METRICS_TOKEN is set and for admins only otherwise"""
+    token = current_app.config.get('METRICS_TOKEN')
+    if token:
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied, f'Bearer {token}'):
+            abort(401)
+    elif not is_admin_session():
+        abort(404)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def init_metrics(app):
+    """Collect request metrics of the application and serve them at /metrics"""
+    get_metrics(app)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_end_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint)
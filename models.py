@@ -1,7 +1,110 @@
+import json
+import uuid
+from datetime import datetime
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
 
 db = SQLAlchemy()
 
+
+def parse_badminton_score(score_str):
+    """Parse badminton score format and return total points for each side"""
+    total_a = 0
+    total_b = 0
+
+    try:
+        # Split into sets (e.g., "21-19, 19-21, 21-15")
+        sets = score_str.split(', ')
+
+        for set_score in sets:
+            if '-' in set_score:
+                parts = set_score.split('-')
+                if len(parts) == 2:
+                    try:
+                        a = int(parts[0])
+                        b = int(parts[1])
+                        total_a += a
+                        total_b += b
+                    except ValueError:
+                        # Handle non-numeric scores
+                        pass
+    except Exception:
+        # Fallback for any parsing errors
+        pass
+
+    return total_a, total_b
+
+
+def count_set_wins(score1, score2):
+    """Count the sets won by each side from the two score strings"""
+    score1_sets = score1.split(', ')
+    score2_sets = score2.split(', ')
+
+    team1_wins = 0
+    team2_wins = 0
+
+    for i in range(min(len(score1_sets), len(score2_sets))):
+        try:
+            score1_points = int(score1_sets[i].split('-')[0])
+            score2_points = int(score2_sets[i].split('-')[0])
+            if score1_points > score2_points:
+                team1_wins += 1
+            else:
+                team2_wins += 1
+        except (ValueError, IndexError):
+            # If there's an error parsing scores, skip this set
+            continue
+
+    return team1_wins, team2_wins
+
+
+def parse_set_scores(score1, score2):
+    """Split a match score into (team1_points, team2_points) pairs, one per set"""
+    sets = []
+    for set_score in (score1 or "").split(', '):
+        parts = set_score.split('-')
+        try:
+            sets.append((int(parts[0]), int(parts[1])))
+        except (ValueError, IndexError):
+            continue
+
+    # Fall back to team 2's view of the score if team 1's could not be read
+    if not sets:
+        for set_score in (score2 or "").split(', '):
+            parts = set_score.split('-')
+            try:
+                sets.append((int(parts[1]), int(parts[0])))
+            except (ValueError, IndexError):
+                continue
+
+    return sets
+
+
+def summarize_scores(score1, score2):
+    """Derive the set winner, point totals and set count stored on a Match"""
+    score1 = score1 or ""
+    score2 = score2 or ""
+
+    team1_sets, team2_sets = count_set_wins(score1, score2)
+    t1_points, t2_points = parse_badminton_score(score1)
+    t2_alt_points, t1_alt_points = parse_badminton_score(score2)
+
+    # Safety override if scoring is flipped
+    if t1_points + t2_points < t1_alt_points + t2_alt_points:
+        t1_points, t2_points = t1_alt_points, t2_alt_points
+
+    sets = parse_set_scores(score1, score2)
+
+    return {
+        'team1_won': team1_sets > team2_sets,
+        'team1_points': t1_points,
+        'team2_points': t2_points,
+        'set_count': len(sets),
+        'sets': sets
+    }
+
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(150), nullable=False, unique=True)
@@ -27,26 +130,84 @@ class Tournament(db.Model):
     date = db.Column(db.Date, nullable=False)
     location = db.Column(db.String(200))
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # Changes whenever the tournament's matches do, so responses scoped to it get a new ETag
+    data_stamp = db.Column(db.String(32), nullable=False, default=lambda: uuid.uuid4().hex)
     matches = db.relationship('Match', backref='tournament', lazy=True, cascade="all, delete-orphan")
 
 
 class Player(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(150), nullable=False)
+    name = db.Column(db.String(150), nullable=False, index=True)
     # Players can be part of multiple teams
     teams_as_player1 = db.relationship('Team', foreign_keys='Team.player1_id', backref='player1', lazy=True)
     teams_as_player2 = db.relationship('Team', foreign_keys='Team.player2_id', backref='player2', lazy=True)
 
+    __table_args__ = (
+        # Case-insensitive prefix searches as a range scan
+        db.Index('ix_player_name_lower', db.func.lower(name)),
+    )
+
+
+def fts5_trigram_supported(connection):
+    """Whether the database is SQLite with FTS5 and its trigram tokenizer (SQLite 3.34+)"""
+    if connection.dialect.name != 'sqlite':
+        return False
+    version = tuple(int(part) for part in connection.exec_driver_sql("SELECT sqlite_version()").scalar().split('.'))
+    options = {row[0] for row in connection.exec_driver_sql("PRAGMA compile_options")}
+    return version >= (3, 34) and 'ENABLE_FTS5' in options
+
+
+# Trigram full-text index over player names, kept in step with the player table by triggers
+PLAYER_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS player_search "
+    "USING fts5(name, content='player', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS player_search_insert AFTER INSERT ON player BEGIN "
+    "INSERT INTO player_search(rowid, name) VALUES (new.id, new.name); END",
+    "CREATE TRIGGER IF NOT EXISTS player_search_delete AFTER DELETE ON player BEGIN "
+    "INSERT INTO player_search(player_search, rowid, name) VALUES ('delete', old.id, old.name); END",
+    "CREATE TRIGGER IF NOT EXISTS player_search_update AFTER UPDATE OF name ON player BEGIN "
+    "INSERT INTO player_search(player_search, rowid, name) VALUES ('delete', old.id, old.name); "
+    "INSERT INTO player_search(rowid, name) VALUES (new.id, new.name); END",
+    "INSERT INTO player_search(player_search) VALUES ('rebuild')",
+)
+
+for statement in PLAYER_SEARCH_DDL:
+    event.listen(Player.__table__, 'after_create', DDL(statement).execute_if(
+        callable_=lambda ddl, target, bind, **kw: fts5_trigram_supported(bind)
+    ))
+event.listen(Player.__table__, 'before_drop', DDL("DROP TABLE IF EXISTS player_search").execute_if(dialect='sqlite'))
+
+
+def team_pair_key(player1_id, player2_id):
+    """Order-independent key of a team's players, with 0 standing in for a singles team's missing partner"""
+    return (min(player1_id, player2_id or 0), max(player1_id, player2_id or 0))
+
 
 class Team(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    player1_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
-    player2_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=True)  # Nullable for singles matches
+    player1_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False, index=True)
+    player2_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=True, index=True)  # Nullable for singles matches
     # Teams can participate in multiple matches
     matches_as_team1 = db.relationship('Match', foreign_keys='Match.team1_id', backref='team1', lazy=True)
     matches_as_team2 = db.relationship('Match', foreign_keys='Match.team2_id', backref='team2', lazy=True)
 
+    # A pair of players forms at most one team, whichever way round they were entered
+    __table_args__ = (
+        db.Index(
+            'uq_team_player_pair',
+            db.func.min(player1_id, db.func.coalesce(player2_id, db.literal_column('0'))),
+            db.func.max(player1_id, db.func.coalesce(player2_id, db.literal_column('0'))),
+            unique=True
+        ),
+    )
+
+    @classmethod
+    def pair_key(cls):
+        """SQL version of team_pair_key, written to match the unique team index"""
+        partner = db.func.coalesce(cls.player2_id, db.literal_column('0'))
+        return (db.func.min(cls.player1_id, partner), db.func.max(cls.player1_id, partner))
+
 
 class Match(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -59,32 +220,71 @@ class Match(db.Model):
     score2 = db.Column(db.String(100), nullable=False)  # e.g., "19-21, 21-19, 18-21"
     match_type = db.Column(db.String(50), nullable=False)  # e.g., "Men's Singles"
     timestamp = db.Column(db.DateTime, default=db.func.current_timestamp())
+    # Structured score data derived from score1/score2 whenever the match is written
+    winner_team_id = db.Column(db.Integer, db.ForeignKey('team.id'), index=True)
+    team1_points = db.Column(db.Integer, nullable=False, default=0)
+    team2_points = db.Column(db.Integer, nullable=False, default=0)
+    total_points = db.Column(db.Integer, nullable=False, default=0)
+    set_count = db.Column(db.Integer, nullable=False, default=0)
+    sets = db.relationship('MatchSet', backref='match', lazy=True, cascade="all, delete-orphan",
+                           order_by='MatchSet.set_number')
+
+    __table_args__ = (
+        db.Index('ix_match_tournament_set_count', 'tournament_id', 'set_count'),
+        db.Index('ix_match_tournament_total_points', 'tournament_id', 'total_points'),
+        db.Index('ix_match_tournament_timestamp', 'tournament_id', 'timestamp'),
+        # Either side of a match, with the opponent second for head-to-head lookups
+        db.Index('ix_match_team1_team2', 'team1_id', 'team2_id'),
+        db.Index('ix_match_team2_team1', 'team2_id', 'team1_id'),
+        db.Index('ix_match_timestamp', 'timestamp'),
+        db.Index('ix_match_match_type', 'match_type'),
+    )
+
+    def update_score_columns(self):
+        """Store the per-set points, winner and point totals parsed from the score strings"""
+        summary = summarize_scores(self.score1, self.score2)
+
+        self.winner_team_id = self.team1_id if summary['team1_won'] else self.team2_id
+        self.team1_points = summary['team1_points']
+        self.team2_points = summary['team2_points']
+        self.total_points = summary['team1_points'] + summary['team2_points']
+        self.set_count = summary['set_count']
+
+        # Reuse the existing set rows so an edit never clashes with the unique set number
+        sets = list(self.sets)
+        for number, (team1_points, team2_points) in enumerate(summary['sets'], start=1):
+            if number <= len(sets):
+                sets[number - 1].team1_points = team1_points
+                sets[number - 1].team2_points = team2_points
+            else:
+                sets.append(MatchSet(set_number=number, team1_points=team1_points, team2_points=team2_points))
+        self.sets = sets[:len(summary['sets'])]
 
     def get_winner(self):
         """Determine the winner of the match based on scores"""
-        score1_sets = self.score1.split(', ')
-        score2_sets = self.score2.split(', ')
+        if self.winner_team_id is not None:
+            return self.team1 if self.winner_team_id == self.team1_id else self.team2
 
-        team1_wins = 0
-        team2_wins = 0
-
-        for i in range(min(len(score1_sets), len(score2_sets))):
-            try:
-                score1_points = int(score1_sets[i].split('-')[0])
-                score2_points = int(score2_sets[i].split('-')[0])
-                if score1_points > score2_points:
-                    team1_wins += 1
-                else:
-                    team2_wins += 1
-            except (ValueError, IndexError):
-                # If there's an error parsing scores, skip this set
-                continue
+        team1_wins, team2_wins = count_set_wins(self.score1, self.score2)
 
         if team1_wins > team2_wins:
             return self.team1
         else:
             return self.team2
 
+
+class MatchSet(db.Model):
+    """Points scored by each side in one set of a match"""
+    id = db.Column(db.Integer, primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), nullable=False)
+    set_number = db.Column(db.Integer, nullable=False)
+    team1_points = db.Column(db.Integer, nullable=False)
+    team2_points = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('match_id', 'set_number', name='unique_match_set'),
+    )
+
 class SharedTournament(db.Model):
     """Model for tournament sharing between users"""
     id = db.Column(db.Integer, primary_key=True)
@@ -101,4 +301,130 @@ class SharedTournament(db.Model):
     # Ensure a tournament is only shared once between same users
     __table_args__ = (
         db.UniqueConstraint('tournament_id', 'owner_id', 'shared_with_id', name='unique_tournament_sharing'),
-    )
\ No newline at end of file
+        db.Index('ix_shared_tournament_shared_with', 'shared_with_id', 'tournament_id'),
+    )
+
+
+class PlayerStats(db.Model):
+    """Aggregated results for a player within one tournament and match type"""
+    id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
+    tournament_id = db.Column(db.Integer, db.ForeignKey('tournament.id'), nullable=False)
+    match_type = db.Column(db.String(50), nullable=False)
+    matches = db.Column(db.Integer, nullable=False, default=0)
+    wins = db.Column(db.Integer, nullable=False, default=0)
+    losses = db.Column(db.Integer, nullable=False, default=0)
+    points_scored = db.Column(db.Integer, nullable=False, default=0)
+    points_conceded = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('player_id', 'tournament_id', 'match_type', name='unique_player_stats'),
+        db.Index('ix_player_stats_tournament', 'tournament_id'),
+    )
+
+
+class RivalryStats(db.Model):
+    """Aggregated results of a player against one opponent within one tournament"""
+    id = db.Column(db.Integer, primary_key=True)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
+    opponent_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
+    tournament_id = db.Column(db.Integer, db.ForeignKey('tournament.id'), nullable=False)
+    matches = db.Column(db.Integer, nullable=False, default=0)
+    wins = db.Column(db.Integer, nullable=False, default=0)
+    losses = db.Column(db.Integer, nullable=False, default=0)
+    points_scored = db.Column(db.Integer, nullable=False, default=0)
+    points_conceded = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('player_id', 'opponent_id', 'tournament_id', name='unique_rivalry_stats'),
+        db.Index('ix_rivalry_stats_opponent', 'opponent_id'),
+        db.Index('ix_rivalry_stats_tournament', 'tournament_id'),
+    )
+
+
+class PlayerRating(db.Model):
+    """Current Elo rating of a player over every match they have played"""
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), primary_key=True)
+    rating = db.Column(db.Float, nullable=False)
+    matches = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_player_rating_rating', 'rating'),
+    )
+
+
+class TeamRating(db.Model):
+    """Current Elo rating of a doubles pair over every match it has played together"""
+    team_id = db.Column(db.Integer, db.ForeignKey('team.id'), primary_key=True)
+    rating = db.Column(db.Float, nullable=False)
+    matches = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_team_rating_rating', 'rating'),
+    )
+
+
+class RatingHistory(db.Model):
+    """Rating of a player or doubles pair after one match; ids follow the order the matches were played in"""
+    id = db.Column(db.Integer, primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), nullable=False)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'))
+    team_id = db.Column(db.Integer, db.ForeignKey('team.id'))
+    rating = db.Column(db.Float, nullable=False)
+    change = db.Column(db.Float, nullable=False)
+    matches = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_rating_history_match', 'match_id'),
+        db.Index('ix_rating_history_player', 'player_id', 'id'),
+        db.Index('ix_rating_history_team', 'team_id', 'id'),
+    )
+
+
+class DataVersion(db.Model):
+    """Version stamp that changes whenever the named data set is written"""
+    name = db.Column(db.String(50), primary_key=True)
+    stamp = db.Column(db.String(32), nullable=False)
+
+
+class ImportJob(db.Model):
+    """State of a results file import running in the background"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed, cancelled
+    rows_total = db.Column(db.Integer, nullable=False, default=0)
+    rows_processed = db.Column(db.Integer, nullable=False, default=0)
+    match_count = db.Column(db.Integer, nullable=False, default=0)
+    error_count = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Text)  # JSON list of the first [line, message] pairs
+    message = db.Column(db.String(500))
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    # Process that queued the job, which keeps heartbeat_at current while the job is queued or running
+    runner_id = db.Column(db.String(100))
+    heartbeat_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        """Progress details for the job status API"""
+        eta_seconds = None
+        if self.status == 'running' and self.started_at and self.rows_processed:
+            elapsed = (datetime.utcnow() - self.started_at).total_seconds()
+            remaining = max(self.rows_total - self.rows_processed, 0)
+            eta_seconds = round(elapsed / self.rows_processed * remaining, 1)
+
+        return {
+            'id': self.id,
+            'filename': self.filename,
+            'status': self.status,
+            'rows_total': self.rows_total,
+            'rows_processed': self.rows_processed,
+            'percent': round(self.rows_processed / self.rows_total * 100, 1) if self.rows_total else 0,
+            'match_count': self.match_count,
+            'error_count': self.error_count,
+            'errors': json.loads(self.errors) if self.errors else [],
+            'message': self.message,
+            'eta_seconds': eta_seconds
+        }
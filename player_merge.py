@@ -0,0 +1,252 @@
+"""
+Player Merge - Finds clusters of likely duplicate players and merges them with set-based updates
+"""
+import re
+from collections import defaultdict
+
+from sqlalchemy import case, func, or_, select, tuple_, update
+
+from models import db, Player, Team, Match, PlayerStats, RivalryStats, team_pair_key
+from player_search import name_similarity
+from player_stats import rebuild_player_stats, rebuild_rivalry_stats
+from identity_map import invalidate_identities
+from ratings import unrate_matches
+from utils import bump_data_version
+
+# Keep IN lists well below SQLite's bound parameter limit
+IN_CHUNK_SIZE = 400
+
+# Names at least this similar are proposed as duplicates
+DEFAULT_MIN_SCORE = 0.6
+
+# Blocks larger than this only compare each name with its neighbours in sorted order
+MAX_BLOCK_SIZE = 100
+BLOCK_WINDOW = 20
+
+
+def _chunks(values, size=IN_CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def name_tokens(name):
+    """Lowercase letter and digit runs of a name, ignoring punctuation"""
+    return re.findall(r'[^\W_]+', name.casefold())
+
+
+def blocking_keys(name):
+    """Keys of the blocks a name is compared within: the first three letters of each of its words"""
+    tokens = [token for token in name_tokens(name) if len(token) > 1]
+    return {token[:3] for token in tokens} or {name.casefold()}
+
+
+def _block_pairs(player_ids, names):
+    """Yield the pairs of players to compare inside one block"""
+    if len(player_ids) <= MAX_BLOCK_SIZE:
+        for i, player_id in enumerate(player_ids):
+            for other_id in player_ids[i + 1:]:
+                yield player_id, other_id
+        return
+
+    # Sorted neighbourhood: very common word starts only compare names that sort close together
+    ordered = sorted(player_ids, key=lambda player_id: names[player_id].casefold())
+    for i, player_id in enumerate(ordered):
+        for other_id in ordered[i + 1:i + 1 + BLOCK_WINDOW]:
+            yield player_id, other_id
+
+
+def duplicate_score(name1, name2):
+    """Similarity of two names, treating names that differ only in case, spacing or punctuation as equal"""
+    if name_tokens(name1) == name_tokens(name2):
+        return 1.0
+    return name_similarity(name1, name2)
+
+
+def played_together(player_ids):
+    """Pairs of the given players that have been partners or opponents, and so cannot be the same person"""
+    pairs = set()
+    for chunk in _chunks(set(player_ids)):
+        pairs.update(db.session.query(RivalryStats.player_id, RivalryStats.opponent_id).filter(
+            RivalryStats.player_id.in_(chunk)
+        ).distinct())
+        pairs.update(db.session.query(Team.player1_id, Team.player2_id).filter(
+            Team.player2_id.isnot(None), Team.player1_id.in_(chunk) | Team.player2_id.in_(chunk)
+        ))
+    return {(min(pair), max(pair)) for pair in pairs}
+
+
+def _match_counts(player_ids):
+    counts = {}
+    for chunk in _chunks(player_ids):
+        counts.update(db.session.query(PlayerStats.player_id, func.sum(PlayerStats.matches)).filter(
+            PlayerStats.player_id.in_(chunk)
+        ).group_by(PlayerStats.player_id))
+    return counts
+
+
+def find_duplicate_clusters(min_score=DEFAULT_MIN_SCORE):
+    """Group likely duplicate players, each cluster naming the player to keep and the ones to merge into it"""
+    names = dict(db.session.query(Player.id, Player.name))
+
+    blocks = defaultdict(list)
+    for player_id, name in names.items():
+        for key in blocking_keys(name):
+            blocks[key].append(player_id)
+
+    edges = {}
+    compared = set()
+    for player_ids in blocks.values():
+        for pair in _block_pairs(player_ids, names):
+            pair = (min(pair), max(pair))
+            if pair in compared:
+                continue
+            compared.add(pair)
+            score = duplicate_score(names[pair[0]], names[pair[1]])
+            if score >= min_score:
+                edges[pair] = score
+
+    candidates = {player_id for pair in edges for player_id in pair}
+    separated = played_together(candidates)
+
+    # Join the most similar pairs first, never putting two players who met in one cluster
+    parent = {player_id: player_id for player_id in candidates}
+    members = {player_id: {player_id} for player_id in candidates}
+
+    def root(player_id):
+        while parent[player_id] != player_id:
+            parent[player_id] = parent[parent[player_id]]
+            player_id = parent[player_id]
+        return player_id
+
+    for (player1_id, player2_id), score in sorted(edges.items(), key=lambda edge: (-edge[1], edge[0])):
+        root1, root2 = root(player1_id), root(player2_id)
+        if root1 == root2:
+            continue
+        if any((min(a, b), max(a, b)) in separated for a in members[root1] for b in members[root2]):
+            continue
+        parent[root2] = root1
+        members[root1] |= members.pop(root2)
+
+    groups = [group for group in members.values() if len(group) > 1]
+    counts = _match_counts({player_id for group in groups for player_id in group})
+
+    clusters = []
+    for group in groups:
+        # Keep the player with the most matches, or the oldest record on a tie
+        keep_id = max(group, key=lambda player_id: (counts.get(player_id) or 0, -player_id))
+        duplicates = [{
+            'id': player_id,
+            'name': names[player_id],
+            'matches': counts.get(player_id) or 0,
+            'score': round(duplicate_score(names[keep_id], names[player_id]), 2)
+        } for player_id in group if player_id != keep_id]
+        duplicates.sort(key=lambda duplicate: (-duplicate['score'], duplicate['name']))
+        clusters.append({
+            'keep': {'id': keep_id, 'name': names[keep_id], 'matches': counts.get(keep_id) or 0},
+            'duplicates': duplicates
+        })
+
+    clusters.sort(key=lambda cluster: (-len(cluster['duplicates']), cluster['keep']['name']))
+    return clusters
+
+
+def _repoint_matches(folded):
+    """Point every match at the surviving team of each folded team"""
+    for column in (Match.team1_id, Match.team2_id, Match.winner_team_id):
+        for chunk in _chunks(folded):
+            db.session.execute(
+                update(Match).where(column.in_(chunk))
+                .values({column.key: case({team_id: folded[team_id] for team_id in chunk}, value=column)})
+                .execution_options(synchronize_session=False)
+            )
+
+
+def rewrite_teams(merged_into):
+    """Swap merged players for the kept ones in every team, folding teams that become duplicates; returns the number folded"""
+    teams = {}
+    for chunk in _chunks(merged_into):
+        for team_id, player1_id, player2_id in db.session.query(Team.id, Team.player1_id, Team.player2_id).filter(
+            Team.player1_id.in_(chunk) | Team.player2_id.in_(chunk)
+        ):
+            teams[team_id] = (
+                merged_into.get(player1_id, player1_id),
+                merged_into.get(player2_id, player2_id) if player2_id else None
+            )
+
+    # The oldest team with each resulting pair of players survives, whether it was rewritten or not
+    survivors = {}
+    for team_id, pair in teams.items():
+        key = team_pair_key(*pair)
+        survivors[key] = min(survivors.get(key, team_id), team_id)
+    existing = {}
+    low, high = Team.pair_key()
+    for chunk in _chunks(survivors):
+        for team_id, player_low, player_high in db.session.query(Team.id, low, high).filter(tuple_(low, high).in_(chunk)):
+            existing[team_id] = (player_low, player_high)
+            survivors[(player_low, player_high)] = min(survivors[(player_low, player_high)], team_id)
+
+    keys = dict(existing)
+    keys.update((team_id, team_pair_key(*pair)) for team_id, pair in teams.items())
+    folded = {team_id: survivors[key] for team_id, key in keys.items() if survivors[key] != team_id}
+    if folded:
+        _repoint_matches(folded)
+        for chunk in _chunks(folded):
+            Team.query.filter(Team.id.in_(chunk)).delete(synchronize_session=False)
+
+    # Only now are the pairs free under the unique team index
+    updates = [{'id': team_id, 'player1_id': pair[0], 'player2_id': pair[1]}
+               for team_id, pair in teams.items() if team_id not in folded]
+    if updates:
+        db.session.execute(update(Team), updates)
+
+    return len(folded)
+
+
+def merge_players(merges):
+    """Merge each list of duplicate ids into the player id it is keyed by, all in the current transaction"""
+    merged_into = {}
+    for keep_id, duplicate_ids in merges.items():
+        for duplicate_id in duplicate_ids:
+            if duplicate_id != keep_id:
+                merged_into[duplicate_id] = keep_id
+    if not merged_into:
+        return {'players': 0, 'teams': 0}
+
+    kept = set(merged_into.values())
+    if kept & set(merged_into):
+        raise ValueError("A player cannot be kept and merged away at the same time")
+
+    player_ids = kept | set(merged_into)
+    names = {}
+    for chunk in _chunks(player_ids):
+        names.update(db.session.query(Player.id, Player.name).filter(Player.id.in_(chunk)))
+    missing = player_ids - set(names)
+    if missing:
+        raise ValueError(f"Player {min(missing)} does not exist")
+
+    # Partners and opponents are different people; merging them would leave a player facing themselves
+    group_of = {keep_id: keep_id for keep_id in kept}
+    group_of.update(merged_into)
+    for player1_id, player2_id in played_together(player_ids):
+        if player1_id in group_of and group_of[player1_id] == group_of.get(player2_id):
+            raise ValueError(f"{names[player1_id]} and {names[player2_id]} have played with or against each other")
+
+    db.session.flush()
+
+    # Ratings are replayed from the earliest match of any merged player, with the merged teams and players
+    for chunk in _chunks(player_ids):
+        team_ids = select(Team.id).where(or_(Team.player1_id.in_(chunk), Team.player2_id.in_(chunk)))
+        unrate_matches(select(Match.id).where(or_(Match.team1_id.in_(team_ids), Match.team2_id.in_(team_ids))))
+    teams_folded = rewrite_teams(merged_into)
+
+    # Recompute statistics now that the merged players' matches belong to the kept ones
+    for chunk in _chunks(player_ids):
+        rebuild_player_stats(chunk)
+        rebuild_rivalry_stats(chunk)
+    for chunk in _chunks(merged_into):
+        Player.query.filter(Player.id.in_(chunk)).delete(synchronize_session=False)
+
+    bump_data_version()
+    invalidate_identities()
+    return {'players': len(merged_into), 'teams': teams_folded}
@@ -0,0 +1,108 @@
+"""
+Player Search - Typeahead, substring and fuzzy name lookups backed by the player_search trigram index
+"""
+import string
+
+from flask import current_app
+from sqlalchemy import func, select, text
+
+from models import db, Player
+
+# The trigram tokenizer cannot match fewer than three characters
+MIN_TRIGRAM_LENGTH = 3
+
+# How many index candidates the duplicate finder scores in Python
+SIMILAR_CANDIDATES = 50
+
+# SQLite's lower() only folds ASCII letters, so prefixes are folded the same way
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def search_index_available():
+    """Whether the player_search index exists, checked once per application"""
+    available = current_app.extensions.get('player_search_index')
+    if available is None:
+        available = db.session.execute(text(
+            "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'player_search'"
+        )).scalar() > 0 if db.engine.dialect.name == 'sqlite' else False
+        current_app.extensions['player_search_index'] = available
+    return available
+
+
+def _quote(term):
+    """Quote a term as an FTS5 string so punctuation in names is matched literally"""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def trigrams(name):
+    """Set of lowercase three-character substrings of a name, padded so short names still have some"""
+    padded = '  ' + ' '.join(name.lower().split()) + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def name_similarity(name1, name2):
+    """Jaccard similarity of the trigram sets of two names, between 0 and 1"""
+    grams1, grams2 = trigrams(name1), trigrams(name2)
+    if not grams1 or not grams2:
+        return 0.0
+    return len(grams1 & grams2) / len(grams1 | grams2)
+
+
+def matching_player_ids(term):
+    """Select the ids of players whose name contains the term, for use as an IN subquery"""
+    term = ' '.join(term.split())
+    if len(term) >= MIN_TRIGRAM_LENGTH and search_index_available():
+        return select(text('rowid')).select_from(text('player_search')).where(
+            text('player_search MATCH :term').bindparams(term=_quote(term))
+        )
+    return select(Player.id).where(Player.name.contains(term, autoescape=True))
+
+
+def typeahead(prefix, limit=10):
+    """Players whose name starts with or contains the prefix, names starting with it first"""
+    prefix = ' '.join(prefix.split())
+    if not prefix:
+        return []
+
+    if len(prefix) < MIN_TRIGRAM_LENGTH or not search_index_available():
+        # Short prefixes use the lower(name) index as a range scan
+        folded = prefix.translate(_ASCII_LOWER)
+        rows = db.session.query(Player.id, Player.name).filter(
+            func.lower(Player.name) >= folded, func.lower(Player.name) < folded + '\uffff'
+        ).order_by(Player.name).limit(limit).all()
+    else:
+        starts_with = Player.name.istartswith(prefix, autoescape=True)
+        rows = db.session.query(Player.id, Player.name).filter(
+            Player.id.in_(matching_player_ids(prefix))
+        ).order_by(starts_with.desc(), Player.name).limit(limit).all()
+
+    return [{'id': player_id, 'name': name} for player_id, name in rows]
+
+
+def similar_players(name, exclude_id=None, limit=10, min_score=0.3):
+    """Players whose names look like the given one, most similar first, each with its similarity score"""
+    grams = sorted(gram for gram in trigrams(name) if gram.strip() and len(gram.strip()) == 3)
+
+    if grams and search_index_available():
+        # Any shared trigram makes a candidate; bm25 puts those sharing the most first
+        candidates = db.session.execute(text(
+            "SELECT player.id, player.name FROM player_search "
+            "JOIN player ON player.id = player_search.rowid "
+            "WHERE player_search MATCH :query ORDER BY bm25(player_search) LIMIT :candidates"
+        ), {'query': ' OR '.join(_quote(gram) for gram in grams), 'candidates': SIMILAR_CANDIDATES}).all()
+    else:
+        first_name = name.split()[0] if name.split() else name
+        candidates = db.session.query(Player.id, Player.name).filter(
+            Player.name.contains(first_name, autoescape=True)
+        ).limit(SIMILAR_CANDIDATES).all()
+
+    ranked = []
+    for player_id, candidate_name in candidates:
+        if player_id == exclude_id:
+            continue
+        score = name_similarity(name, candidate_name)
+        if score >= min_score:
+            ranked.append({'id': player_id, 'name': candidate_name, 'score': round(score, 2)})
+
+    ranked.sort(key=lambda player: (-player['score'], player['name']))
+    return ranked[:limit]
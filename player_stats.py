@@ -0,0 +1,257 @@
+"""
+Player Statistics Store - Keeps the PlayerStats and RivalryStats aggregate tables in step with the match table
+"""
+from sqlalchemy import update, tuple_
+
+from models import db, Match, Team, PlayerStats, RivalryStats
+from head_to_head import forget_rivals
+
+# Order of the counters held for each aggregate key
+STAT_FIELDS = ('matches', 'wins', 'losses', 'points_scored', 'points_conceded')
+
+# Columns making up the key of each aggregate table
+PLAYER_STATS_KEY = ('player_id', 'tournament_id', 'match_type')
+RIVALRY_STATS_KEY = ('player_id', 'opponent_id', 'tournament_id')
+
+
+def team_player_ids(player1_id, player2_id):
+    """List the player ids making up a team"""
+    return [player1_id] + ([player2_id] if player2_id else [])
+
+
+def _add_result(deltas, key, won, scored, conceded, sign):
+    current = deltas.setdefault(key, [0, 0, 0, 0, 0])
+    current[0] += sign
+    current[1] += sign if won else 0
+    current[2] += 0 if won else sign
+    current[3] += sign * scored
+    current[4] += sign * conceded
+
+
+def add_match_deltas(deltas, tournament_id, match_type, team1_players, team2_players,
+                     team1_won, t1_points, t2_points, sign=1, only_players=None):
+    """Accumulate the stat changes caused by one match into a deltas dictionary"""
+    sides = (
+        (team1_players, team1_won, t1_points, t2_points),
+        (team2_players, not team1_won, t2_points, t1_points),
+    )
+    for players, won, scored, conceded in sides:
+        for player_id in players:
+            if only_players is not None and player_id not in only_players:
+                continue
+            _add_result(deltas, (player_id, tournament_id, match_type), won, scored, conceded, sign)
+
+    return deltas
+
+
+def add_rivalry_deltas(deltas, tournament_id, team1_players, team2_players,
+                       team1_won, t1_points, t2_points, sign=1, only_players=None):
+    """Accumulate the changes one match makes to every player-versus-opponent pair in it"""
+    sides = (
+        (team1_players, team2_players, team1_won, t1_points, t2_points),
+        (team2_players, team1_players, not team1_won, t2_points, t1_points),
+    )
+    for players, opponents, won, scored, conceded in sides:
+        for player_id in players:
+            for opponent_id in opponents:
+                if only_players is not None and player_id not in only_players and opponent_id not in only_players:
+                    continue
+                _add_result(deltas, (player_id, opponent_id, tournament_id), won, scored, conceded, sign)
+
+    return deltas
+
+
+def _match_deltas(match, sign):
+    """Build the player and rivalry stat changes for a single Match object"""
+    deltas, rivalry_deltas = {}, {}
+    team1 = db.session.get(Team, match.team1_id)
+    team2 = db.session.get(Team, match.team2_id)
+    if not team1 or not team2:
+        return deltas, rivalry_deltas  # Skip malformed matches
+
+    team1_players = team_player_ids(team1.player1_id, team1.player2_id)
+    team2_players = team_player_ids(team2.player1_id, team2.player2_id)
+    team1_won = match.winner_team_id == match.team1_id
+    add_match_deltas(deltas, match.tournament_id, match.match_type, team1_players, team2_players,
+                     team1_won, match.team1_points, match.team2_points, sign=sign)
+    add_rivalry_deltas(rivalry_deltas, match.tournament_id, team1_players, team2_players,
+                       team1_won, match.team1_points, match.team2_points, sign=sign)
+    return deltas, rivalry_deltas
+
+
+def _merge_rows(model, key_fields, deltas):
+    """Apply accumulated deltas to an aggregate table keyed by key_fields"""
+    if not deltas:
+        return
+
+    key_columns = tuple(getattr(model, field) for field in key_fields)
+    columns = (model.id,) + key_columns + tuple(getattr(model, field) for field in STAT_FIELDS)
+    key_size = len(key_fields)
+    prefixes = list({key[:2] for key in deltas})
+    rows = {}
+    for start in range(0, len(prefixes), 400):
+        query = db.session.query(*columns).filter(tuple_(*key_columns[:2]).in_(prefixes[start:start + 400]))
+        for row in query:
+            rows[tuple(row[1:key_size + 1])] = (row[0], row[key_size + 1:])
+
+    new_rows = []
+    updates = []
+    deleted_ids = []
+    for key, values in deltas.items():
+        if key not in rows:
+            if values[0] > 0:
+                new_rows.append(dict(zip(key_fields, key), **dict(zip(STAT_FIELDS, values))))
+            continue
+
+        row_id, current = rows[key]
+        totals = [stored + delta for stored, delta in zip(current, values)]
+        # Drop rows that no longer describe any match
+        if totals[0] <= 0:
+            deleted_ids.append(row_id)
+        else:
+            updates.append(dict(zip(STAT_FIELDS, totals), id=row_id))
+
+    # Each kind of change goes to the database as one statement rather than one per row
+    if new_rows:
+        db.session.execute(model.__table__.insert(), new_rows)
+    if updates:
+        db.session.execute(update(model), updates)
+    if deleted_ids:
+        model.query.filter(model.id.in_(deleted_ids)).delete(synchronize_session=False)
+
+
+def merge_deltas(deltas):
+    """Apply accumulated deltas to the PlayerStats table"""
+    _merge_rows(PlayerStats, PLAYER_STATS_KEY, deltas)
+
+
+def merge_rivalry_deltas(deltas):
+    """Apply accumulated deltas to the RivalryStats table"""
+    _merge_rows(RivalryStats, RIVALRY_STATS_KEY, deltas)
+    forget_rivals({key[0] for key in deltas})
+
+
+def apply_match(match):
+    """Add a newly written match to the aggregates"""
+    deltas, rivalry_deltas = _match_deltas(match, 1)
+    merge_deltas(deltas)
+    merge_rivalry_deltas(rivalry_deltas)
+
+
+def revert_match(match):
+    """Remove a match's current values from the aggregates"""
+    deltas, rivalry_deltas = _match_deltas(match, -1)
+    merge_deltas(deltas)
+    merge_rivalry_deltas(rivalry_deltas)
+
+
+def _match_rows(only_players):
+    """Yield the tournament, type, player lists and result of every match, optionally only those of some players"""
+    teams = {
+        team_id: team_player_ids(player1_id, player2_id)
+        for team_id, player1_id, player2_id in db.session.query(Team.id, Team.player1_id, Team.player2_id)
+    }
+
+    query = db.session.query(
+        Match.tournament_id, Match.match_type, Match.team1_id, Match.team2_id,
+        Match.winner_team_id, Match.team1_points, Match.team2_points
+    )
+
+    if only_players is not None:
+        team_ids = [team_id for team_id, players in teams.items() if only_players.intersection(players)]
+        query = query.filter(Match.team1_id.in_(team_ids) | Match.team2_id.in_(team_ids))
+
+    for tournament_id, match_type, team1_id, team2_id, winner_id, t1_points, t2_points in query.yield_per(1000):
+        if team1_id not in teams or team2_id not in teams:
+            continue  # Skip malformed matches
+        yield tournament_id, match_type, teams[team1_id], teams[team2_id], winner_id == team1_id, t1_points, t2_points
+
+
+def compute_stats_rows(player_ids=None):
+    """Recompute the aggregate rows from the match table in memory"""
+    only_players = set(player_ids) if player_ids is not None else None
+    deltas = {}
+    for tournament_id, match_type, team1_players, team2_players, team1_won, t1_points, t2_points in \
+            _match_rows(only_players):
+        add_match_deltas(deltas, tournament_id, match_type, team1_players, team2_players,
+                         team1_won, t1_points, t2_points, only_players=only_players)
+
+    return deltas
+
+
+def compute_rivalry_rows(player_ids=None):
+    """Recompute the rivalry rows from the match table in memory"""
+    only_players = set(player_ids) if player_ids is not None else None
+    deltas = {}
+    for tournament_id, match_type, team1_players, team2_players, team1_won, t1_points, t2_points in \
+            _match_rows(only_players):
+        add_rivalry_deltas(deltas, tournament_id, team1_players, team2_players,
+                           team1_won, t1_points, t2_points, only_players=only_players)
+
+    return deltas
+
+
+def _insert_rows(model, key_fields, deltas):
+    db.session.bulk_insert_mappings(model, [
+        dict(zip(key_fields, key), **dict(zip(STAT_FIELDS, values)))
+        for key, values in deltas.items()
+        if values[0] > 0
+    ])
+
+
+def rebuild_player_stats(player_ids=None):
+    """Rebuild the aggregate table for all players, or only the given ones"""
+    query = PlayerStats.query
+    if player_ids is not None:
+        query = query.filter(PlayerStats.player_id.in_(player_ids))
+    query.delete(synchronize_session=False)
+
+    deltas = compute_stats_rows(player_ids)
+    _insert_rows(PlayerStats, PLAYER_STATS_KEY, deltas)
+    return len(deltas)
+
+
+def rebuild_rivalry_stats(player_ids=None):
+    """Rebuild the rivalry table for all players, or only the rows involving the given ones"""
+    query = RivalryStats.query
+    if player_ids is not None:
+        query = query.filter(RivalryStats.player_id.in_(player_ids) | RivalryStats.opponent_id.in_(player_ids))
+        forget_rivals(player_id for player_id, in query.with_entities(RivalryStats.player_id).distinct())
+    else:
+        forget_rivals()
+    query.delete(synchronize_session=False)
+
+    deltas = compute_rivalry_rows(player_ids)
+    _insert_rows(RivalryStats, RIVALRY_STATS_KEY, deltas)
+    if player_ids is not None:
+        forget_rivals({key[0] for key in deltas})
+    return len(deltas)
+
+
+def _compare_rows(model, key_fields, expected):
+    expected = {key: values for key, values in expected.items() if values[0] > 0}
+    stored = {
+        tuple(getattr(row, field) for field in key_fields): [getattr(row, field) for field in STAT_FIELDS]
+        for row in model.query.all()
+    }
+
+    mismatches = []
+    for key in sorted(set(expected) | set(stored), key=str):
+        if expected.get(key) != stored.get(key):
+            mismatches.append(dict(
+                zip(key_fields, key),
+                expected=dict(zip(STAT_FIELDS, expected[key])) if key in expected else None,
+                stored=dict(zip(STAT_FIELDS, stored[key])) if key in stored else None
+            ))
+
+    return mismatches
+
+
+def check_player_stats():
+    """Compare the aggregate table with a full recomputation and return any differences"""
+    return _compare_rows(PlayerStats, PLAYER_STATS_KEY, compute_stats_rows())
+
+
+def check_rivalry_stats():
+    """Compare the rivalry table with a full recomputation and return any differences"""
+    return _compare_rows(RivalryStats, RIVALRY_STATS_KEY, compute_rivalry_rows())
@@ -0,0 +1,333 @@
+"""
+Profiling - Opt-in count and timing of the SQL each request issues, summarised per endpoint,
+and cProfile runs of single requests asked for by admins
+"""
+import cProfile
+import io
+import pstats
+import re
+import sys
+import time
+from collections import Counter, OrderedDict, deque
+from datetime import datetime
+from threading import Event, Lock, Thread, get_ident
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from models import db
+from utils import is_admin_session
+
+# Percentiles shown for every endpoint
+PERCENTILES = (50, 95, 99)
+
+# Statement fingerprints kept with each slow request
+SLOW_REQUEST_STATEMENTS = 5
+
+# Query parameter or header set to 1 to profile one request; only honoured for admins
+PROFILE_FLAG = '__profile'
+PROFILE_HEADER = 'X-Profile'
+
+# Seconds between stack samples of a profiled request
+SAMPLE_INTERVAL = 0.005
+
+# Functions listed in a profile's sorted report
+REPORT_FUNCTIONS = 60
+
+# cProfile can only profile one request of the process at a time
+_request_profiler_lock = Lock()
+
+_NUMBER = re.compile(r"\b\d+(\.\d+)?\b")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_PARAMETER_LIST = re.compile(r"\?(\s*,\s*\?)+")
+_SPACE = re.compile(r"\s+")
+
+
+def fingerprint(statement):
+    """Statement text with literals and parameter lists folded, so repeats of one query look the same"""
+    statement = _STRING.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _PARAMETER_LIST.sub('?+', statement)
+    return _SPACE.sub(' ', statement).strip()
+
+
+def percentile(sorted_values, percent):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+class RequestProfile:
+    """Statements, SQL time and wall time of one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_seconds = 0.0
+        self.statements = Counter()
+        self.statement_seconds = Counter()
+
+    def add(self, statement, seconds):
+        key = fingerprint(statement)
+        self.sql_seconds += seconds
+        self.statements[key] += 1
+        self.statement_seconds[key] += seconds
+
+
+class ProfileStore:
+    """Recent request samples per endpoint and the latest slow requests of this process"""
+
+    def __init__(self, samples, slow_requests=50):
+        self.samples = samples
+        self.endpoints = OrderedDict()
+        self.slow = deque(maxlen=slow_requests)
+        self.lock = Lock()
+
+    def record(self, endpoint, query_count, sql_ms, wall_ms):
+        with self.lock:
+            entry = self.endpoints.get(endpoint)
+            if entry is None:
+                entry = self.endpoints[endpoint] = {'requests': 0, 'samples': deque(maxlen=self.samples)}
+            entry['requests'] += 1
+            entry['samples'].append((query_count, sql_ms, wall_ms))
+
+    def record_slow(self, details):
+        with self.lock:
+            self.slow.appendleft(details)
+
+    def summary(self):
+        """Request count and query count, SQL time and wall time percentiles of every endpoint, slowest first"""
+        with self.lock:
+            endpoints = [(endpoint, entry['requests'], list(entry['samples']))
+                         for endpoint, entry in self.endpoints.items()]
+            slow = list(self.slow)
+
+        rows = []
+        for endpoint, requests, samples in endpoints:
+            row = {'endpoint': endpoint, 'requests': requests}
+            for index, name in enumerate(('queries', 'sql_ms', 'wall_ms')):
+                values = sorted(sample[index] for sample in samples)
+                for percent in PERCENTILES:
+                    row[f'{name}_p{percent}'] = percentile(values, percent)
+            rows.append(row)
+        rows.sort(key=lambda row: row['wall_ms_p95'], reverse=True)
+        return rows, slow
+
+    def clear(self):
+        with self.lock:
+            self.endpoints.clear()
+            self.slow.clear()
+
+
+def get_profile_store(app=None):
+    """Get the request profiles of the application"""
+    app = app or current_app._get_current_object()
+    store = app.extensions.get('sql_profiles')
+    if store is None:
+        store = app.extensions['sql_profiles'] = ProfileStore(app.config.get('SQL_PROFILE_SAMPLES', 1000))
+    return store
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'query_count' in g:
+        g.query_count += 1
+        if g.get('sql_profile') is not None:
+            conn.info.setdefault('profile_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('profile_started')
+    if started and has_request_context() and g.get('sql_profile') is not None:
+        g.sql_profile.add(statement, time.perf_counter() - started.pop())
+
+
+def request_query_count():
+    """SQL statements the current request has issued so far, read by query budgets, metrics and profiles"""
+    return g.get('query_count', 0) if has_request_context() else 0
+
+
+def _start_counting():
+    if not event.contains(db.engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+    g.query_count = 0
+
+
+def _start_profile():
+    if current_app.config.get('SQL_PROFILING'):
+        g.sql_profile = RequestProfile()
+
+
+def _finish_profile(response):
+    profile = g.pop('sql_profile', None)
+    if profile is None:
+        return response
+
+    endpoint = request.endpoint or request.path
+    query_count = request_query_count()
+    sql_ms = round(profile.sql_seconds * 1000, 1)
+    wall_ms = round((time.perf_counter() - profile.started) * 1000, 1)
+    store = get_profile_store()
+    store.record(endpoint, query_count, sql_ms, wall_ms)
+
+    config = current_app.config
+    if query_count > config.get('SQL_PROFILE_MAX_QUERIES', 50) or wall_ms > config.get('SQL_PROFILE_SLOW_MS', 500):
+        statements = [
+            {'statement': statement, 'count': count, 'sql_ms': round(profile.statement_seconds[statement] * 1000, 1)}
+            for statement, count in profile.statements.most_common(SLOW_REQUEST_STATEMENTS)
+        ]
+        store.record_slow({
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': endpoint,
+            'status': response.status_code,
+            'queries': query_count,
+            'sql_ms': sql_ms,
+            'wall_ms': wall_ms,
+            'statements': statements
+        })
+        current_app.logger.warning(
+            f"Slow request {request.method} {request.path}: {query_count} SQL statements, "
+            f"{sql_ms} ms in SQL, {wall_ms} ms in total; most repeated: "
+            + "; ".join(f"{item['count']}x {item['statement'][:200]}" for item in statements)
+        )
+    return response
+
+
+def _frame_name(frame):
+    return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}"
+
+
+class StackSampler:
+    """Counts the stacks of one thread, sampled from a background thread"""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, name='request-sampler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(_frame_name(frame))
+                frame = frame.f_back
+            if names:
+                self.stacks[';'.join(reversed(names))] += 1
+
+    def collapsed(self):
+        """The samples as collapsed stacks, one 'outer;...;inner count' line each, as flame graph tools read them"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class ProfileReports:
+    """The latest on-demand request profiles of this process, newest first"""
+
+    def __init__(self, keep):
+        self.reports = deque(maxlen=keep)
+        self.next_id = 1
+        self.lock = Lock()
+
+    def add(self, report):
+        with self.lock:
+            report['id'] = self.next_id
+            self.next_id += 1
+            self.reports.appendleft(report)
+        return report['id']
+
+    def get(self, report_id):
+        with self.lock:
+            return next((report for report in self.reports if report['id'] == report_id), None)
+
+    def recent(self):
+        with self.lock:
+            return list(self.reports)
+
+    def clear(self):
+        with self.lock:
+            self.reports.clear()
+
+
+def get_profile_reports(app=None):
+    """Get the on-demand profiles of the application"""
+    app = app or current_app._get_current_object()
+    reports = app.extensions.get('profile_reports')
+    if reports is None:
+        reports = app.extensions['profile_reports'] = ProfileReports(app.config.get('PROFILE_REPORTS_KEPT', 20))
+    return reports
+
+
+def _wants_request_profile():
+    flag = request.args.get(PROFILE_FLAG) or request.headers.get(PROFILE_HEADER)
+    return flag == '1' and is_admin_session()
+
+
+def _start_request_profile():
+    if not _wants_request_profile():
+        return
+    if not _request_profiler_lock.acquire(blocking=False):
+        current_app.logger.warning(f"Not profiling {request.path}: another request is being profiled")
+        return
+    profiler = cProfile.Profile()
+    sampler = StackSampler(get_ident())
+    g.request_profiler = (profiler, sampler, time.perf_counter())
+    sampler.start()
+    profiler.enable()
+
+
+def _stop_request_profile():
+    profiler, sampler, started = g.pop('request_profiler')
+    profiler.disable()
+    sampler.stop()
+    _request_profiler_lock.release()
+    return profiler, sampler, round((time.perf_counter() - started) * 1000, 1)
+
+
+def _finish_request_profile(response):
+    if g.get('request_profiler') is None:
+        return response
+    profiler, sampler, wall_ms = _stop_request_profile()
+
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).strip_dirs().sort_stats('cumulative').print_stats(REPORT_FUNCTIONS)
+    report_id = get_profile_reports().add({
+        'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint or request.path,
+        'status': response.status_code,
+        'wall_ms': wall_ms,
+        'samples': sum(sampler.stacks.values()),
+        'stats': output.getvalue(),
+        'collapsed': sampler.collapsed()
+    })
+    response.headers['X-Profile-Id'] = str(report_id)
+    return response
+
+
+def _abandon_request_profile(error=None):
+    # The response never reached the after request handlers
+    if g.get('request_profiler') is not None:
+        _stop_request_profile()
+
+
+def init_profiling(app):
+    """Count the SQL of every request, profile requests whenever SQL_PROFILING is on, and single requests admins ask for"""
+    app.before_request(_start_counting)
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    app.before_request(_start_request_profile)
+    app.after_request(_finish_request_profile)
+    app.teardown_request(_abandon_request_profile)
@@ -0,0 +1,283 @@
+"""
+Ratings - Elo ratings of players and doubles pairs, replayed in match order and kept current as matches are written
+"""
+from sqlalchemy import delete, event, func, select, tuple_
+from sqlalchemy.orm import Session, aliased
+
+from models import db, Match, Team, Player, PlayerRating, TeamRating, RatingHistory
+from utils import before_match
+
+# Rating of a player or pair before their first match
+INITIAL_RATING = 1500.0
+
+# Ratings move faster over the first matches, until they have settled
+PROVISIONAL_MATCHES = 10
+PROVISIONAL_K_FACTOR = 48
+K_FACTOR = 24
+
+# Keep IN lists well below SQLite's bound parameter limit
+IN_CHUNK_SIZE = 400
+
+
+def _chunks(values, size=IN_CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def expected_score(rating, opponent_rating):
+    """Chance of beating an opponent under the Elo model"""
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+
+def k_factor(matches):
+    """Largest rating change of a match, given how many matches were rated before it"""
+    return PROVISIONAL_K_FACTOR if matches < PROVISIONAL_MATCHES else K_FACTOR
+
+
+class RatingEngine:
+    """Ratings and match counts of players and pairs, updated one match at a time"""
+
+    def __init__(self, players=None, teams=None):
+        self.players = dict(players or {})  # player id -> (rating, matches)
+        self.teams = dict(teams or {})      # team id -> (rating, matches)
+        self.history = []
+
+    def _update(self, ratings, key, score, expected, match_id, column):
+        rating, matches = ratings.get(key, (INITIAL_RATING, 0))
+        change = k_factor(matches) * (score - expected)
+        ratings[key] = (rating + change, matches + 1)
+        self.history.append({
+            'match_id': match_id,
+            'player_id': key if column == 'player_id' else None,
+            'team_id': key if column == 'team_id' else None,
+            'rating': rating + change,
+            'change': change,
+            'matches': matches + 1
+        })
+
+    def play(self, match_id, team1_id, team1_players, team2_id, team2_players, team1_won):
+        """Rate one match from the ratings everyone had before it"""
+        sides = (
+            (team1_id, team1_players, 1.0 if team1_won else 0.0),
+            (team2_id, team2_players, 0.0 if team1_won else 1.0),
+        )
+        # A doubles side plays at the average rating of its players
+        player_ratings = [
+            sum(self.players.get(player_id, (INITIAL_RATING, 0))[0] for player_id in players) / len(players)
+            for team_id, players, score in sides
+        ]
+        team_ratings = [
+            self.teams.get(team_id, (INITIAL_RATING, 0))[0] if len(players) > 1 else rating
+            for (team_id, players, score), rating in zip(sides, player_ratings)
+        ]
+
+        for index, (team_id, players, score) in enumerate(sides):
+            expected = expected_score(player_ratings[index], player_ratings[1 - index])
+            for player_id in players:
+                self._update(self.players, player_id, score, expected, match_id, 'player_id')
+            if len(players) > 1:
+                expected = expected_score(team_ratings[index], team_ratings[1 - index])
+                self._update(self.teams, team_id, score, expected, match_id, 'team_id')
+
+
+def _after_match(match_id):
+    """Filter for the matches played after the given one in (timestamp, id) order"""
+    timestamp = select(Match.timestamp).where(Match.id == match_id).scalar_subquery()
+    return tuple_(Match.timestamp, Match.id) > tuple_(timestamp, match_id)
+
+
+def _match_rows(session, after_id=None):
+    """Yield the id, teams, players and result of every match after the given one, in the order they were played"""
+    team1, team2 = aliased(Team), aliased(Team)
+    query = session.query(
+        Match.id, Match.team1_id, team1.player1_id, team1.player2_id,
+        Match.team2_id, team2.player1_id, team2.player2_id, Match.winner_team_id
+    ).join(team1, team1.id == Match.team1_id).join(team2, team2.id == Match.team2_id)
+    if after_id is not None:
+        query = query.filter(_after_match(after_id))
+    return query.order_by(Match.timestamp, Match.id).yield_per(5000)
+
+
+def _latest_ratings(session, column, keys):
+    """The rating and match count of each key after the last match still in its history"""
+    latest = {}
+    for chunk in _chunks(keys):
+        last_ids = select(func.max(RatingHistory.id)).where(column.in_(chunk)).group_by(column)
+        latest.update(
+            (key, (rating, matches)) for key, rating, matches in
+            session.query(column, RatingHistory.rating, RatingHistory.matches).filter(RatingHistory.id.in_(last_ids))
+        )
+    return latest
+
+
+def _store_ratings(session, model, column, ratings, keys=None):
+    """Replace the current ratings of the given keys, or of everyone when keys is None"""
+    if keys is None:
+        session.execute(delete(model))
+    else:
+        for chunk in _chunks(keys):
+            session.execute(delete(model).where(column.in_(chunk)))
+    rows = [
+        {column.key: key, 'rating': rating, 'matches': matches}
+        for key, (rating, matches) in ratings.items()
+        if keys is None or key in keys
+    ]
+    if rows:
+        session.execute(model.__table__.insert(), rows)
+
+
+def replay_ratings(after_id=None, player_ids=(), team_ids=(), session=None):
+    """Rate every match after the given one again (all matches when None), returning how many were rated
+
+    The given players and pairs also get their ratings recomputed, for when their matches were deleted.
+    """
+    if session is None:
+        session = db.session
+    forgotten = session.query(RatingHistory)
+    if after_id is not None:
+        forgotten = forgotten.filter(RatingHistory.match_id.in_(select(Match.id).where(_after_match(after_id))))
+
+    # Everyone whose rating included one of the replayed matches starts again from their rating before it
+    player_ids, team_ids = set(player_ids), set(team_ids)
+    if after_id is not None:
+        for player_id, team_id in forgotten.with_entities(RatingHistory.player_id, RatingHistory.team_id).distinct():
+            (player_ids if player_id else team_ids).add(player_id or team_id)
+    forgotten.delete(synchronize_session=False)
+
+    matches = []
+    for match_id, team1_id, t1p1, t1p2, team2_id, t2p1, t2p2, winner_id in _match_rows(session, after_id):
+        team1_players = [t1p1] + ([t1p2] if t1p2 else [])
+        team2_players = [t2p1] + ([t2p2] if t2p2 else [])
+        matches.append((match_id, team1_id, team1_players, team2_id, team2_players, winner_id == team1_id))
+        player_ids.update(team1_players + team2_players)
+        team_ids.update(team_id for team_id, players in ((team1_id, team1_players), (team2_id, team2_players))
+                        if len(players) > 1)
+
+    if after_id is None:
+        engine = RatingEngine()
+    else:
+        engine = RatingEngine(_latest_ratings(session, RatingHistory.player_id, player_ids),
+                              _latest_ratings(session, RatingHistory.team_id, team_ids))
+    for match in matches:
+        engine.play(*match)
+
+    if engine.history:
+        session.execute(RatingHistory.__table__.insert(), engine.history)
+    keys = (None, None) if after_id is None else (player_ids, team_ids)
+    _store_ratings(session, PlayerRating, PlayerRating.player_id, engine.players, keys[0])
+    _store_ratings(session, TeamRating, TeamRating.team_id, engine.teams, keys[1])
+    return len(matches)
+
+
+def _last_rated_match(session):
+    """Id of the latest match in the rating history, or None when nothing has been rated yet"""
+    return session.query(RatingHistory.match_id).order_by(RatingHistory.id.desc()).limit(1).scalar()
+
+
+def _stale(session):
+    return session.info.setdefault('stale_ratings', {
+        'from_start': False, 'after': set(), 'new_matches': False, 'players': set(), 'teams': set()
+    })
+
+
+def rate_new_matches():
+    """Rate the matches added in this transaction when it commits"""
+    _stale(db.session)['new_matches'] = True
+
+
+def unrate_matches(match_ids):
+    """Take matches about to be changed or deleted out of the ratings, which are replayed from there on commit
+
+    match_ids can be a list or a select of ids.
+    """
+    stale = _stale(db.session)
+    first_id = db.session.query(Match.id).filter(Match.id.in_(match_ids)).order_by(
+        Match.timestamp, Match.id
+    ).limit(1).scalar()
+    if first_id is None:
+        return
+
+    # Replay after the last match left untouched; a deleted match has no row left to start from
+    previous_id = db.session.query(Match.id).filter(
+        before_match(first_id), Match.id.notin_(match_ids)
+    ).order_by(Match.timestamp.desc(), Match.id.desc()).limit(1).scalar()
+    if previous_id is None:
+        stale['from_start'] = True
+    else:
+        stale['after'].add(previous_id)
+
+    history = RatingHistory.query.filter(RatingHistory.match_id.in_(match_ids))
+    for player_id, team_id in history.with_entities(RatingHistory.player_id, RatingHistory.team_id).distinct():
+        (stale['players'] if player_id else stale['teams']).add(player_id or team_id)
+    history.delete(synchronize_session=False)
+
+
+def update_ratings(stale, session):
+    """Replay the matches a transaction added, changed or deleted, from the earliest one on"""
+    after_ids = set(stale['after'])
+    if stale['new_matches']:
+        last_rated = _last_rated_match(session)
+        if last_rated is None:
+            stale['from_start'] = True
+        else:
+            after_ids.add(last_rated)
+
+    if stale['from_start']:
+        return replay_ratings(session=session)
+    if not after_ids:
+        return 0
+    earliest = session.query(Match.id).filter(Match.id.in_(after_ids)).order_by(
+        Match.timestamp, Match.id
+    ).limit(1).scalar()
+    return replay_ratings(earliest, stale['players'], stale['teams'], session)
+
+
+@event.listens_for(Session, 'before_commit')
+def _update_stale_ratings(session):
+    stale = session.info.pop('stale_ratings', None)
+    if stale:
+        # New matches need their ids and timestamps before they can be put in order
+        session.flush()
+        update_ratings(stale, session)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_stale_ratings(session, previous_transaction):
+    session.info.pop('stale_ratings', None)
+
+
+def player_rating(player_id):
+    """A player's current rating, or None before their first rated match"""
+    rating = db.session.query(PlayerRating.rating).filter(PlayerRating.player_id == player_id).scalar()
+    return round(rating, 1) if rating is not None else None
+
+
+def player_leaderboard(limit=20, min_matches=1):
+    """Highest rated players, with their rating and number of rated matches"""
+    rows = db.session.query(Player.id, Player.name, PlayerRating.rating, PlayerRating.matches).join(
+        PlayerRating, PlayerRating.player_id == Player.id
+    ).filter(PlayerRating.matches >= min_matches).order_by(PlayerRating.rating.desc(), Player.id).limit(limit)
+    return [{'id': player_id, 'name': name, 'rating': round(rating, 1), 'matches': matches}
+            for player_id, name, rating, matches in rows]
+
+
+def pair_leaderboard(limit=20, min_matches=1):
+    """Highest rated doubles pairs, with their players' names"""
+    player1, player2 = aliased(Player), aliased(Player)
+    rows = db.session.query(TeamRating.team_id, player1.name, player2.name, TeamRating.rating, TeamRating.matches).join(
+        Team, Team.id == TeamRating.team_id
+    ).join(player1, player1.id == Team.player1_id).join(player2, player2.id == Team.player2_id).filter(
+        TeamRating.matches >= min_matches
+    ).order_by(TeamRating.rating.desc(), TeamRating.team_id).limit(limit)
+    return [{'id': team_id, 'players': [name1, name2], 'rating': round(rating, 1), 'matches': matches}
+            for team_id, name1, name2, rating, matches in rows]
+
+
+def player_rating_history(player_id):
+    """A player's rating after each of their matches, oldest first"""
+    rows = db.session.query(RatingHistory.match_id, Match.timestamp, RatingHistory.rating, RatingHistory.change).join(
+        Match, Match.id == RatingHistory.match_id
+    ).filter(RatingHistory.player_id == player_id).order_by(RatingHistory.id)
+    return [{'match_id': match_id, 'date': timestamp.strftime('%Y-%m-%d'), 'rating': round(rating, 1),
+             'change': round(change, 1)} for match_id, timestamp, rating, change in rows]
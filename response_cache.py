@@ -0,0 +1,216 @@
+"""
+Response Cache - Keeps the data behind analytics pages until the data it was computed from is written again
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+import time
+from collections import OrderedDict
+from threading import Event, Lock
+
+from flask import current_app
+
+from utils import get_data_versions
+
+# Data sets whose version changes when tournaments are created or deleted, or shared or unshared
+TOURNAMENT_DATA = 'tournaments'
+SHARE_DATA = 'shares'
+
+# Data set whose version changes when players are created
+PLAYER_DATA = 'players'
+
+
+class MemoryStore:
+    """Least recently used entries of this process, each expiring after its time to live"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class FileStore:
+    """Entries pickled into a directory, so that every worker process shares them"""
+
+    def __init__(self, directory, max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.cache')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires <= time.time():
+            return None
+        # The modification time doubles as the last use for eviction
+        os.utime(path)
+        return value
+
+    def set(self, key, value, ttl):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((time.time() + ttl, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self._path(key))
+
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.cache')]
+        if len(paths) > self.max_entries:
+            paths.sort(key=lambda path: os.path.getmtime(path))
+            for path in paths[:len(paths) - self.max_entries]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                os.remove(os.path.join(self.directory, name))
+
+
+class _Flight:
+    """One computation in progress and the outcome its waiting callers receive"""
+
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs one computation per key at a time in this process, handing its result to every caller that asked meanwhile"""
+
+    def __init__(self, wait_seconds):
+        self.wait_seconds = wait_seconds
+        self.flights = {}
+        self.computed = 0
+        self.coalesced = 0
+        self.lock = Lock()
+
+    def do(self, key, compute):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            # A computation that takes too long is not waited for, so one stuck request cannot hold up the rest
+            if flight.done.wait(self.wait_seconds):
+                if flight.error is not None:
+                    raise flight.error
+                return flight.value
+            return compute()
+
+        try:
+            flight.value = compute()
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.computed += 1
+                del self.flights[key]
+            flight.done.set()
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.flights)
+
+
+class ResponseCache:
+    """Values keyed by endpoint, viewer and parameters, valid while the data sets they read keep their versions"""
+
+    def __init__(self, store, ttl, wait_seconds=30):
+        self.store = store
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.flights = SingleFlight(wait_seconds)
+
+    @staticmethod
+    def key(endpoint, scope, params):
+        return hashlib.sha1(repr((endpoint, scope, params)).encode()).hexdigest()
+
+    def get_or_compute(self, endpoint, compute, scope=None, params=(), data=('matches',)):
+        """Return the cached value, or compute and store it when missing, expired or computed from older data"""
+        versions = get_data_versions(*data)
+        key = self.key(endpoint, scope, params)
+        entry = self.store.get(key)
+        if entry is not None and entry[0] == versions:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        # Identical requests arriving while the value is computed share that computation
+        return self.flights.do((key, versions), lambda: self._compute(key, versions, compute))
+
+    def _compute(self, key, versions, compute):
+        value = compute()
+        self.store.set(key, (versions, value), self.ttl)
+        return value
+
+    def metrics(self):
+        """Counters of how requests for cached values were answered"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'computed': self.flights.computed,
+            'coalesced': self.flights.coalesced,
+            'in_flight': self.flights.in_flight()
+        }
+
+
+def get_response_cache(app=None):
+    """Get the response cache of the application, creating the configured store on first use"""
+    app = app or current_app._get_current_object()
+    cache = app.extensions.get('response_cache')
+    if cache is None:
+        size = app.config.get('RESPONSE_CACHE_SIZE', 512)
+        if app.config.get('RESPONSE_CACHE_STORE') == 'file':
+            directory = app.config.get('RESPONSE_CACHE_DIR') or os.path.join(app.instance_path, 'response_cache')
+            store = FileStore(directory, size)
+        else:
+            store = MemoryStore(size)
+        cache = app.extensions['response_cache'] = ResponseCache(
+            store, app.config.get('RESPONSE_CACHE_SECONDS', 300), app.config.get('RESPONSE_CACHE_WAIT_SECONDS', 30)
+        )
+    return cache
+
+
+def cached(endpoint, compute, scope=None, params=(), data=('matches',)):
+    """Serve a value from the application's response cache"""
+    return get_response_cache().get_or_compute(endpoint, compute, scope, params, data)
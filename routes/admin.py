@@ -1,8 +1,18 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, current_app, \
+    Response, abort
+import click
 from sqlalchemy import func, desc
 from datetime import datetime
-from models import db, User, Tournament, Player, Team, Match
-from utils import admin_required
+from models import db, User, Tournament, Player, Team, Match, MatchSet, PlayerStats, RivalryStats, \
+    SharedTournament
+from utils import admin_required, load_match_rows, bump_data_version
+from player_search import similar_players
+from player_merge import find_duplicate_clusters, merge_players, DEFAULT_MIN_SCORE
+from maintenance import CLEANUPS, maintenance_counts, run_cleanup
+from response_cache import TOURNAMENT_DATA, SHARE_DATA, get_response_cache
+from ratings import unrate_matches
+from head_to_head import forget_rivals
+from profiling import get_profile_store, get_profile_reports, PERCENTILES, PROFILE_FLAG, PROFILE_HEADER
 
 # Create blueprint with proper URL prefix
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
@@ -147,35 +157,7 @@ def manage_tournaments():
 @admin_required
 def view_tournament(tournament_id):
     tournament = Tournament.query.get_or_404(tournament_id)
-    matches = Match.query.filter_by(tournament_id=tournament_id).all()
-
-    match_data = []
-    for match in matches:
-        team1 = Team.query.get(match.team1_id)
-        team2 = Team.query.get(match.team2_id)
-
-        team1_players = [team1.player1.name]
-        if team1.player2:
-            team1_players.append(team1.player2.name)
-
-        team2_players = [team2.player1.name]
-        if team2.player2:
-            team2_players.append(team2.player2.name)
-
-        winner = match.get_winner()
-
-        match_data.append({
-            'id': match.id,
-            'round': match.round_name,
-            'group': match.group_name,
-            'team1': ', '.join(team1_players),
-            'team2': ', '.join(team2_players),
-            'score1': match.score1,
-            'score2': match.score2,
-            'match_type': match.match_type,
-            'date': match.timestamp.strftime('%Y-%m-%d'),
-            'winner': ', '.join(team1_players) if winner.id == team1.id else ', '.join(team2_players)
-        })
+    match_data = load_match_rows(Match.query.filter_by(tournament_id=tournament_id))
 
     return render_template(
         "admin/view.html",
@@ -190,8 +172,21 @@ def view_tournament(tournament_id):
 def delete_tournament(tournament_id):
     tournament = Tournament.query.get_or_404(tournament_id)
 
-    # Delete associated matches
+    # Delete associated matches and their aggregated statistics
+    match_ids = db.session.query(Match.id).filter_by(tournament_id=tournament_id)
+    unrate_matches(match_ids)
+    MatchSet.query.filter(MatchSet.match_id.in_(match_ids)).delete(synchronize_session=False)
     Match.query.filter_by(tournament_id=tournament_id).delete()
+    PlayerStats.query.filter_by(tournament_id=tournament_id).delete()
+    rivalries = RivalryStats.query.filter_by(tournament_id=tournament_id)
+    forget_rivals(player_id for player_id, in rivalries.with_entities(RivalryStats.player_id).distinct())
+    rivalries.delete()
+    bump_data_version()
+    bump_data_version(TOURNAMENT_DATA)
+
+    # Unshare it, which also takes it out of every recipient's visible tournaments
+    SharedTournament.query.filter_by(tournament_id=tournament_id).delete()
+    bump_data_version(SHARE_DATA)
 
     # Delete the tournament
     db.session.delete(tournament)
@@ -287,29 +282,30 @@ def merge_player(player_id):
             return redirect(url_for("admin.merge_player", player_id=player_id))
 
         merge_with = Player.query.get_or_404(merge_with_id)
-
-        # Update all teams where the merge_with player is player1
-        teams_p1 = Team.query.filter_by(player1_id=merge_with.id).all()
-        for team in teams_p1:
-            team.player1_id = player.id
-
-        # Update all teams where the merge_with player is player2
-        teams_p2 = Team.query.filter_by(player2_id=merge_with.id).all()
-        for team in teams_p2:
-            team.player2_id = player.id
-
-        # Delete the merged player
-        db.session.delete(merge_with)
+        merge_with_name = merge_with.name
+
+        # Hand the merged player's teams and matches to player, then delete the merged player
+        try:
+            merge_players({player.id: [merge_with.id]})
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e))
+            return redirect(url_for("admin.merge_player", player_id=player_id))
         db.session.commit()
 
-        flash(f"Successfully merged player {merge_with.name} into {player.name}")
+        flash(f"Successfully merged player {merge_with_name} into {player.name}")
         return redirect(url_for("admin.view_player", player_id=player_id))
 
-    # Get potential duplicate players (same or similar names)
-    potential_duplicates = Player.query.filter(
-        Player.id != player_id,
-        Player.name.like(f"%{player.name.split()[0]}%")  # Match on first name
-    ).all()
+    # Get potential duplicate players, ranked by how closely their names match
+    potential_duplicates = similar_players(player.name, exclude_id=player.id)
+    team_counts = dict(
+        db.session.query(Player.id, func.count(Team.id))
+        .join(Team, (Team.player1_id == Player.id) | (Team.player2_id == Player.id))
+        .filter(Player.id.in_([duplicate['id'] for duplicate in potential_duplicates]))
+        .group_by(Player.id)
+    )
+    for duplicate in potential_duplicates:
+        duplicate['team_count'] = team_counts.get(duplicate['id'], 0)
 
     return render_template(
         "admin/merge_player.html",
@@ -318,6 +314,44 @@ def merge_player(player_id):
     )
 
 
+@admin_bp.route('/players/duplicates', methods=["GET", "POST"])
+@admin_required
+def duplicate_players():
+    if request.method == "POST":
+        # Each ticked box is a "keep_id:duplicate_id" pair
+        merges = {}
+        for value in request.form.getlist("merge"):
+            try:
+                keep_id, duplicate_id = (int(part) for part in value.split(":"))
+            except ValueError:
+                continue
+            merges.setdefault(keep_id, []).append(duplicate_id)
+
+        if not merges:
+            flash("No players selected to merge")
+            return redirect(url_for("admin.duplicate_players"))
+
+        try:
+            result = merge_players(merges)
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e))
+            return redirect(url_for("admin.duplicate_players"))
+        db.session.commit()
+
+        flash(f"Merged {result['players']} duplicate players, folding {result['teams']} duplicate teams")
+        return redirect(url_for("admin.duplicate_players"))
+
+    min_score = min(max(request.args.get("min_score", DEFAULT_MIN_SCORE, type=float), 0.3), 1.0)
+    clusters = find_duplicate_clusters(min_score)
+
+    return render_template(
+        "admin/duplicate_players.html",
+        clusters=clusters,
+        min_score=min_score
+    )
+
+
 # System Stats & Maintenance
 @admin_bp.route('/stats')
 @admin_required
@@ -364,82 +398,109 @@ def system_stats():
         tournaments_by_month=tournaments_by_month,
         matches_by_month=matches_by_month,
         active_users=active_users,
-        match_types=match_types
+        match_types=match_types,
+        cache_metrics=get_response_cache().metrics()
     )
 
 
-# Database Maintenance
-@admin_bp.route('/maintenance')
+@admin_bp.route('/performance', methods=["GET", "POST"])
 @admin_required
-def database_maintenance():
-    # Identify orphaned records
-    orphaned_teams = Team.query.filter(
-        ~Team.matches_as_team1.any() & ~Team.matches_as_team2.any()
-    ).count()
+def performance():
+    store = get_profile_store()
+    if request.method == "POST":
+        store.clear()
+        flash("Request profiles cleared")
+        return redirect(url_for("admin.performance"))
 
-    # Players with no matches
-    inactive_players = Player.query.filter(
-        ~Player.teams_as_player1.any() & ~Player.teams_as_player2.any()
-    ).count()
+    endpoints, slow_requests = store.summary()
+    return render_template(
+        "admin/performance.html",
+        profiling=current_app.config.get('SQL_PROFILING'),
+        slow_ms=current_app.config.get('SQL_PROFILE_SLOW_MS'),
+        max_queries=current_app.config.get('SQL_PROFILE_MAX_QUERIES'),
+        percentiles=PERCENTILES,
+        endpoints=endpoints,
+        slow_requests=slow_requests
+    )
 
-    # Users with no tournaments
-    users_without_tournaments = User.query.filter(
-        ~User.tournaments.any()
-    ).count()
 
-    # Tournaments with no matches
-    empty_tournaments = Tournament.query.filter(
-        ~Tournament.matches.any()
-    ).count()
+@admin_bp.route('/profiles', methods=["GET", "POST"])
+@admin_required
+def profiles():
+    reports = get_profile_reports()
+    if request.method == "POST":
+        reports.clear()
+        flash("Request profiles cleared")
+        return redirect(url_for("admin.profiles"))
 
     return render_template(
-        "admin/maintenance.html",
-        orphaned_teams=orphaned_teams,
-        inactive_players=inactive_players,
-        users_without_tournaments=users_without_tournaments,
-        empty_tournaments=empty_tournaments
+        "admin/profiles.html",
+        reports=reports.recent(),
+        profile_flag=PROFILE_FLAG,
+        profile_header=PROFILE_HEADER
     )
 
 
-@admin_bp.route('/maintenance/cleanup', methods=["POST"])
+@admin_bp.route('/profiles/<int:report_id>')
 @admin_required
-def perform_cleanup():
-    action = request.form.get("action")
+def view_profile(report_id):
+    report = get_profile_reports().get(report_id)
+    if report is None:
+        abort(404)
+    return render_template("admin/profile.html", report=report)
 
-    if action == "orphaned_teams":
-        # Delete teams without matches
-        teams = Team.query.filter(
-            ~Team.matches_as_team1.any() & ~Team.matches_as_team2.any()
-        ).all()
 
-        for team in teams:
-            db.session.delete(team)
+@admin_bp.route('/profiles/<int:report_id>/collapsed')
+@admin_required
+def download_profile_stacks(report_id):
+    """Collapsed stacks of a profile, for flamegraph.pl, speedscope and similar tools"""
+    report = get_profile_reports().get(report_id)
+    if report is None:
+        abort(404)
+    return Response(
+        report['collapsed'],
+        mimetype='text/plain',
+        headers={'Content-Disposition': f'attachment; filename=profile-{report_id}.folded'}
+    )
 
-        db.session.commit()
-        flash(f"Deleted {len(teams)} orphaned teams")
 
-    elif action == "inactive_players":
-        # Delete players without teams
-        players = Player.query.filter(
-            ~Player.teams_as_player1.any() & ~Player.teams_as_player2.any()
-        ).all()
+# Database Maintenance
+@admin_bp.route('/maintenance')
+@admin_required
+def database_maintenance():
+    # Count orphaned teams, inactive players, users without tournaments and empty tournaments together
+    counts = maintenance_counts()
 
-        for player in players:
-            db.session.delete(player)
+    return render_template("admin/maintenance.html", **counts)
 
-        db.session.commit()
-        flash(f"Deleted {len(players)} inactive players")
 
-    elif action == "empty_tournaments":
-        # Delete tournaments without matches
-        tournaments = Tournament.query.filter(
-            ~Tournament.matches.any()
-        ).all()
+# Wording of each cleanup in messages
+CLEANUP_LABELS = {
+    'orphaned_teams': 'orphaned teams',
+    'inactive_players': 'inactive players',
+    'empty_tournaments': 'empty tournaments',
+}
 
-        for tournament in tournaments:
-            db.session.delete(tournament)
 
-        db.session.commit()
-        flash(f"Deleted {len(tournaments)} empty tournaments")
+@admin_bp.route('/maintenance/cleanup', methods=["POST"])
+@admin_required
+def perform_cleanup():
+    action = request.form.get("action")
+
+    if action in CLEANUPS:
+        count = run_cleanup(action)
+        flash(f"Deleted {count} {CLEANUP_LABELS[action]}")
+
+    return redirect(url_for("admin.database_maintenance"))
+
 
-    return redirect(url_for("admin.database_maintenance"))
\ No newline at end of file
+@admin_bp.cli.command('cleanup')
+@click.argument('action', type=click.Choice(sorted(CLEANUPS)))
+@click.option('--dry-run', is_flag=True, help='Only count the rows that would be deleted')
+@click.option('--chunk-size', type=int, default=None, help='Rows deleted per statement and transaction')
+def cleanup_command(action, dry_run, chunk_size):
+    """Delete orphaned teams, inactive players or empty tournaments"""
+    if dry_run:
+        click.echo(f"{run_cleanup(action, dry_run=True)} {CLEANUP_LABELS[action]} would be deleted")
+    else:
+        click.echo(f"Deleted {run_cleanup(action, chunk_size=chunk_size)} {CLEANUP_LABELS[action]}")
\ No newline at end of file
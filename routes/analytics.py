@@ -2,245 +2,151 @@
 Data Analysis Module - Provides data analysis functionality for the badminton tournament management system
 """
 from flask import Blueprint, render_template, session, redirect, url_for, jsonify, request, flash
-from sqlalchemy import func, desc, and_
+from sqlalchemy import func, desc, and_, literal, true, select, union
 from datetime import datetime, timedelta
 import json
-from utils import login_required
+import click
+from utils import login_required, eager_match_options, team_player_names, query_budget, conditional_json
+from analytics_engine import get_snapshot
+from head_to_head import get_rivals, rivalry_summary, rivalry_matches, rivalry_stamps, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from player_search import typeahead
+from ratings import player_rating, player_leaderboard, pair_leaderboard, player_rating_history
+from response_cache import cached, TOURNAMENT_DATA, SHARE_DATA, PLAYER_DATA
+from visibility import visible_to, visible_tournament_ids
 # Import database models from models.py
-from models import db, Tournament, Match, Team, Player
+from models import db, Tournament, Match, Team, Player, PlayerStats
 
 # Create blueprint
 analytics_bp = Blueprint('analytics', __name__)
 
-def parse_badminton_score(score_str):
-    """Parse badminton score format and return total points for each side"""
-    total_a = 0
-    total_b = 0
-
-    try:
-        # Split into sets (e.g., "21-19, 19-21, 21-15")
-        sets = score_str.split(', ')
-
-        for set_score in sets:
-            if '-' in set_score:
-                parts = set_score.split('-')
-                if len(parts) == 2:
-                    try:
-                        a = int(parts[0])
-                        b = int(parts[1])
-                        total_a += a
-                        total_b += b
-                    except ValueError:
-                        # Handle non-numeric scores
-                        pass
-    except Exception:
-        # Fallback for any parsing errors
-        pass
-
-    return total_a, total_b
+def _empty_player_stats(player_id, name):
+    """Default statistics for a player with no recorded matches"""
+    return {
+        'id': player_id,
+        'name': name,
+        'matches': 0,
+        'wins': 0,
+        'losses': 0,
+        'win_rate': 0,
+        'points_scored': 0,
+        'points_conceded': 0,
+        'match_types': {},
+        'recent_matches': []
+    }
 
-def get_player_stats(player_id=None, user_id=None):
-    """Get player statistics (filtered by tournaments owned by user)"""
+def get_recent_matches(player_id, user_id=None, limit=5):
+    """Get a player's most recent matches (filtered by tournaments visible to user)"""
+    team_ids = db.session.query(Team.id).filter(
+        (Team.player1_id == player_id) | (Team.player2_id == player_id)
+    )
 
-    # Base query - all matches in tournaments owned by the user
-    query = db.session.query(Match, Tournament).join(Tournament, Match.tournament_id == Tournament.id)
+    query = db.session.query(Match, Tournament).join(
+        Tournament, Match.tournament_id == Tournament.id
+    ).filter(
+        Match.team1_id.in_(team_ids) | Match.team2_id.in_(team_ids)
+    )
 
     if user_id:
-        from models import SharedTournament
-        shared_tournaments_subquery = db.session.query(SharedTournament.tournament_id).filter(
-            SharedTournament.shared_with_id == user_id
-        ).subquery()
-        
-        query = query.filter(
-            # Either the user owns the tournament
-            (Tournament.user_id == user_id) | 
-            # Or the tournament is shared with the user
-            (Tournament.id.in_(shared_tournaments_subquery))
-        )
+        query = query.filter(visible_to(Match.tournament_id, user_id))
 
-    matches = query.all()
+    recent_matches = []
+    for match, tournament in query.order_by(Match.timestamp.desc(), Match.id.desc()).limit(limit):
+        is_team1 = player_id in (match.team1.player1_id, match.team1.player2_id)
+        opponent = match.team2 if is_team1 else match.team1
+        opponent_names = [opponent.player1.name] + ([opponent.player2.name] if opponent.player2 else [])
+        team1_won = match.get_winner().id == match.team1_id
 
-    player_stats = {}
-    
-    # If a specific player is requested, get player info regardless of matches
-    if player_id:
-        # Get player info from database
-        from models import Player
-        player = Player.query.get(player_id)
-        if player:
-            # Initialize stats with default values even if no matches exist
-            player_stats[player.id] = {
-                'id': player.id,
-                'name': player.name,
-                'matches': 0,
-                'wins': 0,
-                'losses': 0,
-                'win_rate': 0,
-                'points_scored': 0,
-                'points_conceded': 0,
-                'match_types': {},
-                'recent_matches': []
-            }
-            
-    for match, tournament in matches:
-        team1 = match.team1
-        team2 = match.team2
-        winner = match.get_winner()
-
-        if not team1 or not team2:
-            continue  # Skip malformed matches
-
-        team1_players = [team1.player1] + ([team1.player2] if team1.player2 else [])
-        team2_players = [team2.player1] + ([team2.player2] if team2.player2 else [])
-
-        if not winner:
-            print(f"[WARN] No winner for match {match.id}. Skipping win/loss stats.")
-            continue
+        recent_matches.append({
+            'id': match.id,
+            'tournament': tournament.name,
+            'date': match.timestamp.strftime('%Y-%m-%d'),
+            'opponent': ', '.join(opponent_names),
+            'result': 'Win' if team1_won == is_team1 else 'Loss',
+            'score': (match.score1 if is_team1 else match.score2) or "N/A"
+        })
 
-        is_team1_winner = winner.id == team1.id
-
-        # Use parse_badminton_score on both scores
-        score1 = match.score1 or ""
-        score2 = match.score2 or ""
-        t1_points, t2_points = parse_badminton_score(score1)
-        t2_alt_points, t1_alt_points = parse_badminton_score(score2)  # just in case
-
-        # Safety override if scoring is flipped
-        if t1_points + t2_points < t1_alt_points + t2_alt_points:
-            t1_points, t2_points = t1_alt_points, t2_alt_points
-
-        # Team 1 players
-        for player in team1_players:
-            if player.id not in player_stats:
-                player_stats[player.id] = {
-                    'id': player.id,
-                    'name': player.name,
-                    'matches': 0,
-                    'wins': 0,
-                    'losses': 0,
-                    'win_rate': 0,
-                    'points_scored': 0,
-                    'points_conceded': 0,
-                    'match_types': {},
-                    'recent_matches': []
-                }
-            stats = player_stats[player.id]
-            stats['matches'] += 1
-            stats['wins'] += 1 if is_team1_winner else 0
-            stats['losses'] += 0 if is_team1_winner else 1
-            stats['points_scored'] += t1_points
-            stats['points_conceded'] += t2_points
-
-            mt = match.match_type
-            if mt not in stats['match_types']:
-                stats['match_types'][mt] = {'matches': 0, 'wins': 0}
-            stats['match_types'][mt]['matches'] += 1
-            stats['match_types'][mt]['wins'] += 1 if is_team1_winner else 0
-
-            stats['recent_matches'].append({
-                'id': match.id,
-                'tournament': tournament.name,
-                'date': match.timestamp.strftime('%Y-%m-%d'),
-                'opponent': ', '.join([p.name for p in team2_players]),
-                'result': 'Win' if is_team1_winner else 'Loss',
-                'score': score1 or "N/A"
-            })
-
-        # Team 2 players
-        for player in team2_players:
-            if player.id not in player_stats:
-                player_stats[player.id] = {
-                    'id': player.id,
-                    'name': player.name,
-                    'matches': 0,
-                    'wins': 0,
-                    'losses': 0,
-                    'win_rate': 0,
-                    'points_scored': 0,
-                    'points_conceded': 0,
-                    'match_types': {},
-                    'recent_matches': []
-                }
-            stats = player_stats[player.id]
-            stats['matches'] += 1
-            stats['wins'] += 1 if not is_team1_winner else 0
-            stats['losses'] += 0 if not is_team1_winner else 1
-            stats['points_scored'] += t2_points
-            stats['points_conceded'] += t1_points
-
-            mt = match.match_type
-            if mt not in stats['match_types']:
-                stats['match_types'][mt] = {'matches': 0, 'wins': 0}
-            stats['match_types'][mt]['matches'] += 1
-            stats['match_types'][mt]['wins'] += 1 if not is_team1_winner else 0
-
-            stats['recent_matches'].append({
-                'id': match.id,
-                'tournament': tournament.name,
-                'date': match.timestamp.strftime('%Y-%m-%d'),
-                'opponent': ', '.join([p.name for p in team1_players]),
-                'result': 'Win' if not is_team1_winner else 'Loss',
-                'score': score2 or "N/A"
-            })
-
-
-
-    # Finalize win rates, trim recent matches
-    for stats in player_stats.values():
-        if stats['matches'] > 0:
-            stats['win_rate'] = round((stats['wins'] / stats['matches']) * 100, 1)
-            stats['points_scored'] = int(stats.get('points_scored', 0) or 0)
-            stats['points_conceded'] = int(stats.get('points_conceded', 0) or 0)
-            stats['recent_matches'] = sorted(stats['recent_matches'], key=lambda x: x['date'], reverse=True)[:5]
-            for mt_stats in stats['match_types'].values():
-                if mt_stats['matches'] > 0:
-                    mt_stats['win_rate'] = round((mt_stats['wins'] / mt_stats['matches']) * 100, 1)
-
-    # If a specific player ID is requested, return just that player's stats
-    if player_id and player_id in player_stats:
-        return player_stats[player_id]
-
-    # Return all players the user can see
-    return list(player_stats.values())
+    return recent_matches
 
+def get_player_stats(player_id=None, user_id=None):
+    """Get player statistics (filtered by tournaments owned by user)"""
 
-def get_tournament_stats(tournament_id=None, user_id=None):
-    """Get tournament statistics"""
+    # Statistics for every player come from the columnar match snapshot
+    if not player_id:
+        tournament_ids = visible_tournament_ids(user_id) if user_id else None
+        return get_snapshot().player_stats(tournament_ids)
 
-    # Base query
-    query = Tournament.query
+    # Sum the per-tournament aggregates of every tournament the user can see
+    query = db.session.query(
+        PlayerStats.player_id,
+        Player.name,
+        PlayerStats.match_type,
+        func.sum(PlayerStats.matches),
+        func.sum(PlayerStats.wins),
+        func.sum(PlayerStats.losses),
+        func.sum(PlayerStats.points_scored),
+        func.sum(PlayerStats.points_conceded)
+    ).join(Player, PlayerStats.player_id == Player.id).filter(PlayerStats.player_id == player_id)
 
-    # If user ID is specified
     if user_id:
-        from models import SharedTournament
-        shared_tournaments_subquery = db.session.query(SharedTournament.tournament_id).filter(
-            SharedTournament.shared_with_id == user_id
-        ).subquery()
-        
-        query = query.filter(
-            # Either the user owns the tournament
-            (Tournament.user_id == user_id) | 
-            # Or the tournament is shared with the user
-            (Tournament.id.in_(shared_tournaments_subquery))
-        )
+        query = query.filter(visible_to(PlayerStats.tournament_id, user_id))
 
-    # If tournament ID is specified
-    if tournament_id:
-        query = query.filter_by(id=tournament_id)
+    player = db.session.get(Player, player_id)
+    if not player:
+        return None
+    stats = _empty_player_stats(player.id, player.name)
+
+    rows = query.group_by(PlayerStats.player_id, Player.name, PlayerStats.match_type).all()
+    for pid, name, match_type, matches, wins, losses, scored, conceded in rows:
+        stats['matches'] += matches
+        stats['wins'] += wins
+        stats['losses'] += losses
+        stats['points_scored'] += scored
+        stats['points_conceded'] += conceded
+        stats['match_types'][match_type] = {
+            'matches': matches,
+            'wins': wins,
+            'win_rate': round((wins / matches) * 100, 1) if matches > 0 else 0
+        }
 
-    tournaments = query.all()
-    tournament_stats = []
+    if stats['matches'] > 0:
+        stats['win_rate'] = round((stats['wins'] / stats['matches']) * 100, 1)
+        stats['recent_matches'] = get_recent_matches(player_id, user_id)
 
-    for tournament in tournaments:
-        matches = Match.query.filter_by(tournament_id=tournament.id).all()
+    return stats
 
-        # Basic statistics
-        stats = {
+
+def _extreme_match(match, **fields):
+    """Teams, scores and type of a tournament's longest or highest scoring match"""
+    summary = {
+        'team1': ', '.join(team_player_names(match.team1)),
+        'team2': ', '.join(team_player_names(match.team2)),
+        'score1': match.score1,
+        'score2': match.score2,
+        'match_type': match.match_type
+    }
+    summary.update(fields)
+    return summary
+
+def get_tournament_stats(tournament_id=None, user_id=None):
+    """Get tournament statistics, for every requested tournament at once with a few grouped queries"""
+
+    def in_scope(column):
+        """Limit a tournament id column to the requested tournaments the user can see"""
+        conditions = []
+        if user_id:
+            conditions.append(visible_to(column, user_id))
+        if tournament_id:
+            conditions.append(column == tournament_id)
+        return and_(true(), *conditions)
+
+    tournament_stats = {}
+    for tournament in Tournament.query.filter(in_scope(Tournament.id)):
+        tournament_stats[tournament.id] = {
             'id': tournament.id,
             'name': tournament.name,
             'date': tournament.date.strftime('%Y-%m-%d'),
             'location': tournament.location,
-            'match_count': len(matches),
+            'match_count': 0,
             'player_count': 0,
             'match_types': {},
             'players': [],
@@ -248,222 +154,107 @@ def get_tournament_stats(tournament_id=None, user_id=None):
             'longest_match': None,
             'highest_score': None
         }
-
-        # Collect all players and match types
-        players = set()
-        longest_sets = 0
-        highest_points = 0
-        highest_score_match = None
-        longest_match = None
-
-        for match in matches:
-            # Add team 1 players
-            players.add(match.team1.player1.id)
-            if match.team1.player2:
-                players.add(match.team1.player2.id)
-
-            # Add team 2 players
-            players.add(match.team2.player1.id)
-            if match.team2.player2:
-                players.add(match.team2.player2.id)
-
-            # Match type statistics
-            if match.match_type not in stats['match_types']:
-                stats['match_types'][match.match_type] = 0
-            stats['match_types'][match.match_type] += 1
-
-            # Round statistics
-            if match.round_name not in stats['rounds']:
-                stats['rounds'][match.round_name] = 0
-            stats['rounds'][match.round_name] += 1
-
-            # Check for longest match (by number of sets)
-            score1_sets = match.score1.split(', ')
-            current_sets = len(score1_sets)
-            if current_sets > longest_sets:
-                longest_sets = current_sets
-                longest_match = match
-
-            # Check for highest scoring match
-            total_points = 0
-            for i in range(len(score1_sets)):
-                try:
-                    set_parts = score1_sets[i].split('-')
-                    if len(set_parts) == 2:
-                        total_points += int(set_parts[0]) + int(set_parts[1])
-                except (ValueError, IndexError):
-                    pass
-
-            if total_points > highest_points:
-                highest_points = total_points
-                highest_score_match = match
-
-        # Update player count
-        stats['player_count'] = len(players)
-
-        # Add longest match info
-        if longest_match:
-            team1_names = [longest_match.team1.player1.name]
-            if longest_match.team1.player2:
-                team1_names.append(longest_match.team1.player2.name)
-
-            team2_names = [longest_match.team2.player1.name]
-            if longest_match.team2.player2:
-                team2_names.append(longest_match.team2.player2.name)
-
-            stats['longest_match'] = {
-                'team1': ', '.join(team1_names),
-                'team2': ', '.join(team2_names),
-                'score1': longest_match.score1,
-                'score2': longest_match.score2,
-                'sets': longest_sets,
-                'match_type': longest_match.match_type
-            }
-
-        # Add highest score match info
-        if highest_score_match:
-            team1_names = [highest_score_match.team1.player1.name]
-            if highest_score_match.team1.player2:
-                team1_names.append(highest_score_match.team1.player2.name)
-
-            team2_names = [highest_score_match.team2.player1.name]
-            if highest_score_match.team2.player2:
-                team2_names.append(highest_score_match.team2.player2.name)
-
-            stats['highest_score'] = {
-                'team1': ', '.join(team1_names),
-                'team2': ', '.join(team2_names),
-                'score1': highest_score_match.score1,
-                'score2': highest_score_match.score2,
-                'total_points': highest_points,
-                'match_type': highest_score_match.match_type
-            }
-
-        # Add all players' basic info
-        for player_id in players:
-            player = Player.query.get(player_id)
-            if player:
-                stats['players'].append({
-                    'id': player.id,
-                    'name': player.name
-                })
-
-        tournament_stats.append(stats)
-
-    # If a tournament ID is specified and a matching tournament is found
-    if tournament_id and tournament_stats:
-        return tournament_stats[0]
+    if not tournament_stats:
+        return []
+
+    # Match, type and round counts from one grouped query
+    counts = db.session.query(
+        Match.tournament_id, Match.match_type, Match.round_name, func.count(Match.id)
+    ).filter(in_scope(Match.tournament_id)).group_by(Match.tournament_id, Match.match_type, Match.round_name)
+    for match_tournament_id, match_type, round_name, count in counts:
+        stats = tournament_stats.get(match_tournament_id)
+        if stats is None:
+            continue
+        stats['match_count'] += count
+        stats['match_types'][match_type] = stats['match_types'].get(match_type, 0) + count
+        stats['rounds'][round_name] = stats['rounds'].get(round_name, 0) + count
+
+    # Distinct players of either team of every match
+    sides = union(
+        select(Match.tournament_id, Match.team1_id.label('team_id')).where(in_scope(Match.tournament_id)),
+        select(Match.tournament_id, Match.team2_id).where(in_scope(Match.tournament_id))
+    ).subquery()
+    participants = union(
+        select(sides.c.tournament_id, Team.player1_id.label('player_id')).join(Team, Team.id == sides.c.team_id),
+        select(sides.c.tournament_id, Team.player2_id).join(Team, Team.id == sides.c.team_id).where(
+            Team.player2_id.isnot(None)
+        )
+    ).subquery()
+    players = db.session.execute(
+        select(participants.c.tournament_id, Player.id, Player.name)
+        .join(Player, Player.id == participants.c.player_id)
+        .order_by(Player.name, Player.id)
+    )
+    for match_tournament_id, player_id, name in players:
+        if match_tournament_id in tournament_stats:
+            tournament_stats[match_tournament_id]['players'].append({'id': player_id, 'name': name})
+    for stats in tournament_stats.values():
+        stats['player_count'] = len(stats['players'])
+
+    # The longest match (by number of sets) and highest scoring match of each tournament, ranked in SQL
+    longest = func.row_number().over(
+        partition_by=Match.tournament_id, order_by=(Match.set_count.desc(), Match.id)
+    ).label('longest')
+    highest = func.row_number().over(
+        partition_by=Match.tournament_id, order_by=(Match.total_points.desc(), Match.id)
+    ).label('highest')
+    ranked = select(Match.id, Match.total_points, longest, highest).where(in_scope(Match.tournament_id)).subquery()
+    extreme_ids = select(ranked.c.id).where(
+        (ranked.c.longest == 1) | ((ranked.c.highest == 1) & (ranked.c.total_points > 0))
+    )
+    extremes = Match.query.filter(Match.id.in_(extreme_ids)).options(*eager_match_options()).order_by(Match.id)
+    for match in extremes:
+        stats = tournament_stats.get(match.tournament_id)
+        if stats is None:
+            continue
+        current = stats['longest_match']
+        if current is None or match.set_count > current['sets']:
+            stats['longest_match'] = _extreme_match(match, sets=match.set_count)
+        current = stats['highest_score']
+        if match.total_points > 0 and (current is None or match.total_points > current['total_points']):
+            stats['highest_score'] = _extreme_match(match, total_points=match.total_points)
+
+    # If a tournament ID is specified, return its statistics alone
+    if tournament_id:
+        return tournament_stats.get(tournament_id) or []
 
     # Sort by date
-    return sorted(tournament_stats, key=lambda x: x['date'], reverse=True)
-
-def get_head_to_head(player1_id, player2_id):
-    """Get head-to-head data between two players with improved score handling"""
-
-    # Find matches where both players participated
-    # This query is complex as players could be in different teams
-    player1_team_ids = db.session.query(Team.id).filter(
-        (Team.player1_id == player1_id) | (Team.player2_id == player1_id)
-    ).all()
-    player1_team_ids = [t[0] for t in player1_team_ids]
-
-    player2_team_ids = db.session.query(Team.id).filter(
-        (Team.player1_id == player2_id) | (Team.player2_id == player2_id)
-    ).all()
-    player2_team_ids = [t[0] for t in player2_team_ids]
-
-    # Find matches where they faced each other
-    versus_matches = Match.query.filter(
-        ((Match.team1_id.in_(player1_team_ids)) & (Match.team2_id.in_(player2_team_ids))) |
-        ((Match.team1_id.in_(player2_team_ids)) & (Match.team2_id.in_(player1_team_ids)))
-    ).all()
+    return sorted(tournament_stats.values(), key=lambda x: x['date'], reverse=True)
 
-    player1 = Player.query.get(player1_id)
-    player2 = Player.query.get(player2_id)
-
-    if not player1 or not player2:
+def get_head_to_head(player1_id, player2_id, page=1, per_page=DEFAULT_PAGE_SIZE, before_id=None):
+    """Get head-to-head totals between two players and one page of their matches"""
+    players = dict(db.session.query(Player.id, Player.name).filter(Player.id.in_([player1_id, player2_id])))
+    if player1_id not in players or player2_id not in players:
         # Handle the case where a player doesn't exist
         return None
 
-    # Match records
-    head_to_head = {
+    summary = rivalry_summary(player1_id, player2_id)
+    per_page = max(1, min(per_page, MAX_PAGE_SIZE))
+    page = max(page, 1)
+    matches = rivalry_matches(player1_id, player2_id, per_page, (page - 1) * per_page, before_id)
+
+    return {
         'player1': {
-            'id': player1.id,
-            'name': player1.name,
-            'wins': 0,
-            'total_points_scored': 0
+            'id': player1_id,
+            'name': players[player1_id],
+            'wins': summary['player1_wins'],
+            'total_points_scored': summary['player1_points']
         },
         'player2': {
-            'id': player2.id,
-            'name': player2.name,
-            'wins': 0,
-            'total_points_scored': 0
+            'id': player2_id,
+            'name': players[player2_id],
+            'wins': summary['player2_wins'],
+            'total_points_scored': summary['player2_points']
         },
-        'matches': [],
-        'total_matches': len(versus_matches)
+        'matches': matches,
+        'total_matches': summary['total_matches'],
+        'total_match_count': summary['total_matches'],
+        'current_page': page,
+        'per_page': per_page,
+        'total_pages': (summary['total_matches'] + per_page - 1) // per_page,
+        'next_before_id': matches[-1]['id'] if len(matches) == per_page else None
     }
 
-    for match in versus_matches:
-        # Determine which team each player is on
-        player1_in_team1 = match.team1.player1_id == player1.id or (match.team1.player2_id and match.team1.player2_id == player1.id)
-
-        # Determine winning team
-        winner = match.get_winner()
-        if not winner:
-            print(f"[WARNING] No winner for match ID {match.id}. Skipping win/loss attribution.")
-            continue
-            
-        is_team1_winner = (winner.id == match.team1.id)
-
-        # Record win/loss
-        if (player1_in_team1 and is_team1_winner) or (not player1_in_team1 and not is_team1_winner):
-            head_to_head['player1']['wins'] += 1
-            winner_id = player1.id
-        else:
-            head_to_head['player2']['wins'] += 1
-            winner_id = player2.id
-
-        # Process scores for points statistics
-        team1_points, team2_points = parse_badminton_score(match.score1)
-
-        # Update points based on which side the player was on
-        if player1_in_team1:
-            head_to_head['player1']['total_points_scored'] += team1_points
-            head_to_head['player2']['total_points_scored'] += team2_points
-        else:
-            head_to_head['player1']['total_points_scored'] += team2_points
-            head_to_head['player2']['total_points_scored'] += team1_points
-
-        # Add match details
-        tournament = Tournament.query.get(match.tournament_id)
-
-        # Get team names
-        team1_players = [match.team1.player1.name]
-        if match.team1.player2:
-            team1_players.append(match.team1.player2.name)
-
-        team2_players = [match.team2.player1.name]
-        if match.team2.player2:
-            team2_players.append(match.team2.player2.name)
-
-        match_info = {
-            'id': match.id,
-            'date': match.timestamp.strftime('%Y-%m-%d'),
-            'tournament': tournament.name,
-            'team1': ', '.join(team1_players),
-            'team2': ', '.join(team2_players),
-            'score1': match.score1,
-            'score2': match.score2,
-            'winner_id': winner_id,
-            'match_type': match.match_type
-        }
-        head_to_head['matches'].append(match_info)
-
-    # Sort by date
-    head_to_head['matches'] = sorted(head_to_head['matches'], key=lambda x: x['date'], reverse=True)
-
-    return head_to_head
-
 def get_match_distribution_by_type(user_id=None):
     """Get match distribution by type"""
 
@@ -473,10 +264,9 @@ def get_match_distribution_by_type(user_id=None):
         func.count(Match.id).label('count')
     )
 
-    # If user ID is specified, only query that user's matches
+    # If user ID is specified, only count matches of tournaments the user can see
     if user_id:
-        query = query.join(Tournament, Match.tournament_id == Tournament.id)
-        query = query.filter(Tournament.user_id == user_id)
+        query = query.filter(visible_to(Match.tournament_id, user_id))
 
     # Group and get results
     distribution = query.group_by(Match.match_type).all()
@@ -567,22 +357,9 @@ def get_monthly_match_counts(user_id=None, months=12):
     end_date = datetime.now()
     start_date = end_date - timedelta(days=30 * months)
 
-    # Base query
-    query = db.session.query(
-        func.strftime('%Y-%m', Match.timestamp).label('month'),
-        func.count(Match.id).label('count')
-    )
-
-    # If user ID is specified, only query that user's matches
-    if user_id:
-        query = query.join(Tournament, Match.tournament_id == Tournament.id)
-        query = query.filter(Tournament.user_id == user_id)
-
-    # Limit date range
-    query = query.filter(Match.timestamp >= start_date)
-
-    # Group and get results
-    monthly_counts = query.group_by('month').all()
+    # Count matches per month from the columnar match snapshot
+    tournament_ids = visible_tournament_ids(user_id) if user_id else None
+    monthly_counts = get_snapshot().monthly_counts(tournament_ids, since=start_date)
 
     # Ensure all months have data
     result = {
@@ -598,8 +375,8 @@ def get_monthly_match_counts(user_id=None, months=12):
         all_months[month_key] = 0
         current = (current.replace(day=1) + timedelta(days=32)).replace(day=1)
 
-    # Fill in query results
-    for month, count in monthly_counts:
+    # Fill in counted months
+    for month, count in monthly_counts.items():
         all_months[month] = count
 
     # Convert to lists
@@ -611,48 +388,67 @@ def get_monthly_match_counts(user_id=None, months=12):
 
     return result
 
+# Data sets read by pages that only show the tournaments a user can see
+VIEWER_DATA = ('matches', 'identities', TOURNAMENT_DATA, SHARE_DATA)
+
+def player_stamps(player_id):
+    """ETag scope of a player's stats: the visible tournaments they played in, and their rating"""
+    tournaments = db.session.query(Tournament.id, Tournament.data_stamp).filter(
+        visible_to(Tournament.id, session.get('user_id')),
+        Tournament.id.in_(select(PlayerStats.tournament_id).where(PlayerStats.player_id == player_id))
+    ).order_by(Tournament.id)
+    return tuple(tuple(row) for row in tournaments), player_rating(player_id)
+
+def tournament_stamp(tournament_id):
+    """ETag scope of a tournament's stats: its data stamp, or None while the user cannot see it"""
+    return db.session.query(Tournament.data_stamp).filter(
+        Tournament.id == tournament_id, visible_to(Tournament.id, session.get('user_id'))
+    ).scalar()
+
+def get_player_choices():
+    """Id and name of every player, for the player pickers"""
+    return cached('player_choices', lambda: [
+        {'id': player_id, 'name': name} for player_id, name in db.session.query(Player.id, Player.name)
+    ], data=('matches', 'identities', PLAYER_DATA))
+
+def compute_dashboard(user_id):
+    """Gather the charts and pickers of a user's analytics dashboard"""
+    return {
+        'match_distribution': get_match_distribution_by_type(user_id),
+        'player_win_rates': get_win_rates_by_player(user_id),
+        'monthly_matches': get_monthly_match_counts(user_id, months=6),
+        'tournaments': [
+            {'id': tournament_id, 'name': name}
+            for tournament_id, name in db.session.query(Tournament.id, Tournament.name).filter(
+                visible_to(Tournament.id, user_id)
+            )
+        ]
+    }
+
 @analytics_bp.route('/analytics')
 @login_required
 def analytics_dashboard():
     """Analytics dashboard view"""
     user_id = session.get("user_id")
 
-    # Get basic statistics
-    match_distribution = get_match_distribution_by_type(user_id)
-    player_win_rates = get_win_rates_by_player(user_id)
-    monthly_matches = get_monthly_match_counts(user_id, months=6)
-
-    # Get all players list (for selection)
-    players = Player.query.all()
-
-    # Get all tournaments list (for selection)
-    tournaments = Tournament.query.filter_by(user_id=user_id).all()
+    # The monthly chart moves on with the calendar, so the month is part of the key
+    dashboard = cached('analytics_dashboard', lambda: compute_dashboard(user_id), scope=user_id,
+                       params=(datetime.now().strftime('%Y-%m'),), data=VIEWER_DATA)
 
     return render_template(
         "analytics.html",
-        match_distribution=match_distribution,  
-        player_win_rates=player_win_rates,  
-        monthly_matches=monthly_matches,  
-        players=players,
-        tournaments=tournaments
+        players=get_player_choices(),
+        **dashboard
     )
 
-@analytics_bp.route('/analytics/player/<int:player_id>')
-@login_required
-def player_analytics(player_id):
-    """Individual player analysis view with improved error handling"""
-    if "user_id" not in session:
-        return redirect(url_for("auth.login"))
-
-    user_id = session.get("user_id")
-
-    # Get player statistics
+def compute_player_page(player_id, user_id):
+    """Player statistics with every field the player page reads filled in, or None for an unknown player"""
     player_stats = get_player_stats(player_id, user_id)
-
-    # Handle case where player stats is None or not found
     if not player_stats:
-        flash("Player not found or no statistics available")
-        return redirect(url_for("analytics.analytics_dashboard"))
+        return None
+
+    # Ratings count every match the player has played, like head-to-head records
+    player_stats['rating'] = player_rating(player_id)
 
     # Make sure match_types is properly initialized
     if 'match_types' not in player_stats or player_stats['match_types'] is None:
@@ -675,9 +471,6 @@ def player_analytics(player_id):
         if field not in player_stats or player_stats[field] is None:
             player_stats[field] = default_value
 
-    # Get all players (for comparison)
-    players = Player.query.all()
-
     # Convert match_types to JSON-serializable format if needed
     for match_type, stats in player_stats['match_types'].items():
         # Ensure each match_type stats has all required fields
@@ -688,32 +481,41 @@ def player_analytics(player_id):
         if 'win_rate' not in stats:
             stats['win_rate'] = 0 if stats['matches'] == 0 else (stats['wins'] / stats['matches'] * 100)
 
-    # Add cache control headers directly to response
-    response = render_template(
-        "player_analytics.html",
-        player=player_stats,
-        players=players
-    )
+    return player_stats
 
-    # Flask will automatically convert the string response to a Response object
-    return response
+def get_player_page(player_id, user_id):
+    """Cached statistics of one player as seen by a user"""
+    return cached('player_analytics', lambda: compute_player_page(player_id, user_id), scope=user_id,
+                  params=(player_id,), data=VIEWER_DATA)
 
-@analytics_bp.route('/analytics/tournament/<int:tournament_id>')
+@analytics_bp.route('/analytics/player/<int:player_id>')
 @login_required
-def tournament_analytics(tournament_id):
-    """Tournament analysis view with improved error handling"""
+def player_analytics(player_id):
+    """Individual player analysis view with improved error handling"""
     if "user_id" not in session:
         return redirect(url_for("auth.login"))
 
     user_id = session.get("user_id")
 
-    # Get tournament statistics
-    tournament_stats = get_tournament_stats(tournament_id, user_id)
+    # Get player statistics
+    player_stats = get_player_page(player_id, user_id)
 
-    # If tournament not found or doesn't belong to current user
+    # Handle case where player stats is None or not found
+    if not player_stats:
+        flash("Player not found or no statistics available")
+        return redirect(url_for("analytics.analytics_dashboard"))
+
+    return render_template(
+        "player_analytics.html",
+        player=player_stats,
+        players=get_player_choices()
+    )
+
+def compute_tournament_page(tournament_id, user_id):
+    """Tournament statistics with every field the tournament page reads filled in, or None when not visible"""
+    tournament_stats = get_tournament_stats(tournament_id, user_id)
     if not tournament_stats:
-        flash("Tournament not found or you don't have permission to view it")
-        return redirect(url_for('analytics.analytics_dashboard'))
+        return None
 
     # Initialize empty containers for missing data
     if 'match_types' not in tournament_stats or not tournament_stats['match_types']:
@@ -725,14 +527,35 @@ def tournament_analytics(tournament_id):
     if 'players' not in tournament_stats or not tournament_stats['players']:
         tournament_stats['players'] = []
 
-    # Create response with cache control headers to prevent stale data
-    response = render_template(
+    return tournament_stats
+
+def get_tournament_page(tournament_id, user_id):
+    """Cached statistics of one tournament as seen by a user"""
+    return cached('tournament_analytics', lambda: compute_tournament_page(tournament_id, user_id), scope=user_id,
+                  params=(tournament_id,), data=VIEWER_DATA)
+
+@analytics_bp.route('/analytics/tournament/<int:tournament_id>')
+@login_required
+def tournament_analytics(tournament_id):
+    """Tournament analysis view with improved error handling"""
+    if "user_id" not in session:
+        return redirect(url_for("auth.login"))
+
+    user_id = session.get("user_id")
+
+    # Get tournament statistics
+    tournament_stats = get_tournament_page(tournament_id, user_id)
+
+    # If tournament not found or doesn't belong to current user
+    if not tournament_stats:
+        flash("Tournament not found or you don't have permission to view it")
+        return redirect(url_for('analytics.analytics_dashboard'))
+
+    return render_template(
         "tournament_analytics.html",
         tournament=tournament_stats
     )
 
-    return response
-
 @analytics_bp.route('/analytics/head_to_head')
 @login_required
 def head_to_head_view():
@@ -746,27 +569,12 @@ def head_to_head_view():
     per_page = request.args.get('per_page', 10, type=int)
 
     # Get all players (for selection)
-    players = Player.query.all()
+    players = get_player_choices()
 
     # If two player IDs are provided
     head_to_head = None
     if player1_id and player2_id:
-        head_to_head = get_head_to_head(player1_id, player2_id)
-
-        # Implement pagination for matches
-        if head_to_head and head_to_head['matches']:
-            total_matches = len(head_to_head['matches'])
-            start_idx = (page - 1) * per_page
-            end_idx = min(start_idx + per_page, total_matches)
-
-            # Store the total number of matches for pagination info
-            head_to_head['total_match_count'] = total_matches
-            head_to_head['current_page'] = page
-            head_to_head['total_pages'] = (total_matches + per_page - 1) // per_page
-
-            # Store all matches and use a subset for display
-            head_to_head['all_matches'] = head_to_head['matches']
-            head_to_head['matches'] = head_to_head['matches'][start_idx:end_idx]
+        head_to_head = get_head_to_head(player1_id, player2_id, page, per_page)
 
     return render_template(
         "head_to_head.html",
@@ -778,61 +586,194 @@ def head_to_head_view():
 
 @analytics_bp.route('/api/player/<int:player_id>/stats')
 @login_required
+@conditional_json('identities', scope=player_stamps)
 def api_player_stats(player_id):
     """Player statistics API"""
 
+    Player.query.get_or_404(player_id)
     user_id = session.get("user_id")
-    stats = get_player_stats(player_id, user_id)
+    stats = get_player_page(player_id, user_id)
 
     return jsonify(stats)
 
+@analytics_bp.route('/api/player/<int:player_id>/rivals')
+@login_required
+@conditional_json('identities', scope=player_stamps)
+def api_player_rivals(player_id):
+    """Every opponent of a player with their record in the tournaments the user can see, most frequent first"""
+
+    player = Player.query.get_or_404(player_id)
+    rivals = get_rivals(player_id, visible_tournament_ids(session.get('user_id')))
+
+    return jsonify({'id': player.id, 'name': player.name, 'rivals': rivals})
+
+@analytics_bp.route('/api/player/<int:player_id>/ratings')
+@login_required
+@conditional_json('matches', 'identities')
+def api_player_ratings(player_id):
+    """A player's current Elo rating and its history, match by match"""
+
+    player = Player.query.get_or_404(player_id)
+
+    return jsonify({
+        'id': player.id,
+        'name': player.name,
+        'rating': player_rating(player_id),
+        'history': player_rating_history(player_id)
+    })
+
+@analytics_bp.route('/api/ratings')
+@login_required
+@conditional_json('matches', 'identities')
+def api_ratings():
+    """Elo leaderboard of players, or of doubles pairs with ?pairs=1"""
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    min_matches = max(1, request.args.get('min_matches', 1, type=int))
+    leaderboard = pair_leaderboard if request.args.get('pairs', type=int) else player_leaderboard
+
+    return jsonify({'ratings': leaderboard(limit, min_matches)})
+
+@analytics_bp.route('/api/players/search')
+@login_required
+def api_player_search():
+    """Typeahead lookup of players by name"""
+
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+
+    return jsonify({'query': query, 'players': typeahead(query, limit)})
+
 @analytics_bp.route('/api/tournament/<int:tournament_id>/stats')
 @login_required
+@conditional_json('identities', scope=tournament_stamp)
 def api_tournament_stats(tournament_id):
     """Tournament statistics API"""
 
     user_id = session.get("user_id")
-    stats = get_tournament_stats(tournament_id, user_id)
+    stats = get_tournament_page(tournament_id, user_id)
 
     return jsonify(stats)
 
 @analytics_bp.route('/api/head_to_head/<int:player1_id>/<int:player2_id>')
 @login_required
+@conditional_json('identities', scope=rivalry_stamps)
 def api_head_to_head(player1_id, player2_id):
-    """Head-to-head statistics API"""
-
-    stats = get_head_to_head(player1_id, player2_id)
+    """Head-to-head statistics API, paged with ?page= or ?before_id=<last match id>"""
+
+    stats = get_head_to_head(
+        player1_id,
+        player2_id,
+        page=request.args.get('page', 1, type=int),
+        per_page=request.args.get('per_page', 50, type=int),
+        before_id=request.args.get('before_id', type=int)
+    )
 
     return jsonify(stats)
 
+def compute_overall_stats():
+    """Count players, tournaments and matches and find the most active player in one query"""
+    top_player = db.session.query(
+        PlayerStats.player_id,
+        func.sum(PlayerStats.matches).label('matches'),
+        func.sum(PlayerStats.wins).label('wins')
+    ).group_by(PlayerStats.player_id).order_by(
+        func.sum(PlayerStats.matches).desc(), PlayerStats.player_id
+    ).limit(1).subquery()
+    anchor = db.session.query(literal(1).label('one')).subquery()
+
+    total_players, total_tournaments, total_matches, player_id, name, matches, wins = db.session.query(
+        db.session.query(func.count(Player.id)).scalar_subquery(),
+        db.session.query(func.count(Tournament.id)).scalar_subquery(),
+        db.session.query(func.count(Match.id)).scalar_subquery(),
+        Player.id,
+        Player.name,
+        top_player.c.matches,
+        top_player.c.wins
+    ).select_from(anchor).outerjoin(top_player, true()).outerjoin(
+        Player, Player.id == top_player.c.player_id
+    ).one()
+
+    most_popular_player = None
+    if player_id:
+        most_popular_player = {
+            'id': player_id,
+            'name': name,
+            'matches_played': matches,
+            'wins': wins,
+            'win_percentage': round((wins / matches) * 100, 1) if matches else 0
+        }
+
+    return {
+        'total_players': total_players,
+        'total_tournaments': total_tournaments,
+        'total_matches': total_matches,
+        'avg_matches_per_tournament': round(total_matches / total_tournaments, 2) if total_tournaments else 0,
+        'most_popular_player': most_popular_player
+    }
+
+def get_overall_stats():
+    """Get the overall statistics, recomputed when matches, players or tournaments change"""
+    return cached('overall_stats', compute_overall_stats, data=('matches', 'identities', TOURNAMENT_DATA, PLAYER_DATA))
+
 @analytics_bp.route('/analytics/overall')
 @login_required
+@query_budget(5)
 def overall_analysis():
     """Generalized analysis of all inputted tournaments"""
-    # Get total number of players
-    total_players = Player.query.count()
-
-    # Get total number of tournaments
-    total_tournaments = Tournament.query.count()
-
-    # Calculate average matches per tournament
-    total_matches = Match.query.count()
-    avg_matches_per_tournament = round(total_matches / total_tournaments, 2) if total_tournaments else 0
-
-    # Most popular player based on matches played
-    players = Player.query.all()
+    return render_template('overall_analysis.html', **get_overall_stats())
 
-    def matches_played(player):
-        teams = player.teams_as_player1 + player.teams_as_player2
-        match_count = sum(len(team.matches_as_team1) + len(team.matches_as_team2) for team in teams)
-        return match_count
+@analytics_bp.route('/api/overall')
+@login_required
+@conditional_json('matches', 'identities', TOURNAMENT_DATA, PLAYER_DATA)
+@query_budget(3)
+def api_overall_analysis():
+    """Overall statistics API"""
+    return jsonify(get_overall_stats())
+
+
+@analytics_bp.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Rebuild the player and rivalry statistics tables from the match table"""
+    from player_stats import rebuild_player_stats, rebuild_rivalry_stats
+    from utils import bump_data_version, touch_tournaments
+
+    row_count = rebuild_player_stats()
+    rivalry_count = rebuild_rivalry_stats()
+    touch_tournaments(tournament_id for tournament_id, in db.session.query(Tournament.id))
+    bump_data_version()
+    db.session.commit()
+    click.echo(f"Rebuilt {row_count} player statistics rows and {rivalry_count} rivalry rows")
+
+
+@analytics_bp.cli.command('rebuild-ratings')
+def rebuild_ratings_command():
+    """Rate every match again in the order they were played"""
+    from ratings import replay_ratings
+
+    match_count = replay_ratings()
+    db.session.commit()
+    click.echo(f"Rated {match_count} matches")
+
+
+@analytics_bp.cli.command('check-stats')
+def check_stats_command():
+    """Compare the player and rivalry statistics tables with a full recomputation"""
+    from player_stats import check_player_stats, check_rivalry_stats
+
+    mismatches = check_player_stats()
+    for mismatch in mismatches:
+        click.echo(
+            f"Player {mismatch['player_id']}, tournament {mismatch['tournament_id']}, "
+            f"{mismatch['match_type']}: expected {mismatch['expected']}, stored {mismatch['stored']}"
+        )
 
-    most_popular_player = max(players, key=matches_played, default=None)
+    rivalry_mismatches = check_rivalry_stats()
+    for mismatch in rivalry_mismatches:
+        click.echo(
+            f"Player {mismatch['player_id']} against {mismatch['opponent_id']}, tournament {mismatch['tournament_id']}: "
+            f"expected {mismatch['expected']}, stored {mismatch['stored']}"
+        )
 
-    return render_template(
-        'overall_analysis.html',
-        total_players=total_players,
-        total_tournaments=total_tournaments,
-        avg_matches_per_tournament=avg_matches_per_tournament,
-        most_popular_player=most_popular_player
-    )
+    if mismatches or rivalry_mismatches:
+        raise SystemExit(f"{len(mismatches) + len(rivalry_mismatches)} statistics rows are out of date")
+    click.echo("Player and rivalry statistics tables are consistent")
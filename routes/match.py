@@ -1,100 +1,145 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify
+from datetime import datetime, timedelta
+from sqlalchemy import select
 from models import db, Tournament, Match, Player, Team
-from utils import login_required, process_team, validate_match_players
+from identity_map import resolve_teams
+from player_search import matching_player_ids
+from utils import login_required, validate_match_players, on_match_saved, on_match_removed, load_match_rows, \
+    before_match
+from visibility import tournament_access, visible_to
+
+# Matches shown per page of the listing
+MATCH_PAGE_SIZE = 50
+MAX_MATCH_PAGE_SIZE = 200
 
 # Create blueprint
 match_bp = Blueprint('match', __name__)
 
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+def match_filters(args):
+    """Read the match listing filters from the query string"""
+    return {
+        'tournament_id': args.get('tournament_id', type=int),
+        'player_name': args.get('player_name', '').strip(),
+        'match_type': args.get('match_type', '').strip(),
+        'round': args.get('round', '').strip(),
+        'date_from': args.get('date_from', '').strip(),
+        'date_to': args.get('date_to', '').strip()
+    }
+
+def filter_matches(query, filters):
+    """Apply the listing filters to a Match query in SQL"""
+    if filters['tournament_id']:
+        query = query.filter(Match.tournament_id == filters['tournament_id'])
+
+    if filters['player_name']:
+        # Players can be in either team, so match on the teams of every player with a matching name
+        player_ids = matching_player_ids(filters['player_name'])
+        team_ids = select(Team.id).where(Team.player1_id.in_(player_ids) | Team.player2_id.in_(player_ids))
+        query = query.filter(Match.team1_id.in_(team_ids) | Match.team2_id.in_(team_ids))
+
+    if filters['match_type']:
+        query = query.filter(Match.match_type == filters['match_type'])
+
+    if filters['round']:
+        query = query.filter(Match.round_name == filters['round'])
+
+    date_from = _parse_date(filters['date_from'])
+    if date_from:
+        query = query.filter(Match.timestamp >= date_from)
+
+    date_to = _parse_date(filters['date_to'])
+    if date_to:
+        query = query.filter(Match.timestamp < date_to + timedelta(days=1))
+
+    return query
+
+def owned_match(match_id, user_id):
+    """Get a match of one of the user's own tournaments; matches of shared tournaments are read-only"""
+    return Match.query.filter(
+        Match.id == match_id,
+        visible_to(Match.tournament_id, user_id, include_shared=False)
+    ).first()
+
+def match_page(user_id, filters, before_id=None, per_page=MATCH_PAGE_SIZE):
+    """Get one newest-first page of the matches a user can see and the id to continue after, if there are more"""
+    query = Match.query.filter(visible_to(Match.tournament_id, user_id))
+    query = filter_matches(query, filters)
+
+    # Continuing after the last match seen keeps every page as cheap as the first one
+    if before_id:
+        query = query.filter(before_match(before_id))
+
+    rows = load_match_rows(query.order_by(Match.timestamp.desc(), Match.id.desc()).limit(per_page + 1))
+    owned = tournament_access(user_id)[0]
+    for row in rows:
+        row['editable'] = row['tournament_id'] in owned
+    next_before_id = rows[per_page - 1]['id'] if len(rows) > per_page else None
+    return rows[:per_page], next_before_id
+
 @match_bp.route("/matches")
 @login_required
 def view_matches():
-    """View all matches with edit/delete options"""
+    """View matches a page at a time with edit/delete options"""
     if "user_id" not in session:
         return redirect(url_for("auth.login"))
 
     user_id = session.get("user_id")
+    filters = match_filters(request.args)
+    before_id = request.args.get('before_id', type=int)
+    per_page = max(1, min(request.args.get('per_page', MATCH_PAGE_SIZE, type=int), MAX_MATCH_PAGE_SIZE))
 
-    # Get query parameters for filtering
-    tournament_id = request.args.get('tournament_id', type=int)
-    player_name = request.args.get('player_name', '')
-
-    # Base query - join with Tournament to filter by user_id
-    query = db.session.query(Match, Tournament).join(
-        Tournament, Match.tournament_id == Tournament.id
-    ).filter(Tournament.user_id == user_id)
-
-    # Apply filters if provided
-    if tournament_id:
-        query = query.filter(Match.tournament_id == tournament_id)
-
-    if player_name:
-        # This is a more complex filter since players can be in either team
-        player_matches = []
-        player_ids = []
-
-        # Find players with matching names
-        players = Player.query.filter(Player.name.contains(player_name)).all()
-        player_ids = [p.id for p in players]
-
-        if player_ids:
-            # Find teams containing these players
-            team_ids = db.session.query(Team.id).filter(
-                (Team.player1_id.in_(player_ids)) |
-                (Team.player2_id.in_(player_ids))
-            ).all()
-            team_ids = [t[0] for t in team_ids]
-
-            # Filter matches containing these teams
-            query = query.filter(
-                (Match.team1_id.in_(team_ids)) |
-                (Match.team2_id.in_(team_ids))
-            )
-
-    # Get all tournaments for the filter dropdown
-    tournaments = Tournament.query.filter_by(user_id=user_id).all()
+    match_data, next_before_id = match_page(user_id, filters, before_id, per_page)
 
-    # Execute query and get results
-    matches = query.order_by(Match.timestamp.desc()).all()
-
-    # Prepare data for template
-    match_data = []
-    for match, tournament in matches:
-        team1 = Team.query.get(match.team1_id)
-        team2 = Team.query.get(match.team2_id)
-
-        team1_players = [team1.player1.name]
-        if team1.player2:
-            team1_players.append(team1.player2.name)
-
-        team2_players = [team2.player1.name]
-        if team2.player2:
-            team2_players.append(team2.player2.name)
-
-        winner = match.get_winner()
-
-        match_data.append({
-            'id': match.id,
-            'tournament': tournament.name,
-            'tournament_id': tournament.id,
-            'date': match.timestamp.strftime('%Y-%m-%d'),
-            'round': match.round_name,
-            'group': match.group_name,
-            'team1': ', '.join(team1_players),
-            'team2': ', '.join(team2_players),
-            'score1': match.score1,
-            'score2': match.score2,
-            'match_type': match.match_type,
-            'winner': ', '.join(team1_players) if winner.id == team1.id else ', '.join(team2_players)
-        })
+    # Get all tournaments the user can see for the filter dropdown
+    tournaments = Tournament.query.filter(visible_to(Tournament.id, user_id)).order_by(Tournament.name).all()
 
     return render_template(
         "matches.html",
         matches=match_data,
         tournaments=tournaments,
-        current_tournament=tournament_id,
-        player_name=player_name
+        current_tournament=filters['tournament_id'],
+        player_name=filters['player_name'],
+        filters=filters,
+        filter_args={name: value for name, value in filters.items() if value},
+        before_id=before_id,
+        next_before_id=next_before_id,
+        per_page=per_page
     )
 
+@match_bp.route("/api/matches")
+@login_required
+def api_matches():
+    """Matches API, newest first, continued with ?before_id=<next_before_id>"""
+    user_id = session.get("user_id")
+    filters = match_filters(request.args)
+    per_page = max(1, min(request.args.get('per_page', MATCH_PAGE_SIZE, type=int), MAX_MATCH_PAGE_SIZE))
+
+    rows, next_before_id = match_page(user_id, filters, request.args.get('before_id', type=int), per_page)
+    return jsonify({
+        'matches': [{
+            'id': row['id'],
+            'tournament': row['tournament'],
+            'tournament_id': row['tournament_id'],
+            'date': row['date'],
+            'round': row['round'],
+            'group': row['group'],
+            'team1': row['team1'],
+            'team2': row['team2'],
+            'score1': row['score1'],
+            'score2': row['score2'],
+            'match_type': row['match_type'],
+            'winner': row['winner'],
+            'editable': row['editable']
+        } for row in rows],
+        'next_before_id': next_before_id
+    })
+
 @match_bp.route("/matches/<int:match_id>/edit", methods=["GET"])
 @login_required
 def edit_match(match_id):
@@ -105,12 +150,7 @@ def edit_match(match_id):
     user_id = session.get("user_id")
 
     # Get the match with validation that it belongs to the current user
-    match = db.session.query(Match).join(
-        Tournament, Match.tournament_id == Tournament.id
-    ).filter(
-        Match.id == match_id,
-        Tournament.user_id == user_id
-    ).first()
+    match = owned_match(match_id, user_id)
 
     if not match:
         flash("Match not found or you don't have permission to edit it")
@@ -152,12 +192,7 @@ def update_match(match_id):
     user_id = session.get("user_id")
 
     # Get the match with validation that it belongs to the current user
-    match = db.session.query(Match).join(
-        Tournament, Match.tournament_id == Tournament.id
-    ).filter(
-        Match.id == match_id,
-        Tournament.user_id == user_id
-    ).first()
+    match = owned_match(match_id, user_id)
 
     if not match:
         flash("Match not found or you don't have permission to edit it")
@@ -181,8 +216,9 @@ def update_match(match_id):
             return redirect(url_for("match.edit_match", match_id=match_id))
 
         # Process teams - either find existing teams or create new ones
-        team1 = process_team(team1_name)
-        team2 = process_team(team2_name)
+        teams = resolve_teams([team1_name, team2_name])
+        team1 = teams[team1_name]
+        team2 = teams[team2_name]
 
         # Validate teams (ensure no player is on both sides in doubles)
         if match_type.endswith('Doubles') and not validate_match_players(team1, team2):
@@ -190,6 +226,7 @@ def update_match(match_id):
             return redirect(url_for("match.edit_match", match_id=match_id))
 
         # Update match
+        on_match_removed(match)
         match.tournament_id = tournament_id
         match.round_name = round_name
         match.group_name = group_name
@@ -198,6 +235,7 @@ def update_match(match_id):
         match.score1 = score1
         match.score2 = score2
         match.match_type = match_type
+        on_match_saved(match)
 
         db.session.commit()
         flash("Match updated successfully!")
@@ -218,12 +256,7 @@ def delete_match(match_id):
     user_id = session.get("user_id")
 
     # Get the match with validation that it belongs to the current user
-    match = db.session.query(Match).join(
-        Tournament, Match.tournament_id == Tournament.id
-    ).filter(
-        Match.id == match_id,
-        Tournament.user_id == user_id
-    ).first()
+    match = owned_match(match_id, user_id)
 
     if not match:
         flash("Match not found or you don't have permission to delete it")
@@ -231,6 +264,7 @@ def delete_match(match_id):
 
     try:
         # Delete the match
+        on_match_removed(match)
         db.session.delete(match)
         db.session.commit()
         flash("Match deleted successfully!")
@@ -1,6 +1,8 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session
 from models import db, Tournament, User, Match, Team, SharedTournament
-from utils import login_required
+from utils import login_required, load_match_rows, bump_data_version
+from response_cache import SHARE_DATA
+from visibility import tournament_access
 
 # Create blueprint
 sharing_bp = Blueprint('sharing', __name__)
@@ -81,6 +83,7 @@ def create_share():
             shared_with_id=shared_with_id
         )
         db.session.add(share)
+        bump_data_version(SHARE_DATA)
         db.session.commit()
         flash(f"Tournament shared with {target_user.username} successfully!")
     except Exception as e:
@@ -119,6 +122,7 @@ def delete_share():
     try:
         username = User.query.get(shared_with_id).username
         db.session.delete(share)
+        bump_data_version(SHARE_DATA)
         db.session.commit()
         flash(f"Stopped sharing tournament with {username}")
     except Exception as e:
@@ -152,12 +156,7 @@ def view_shared_tournament(tournament_id):
     user_id = session.get("user_id")
 
     # Check if the tournament is shared with the current user
-    share = SharedTournament.query.filter_by(
-        tournament_id=tournament_id,
-        shared_with_id=user_id
-    ).first()
-
-    if not share:
+    if tournament_id not in tournament_access(user_id)[1]:
         flash("You don't have access to this tournament")
         return redirect(url_for("sharing.shared_with_me"))
 
@@ -167,41 +166,15 @@ def view_shared_tournament(tournament_id):
         flash("Tournament not found")
         return redirect(url_for("sharing.shared_with_me"))
 
-    # Get matches for this tournament
-    matches = Match.query.filter_by(tournament_id=tournament_id).all()
-
-    match_data = []
-    for match in matches:
-        team1 = Team.query.get(match.team1_id)
-        team2 = Team.query.get(match.team2_id)
-
-        team1_players = [team1.player1.name]
-        if team1.player2:
-            team1_players.append(team1.player2.name)
-
-        team2_players = [team2.player1.name]
-        if team2.player2:
-            team2_players.append(team2.player2.name)
-
-        winner = match.get_winner()
-
-        match_data.append({
-            'id': match.id,
-            'round': match.round_name,
-            'group': match.group_name,
-            'team1': ', '.join(team1_players),
-            'team2': ', '.join(team2_players),
-            'score1': match.score1,
-            'score2': match.score2,
-            'match_type': match.match_type,
-            'date': match.timestamp.strftime('%Y-%m-%d'),
-            'winner': ', '.join(team1_players) if winner.id == team1.id else ', '.join(team2_players)
-        })
+    # Get matches for this tournament with teams and players loaded up front
+    match_data = load_match_rows(Match.query.filter_by(tournament_id=tournament_id))
 
+    # Only the owner of a tournament can share it
+    owner = User.query.get(tournament.user_id)
     return render_template(
         "view_shared_tournament.html",
         tournament=tournament,
         matches=match_data,
-        owner=User.query.get(tournament.user_id),
-        shared_by=User.query.get(share.owner_id)
+        owner=owner,
+        shared_by=owner
     )
\ No newline at end of file
@@ -4,8 +4,17 @@ from datetime import datetime
 import os
 import csv
 import io
-from models import db, Tournament, Match, Player, Team
-from utils import login_required, process_team, validate_match_players, get_or_create_player
+import click
+from models import db, Tournament, Match, Player, Team, ImportJob
+from utils import login_required, validate_match_players, get_or_create_player, on_match_saved, \
+    load_match_rows, bump_data_version, conditional_json
+from identity_map import resolve_teams
+from response_cache import TOURNAMENT_DATA
+from csv_import import import_results, import_player_names, preview_results
+from jobs import start_import_job, cancel_import_job, upload_path, fail_interrupted_jobs
+
+# Number of skipped rows listed individually after an import
+MAX_REPORTED_ROW_ERRORS = 10
 
 # Create blueprint
 tournament_bp = Blueprint('tournament', __name__)
@@ -51,6 +60,7 @@ def submit_results():
         )
         db.session.add(tournament)
         db.session.flush()  # Get the tournament ID without committing yet
+        bump_data_version(TOURNAMENT_DATA)
 
         # Process match data
         rounds = request.form.getlist("round[]")
@@ -61,12 +71,15 @@ def submit_results():
         score2_list = request.form.getlist("score2[]")
         match_types = request.form.getlist("match_type[]")
 
+        # Resolve every player and team of the form together instead of a few queries per team
+        teams = resolve_teams(team1_names + team2_names)
+
         for i in range(len(rounds)):
             if i < len(team1_names) and i < len(team2_names) and i < len(score1_list) and i < len(
                     score2_list) and i < len(match_types):
                 # Process teams
-                team1 = process_team(team1_names[i])
-                team2 = process_team(team2_names[i])
+                team1 = teams[team1_names[i]]
+                team2 = teams[team2_names[i]]
 
                 # Add validation to prevent players appearing on both sides in doubles
                 if match_types[i].endswith('Doubles') and not validate_match_players(team1, team2):
@@ -87,6 +100,7 @@ def submit_results():
                     match_type=match_types[i]
                 )
                 db.session.add(match)
+                on_match_saved(match)
 
         # Commit all database changes
         db.session.commit()
@@ -117,16 +131,9 @@ def upload_pre_tournament():
     if file:
         # Process the CSV file
         try:
-            # Read the CSV data
-            stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
-            csv_data = list(csv.reader(stream))
-
-            # Validate and process data
-            player_count = 0
-            for row in csv_data[1:]:  # Skip header row
-                if len(row) >= 1 and row[0]:
-                    player = get_or_create_player(row[0])
-                    player_count += 1
+            # Decode and parse the upload as it is read instead of buffering the whole file
+            stream = io.TextIOWrapper(file.stream, encoding="utf-8", newline="")
+            player_count = import_player_names(csv.reader(stream))
 
             db.session.commit()
             flash(f'Successfully imported {player_count} players!')
@@ -158,40 +165,20 @@ def upload_post_tournament():
             # Save the file temporarily
             from flask import current_app
             filename = secure_filename(file.filename)
-            filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+            filepath = upload_path(session["user_id"], filename)
             file.save(filepath)
 
-            # Read the CSV data
-            tournament_name = None
-            with open(filepath, 'r') as f:
-                csv_reader = csv.reader(f)
-                headers = next(csv_reader)
-
-                tournament_col_index = -1
-                year_col_index = -1
-
-                for i, header in enumerate(headers):
-                    if header.lower() == 'tournament':
-                        tournament_col_index = i
-                    elif header.lower() == 'year':
-                        year_col_index = i
-
-                matches = list(csv_reader)
+            # Validate the saved file row by row, keeping only a preview in memory
+            with open(filepath, 'r', newline='') as f:
+                preview = preview_results(csv.reader(f))
 
-                if tournament_col_index >= 0 and matches:
-                    tournament_name = matches[0][tournament_col_index]
-
-                    if year_col_index >= 0:
-                        year = matches[0][year_col_index]
-                        tournament_name = f"{tournament_name} {year}"
-
-            if not tournament_name:
-                tournament_name = f"Tournament from {filename}"
+            tournament_name = preview['tournament_name'] or f"Tournament from {filename}"
 
             # Fixed template path - without the html/ prefix since it's in the templates/ directory
             return render_template('review_results.html',
-                                   headers=headers,
-                                   matches=matches,
+                                   headers=preview['headers'],
+                                   matches=preview['rows'],
+                                   preview=preview,
                                    filename=filename,
                                    tournament_name=tournament_name)  # 传递比赛名称
 
@@ -208,97 +195,74 @@ def confirm_results(filename):
 
     try:
         from flask import current_app
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], secure_filename(filename))
-
-        with open(filepath, 'r') as f:
-            csv_reader = csv.reader(f)
-            headers = next(csv_reader)
-
-            team1_idx = headers.index('Team 1') if 'Team 1' in headers else 0
-            team2_idx = headers.index('Team 2') if 'Team 2' in headers else 1
-            score1_idx = headers.index('Score 1') if 'Score 1' in headers else 2
-            score2_idx = headers.index('Score 2') if 'Score 2' in headers else 3
-            round_idx = headers.index('Round') if 'Round' in headers else 4
-            match_type_idx = headers.index('Match Type') if 'Match Type' in headers else 5
-            tournament_idx = headers.index('Tournament') if 'Tournament' in headers else 6
-            year_idx = headers.index('Year') if 'Year' in headers else 7
-
-            tournaments_cache = {}
-            match_count = 0
-
-            for row in csv_reader:
-                if len(row) >= 6:
-                    try:
-                        tournament_name = row[tournament_idx] if tournament_idx < len(row) else "Unknown"
-                        year = row[year_idx] if year_idx < len(row) and year_idx < len(row) else ""
-
-                        tournament_key = f"{tournament_name}_{year}"
-
-                        if tournament_key not in tournaments_cache:
-                            existing_tournament = Tournament.query.filter_by(
-                                name=tournament_name,
-                                user_id=session["user_id"]
-                            ).first()
-
-                            if existing_tournament and str(existing_tournament.date.year) == year:
-
-                                tournaments_cache[tournament_key] = existing_tournament
-                            else:
-                                try:
-
-                                    tournament_date = datetime(int(year), 1,
-                                                               1).date() if year.isdigit() else datetime.now().date()
-                                except:
-                                    tournament_date = datetime.now().date()
-
-                                new_tournament = Tournament(
-                                    name=tournament_name,
-                                    date=tournament_date,
-                                    location="",  # Read from csv if there is
-                                    user_id=session["user_id"]
-                                )
-                                db.session.add(new_tournament)
-                                db.session.flush() # Get id
-                                tournaments_cache[tournament_key] = new_tournament
-
-                        current_tournament = tournaments_cache[tournament_key]
-
-                        team1 = process_team(row[team1_idx])
-                        team2 = process_team(row[team2_idx])
-
-                        match_type = row[match_type_idx] if match_type_idx < len(row) else "Unknown"
-                        if match_type.endswith('Doubles') and not validate_match_players(team1, team2):
-                            flash(f"Warning: In doubles，the player cannnot against itself ({row[team1_idx]} vs {row[team2_idx]})")
-                            continue
-
-                        # Create matches
-                        match = Match(
-                            tournament_id=current_tournament.id,
-                            round_name=row[round_idx] if round_idx < len(row) else "Unknown",
-                            team1_id=team1.id,
-                            team2_id=team2.id,
-                            score1=row[score1_idx] if score1_idx < len(row) else "0-0",
-                            score2=row[score2_idx] if score2_idx < len(row) else "0-0",
-                            match_type=match_type
-                        )
-                        db.session.add(match)
-                        match_count += 1
-                    except Exception as e:
-                        flash(f"Error when dealing with rows: {str(e)}")
-                        continue
+        filepath = upload_path(session["user_id"], filename)
 
-            db.session.commit()
-            os.remove(filepath)
+        # Large files are imported in the background while the user watches the progress
+        if os.path.getsize(filepath) >= current_app.config['BACKGROUND_IMPORT_MIN_BYTES']:
+            job = start_import_job(filepath, session["user_id"])
+            return redirect(url_for('tournament.import_job_status', job_id=job.id))
+
+        with open(filepath, 'r', newline='') as f:
+            importer = import_results(csv.reader(f), session["user_id"])
+        os.remove(filepath)
 
-            flash(f'Successfully imported {match_count} matches，in {len(tournaments_cache)} Tournaments!')
-            return redirect(url_for('user.dashboard'))
+        # Report the first few problem rows rather than flooding the session with messages
+        for line, message in importer.errors[:MAX_REPORTED_ROW_ERRORS]:
+            flash(f"Row {line} skipped: {message}")
+        if len(importer.errors) > MAX_REPORTED_ROW_ERRORS:
+            flash(f"{len(importer.errors) - MAX_REPORTED_ROW_ERRORS} more rows were skipped")
+
+        flash(f'Successfully imported {importer.match_count} matches，in {len(importer.tournaments)} Tournaments!')
+        return redirect(url_for('user.dashboard'))
     except Exception as e:
         db.session.rollback()
         flash(f'Error with results: {str(e)}')
         return redirect(url_for('tournament.upload_page'))
 
+@tournament_bp.route("/imports/<int:job_id>")
+@login_required
+def import_job_status(job_id):
+    fail_interrupted_jobs([job_id])
+    job = ImportJob.query.filter_by(id=job_id, user_id=session["user_id"]).first_or_404()
+    return render_template('import_job.html', job=job.to_dict())
+
+@tournament_bp.route("/api/imports", methods=["POST"])
+@login_required
+def api_start_import():
+    filename = secure_filename(request.form.get("filename", ""))
+    filepath = upload_path(session["user_id"], filename)
+    if not filename or not os.path.isfile(filepath):
+        return jsonify({"error": "Uploaded file not found"}), 404
+
+    job = start_import_job(filepath, session["user_id"])
+    return jsonify(job.to_dict()), 202
+
+@tournament_bp.route("/api/imports/<int:job_id>")
+@login_required
+def api_import_job(job_id):
+    fail_interrupted_jobs([job_id])
+    job = ImportJob.query.filter_by(id=job_id, user_id=session["user_id"]).first()
+    if not job:
+        return jsonify({"error": "Import job not found"}), 404
+    return jsonify(job.to_dict())
+
+@tournament_bp.route("/api/imports/<int:job_id>/cancel", methods=["POST"])
+@login_required
+def api_cancel_import(job_id):
+    job = ImportJob.query.filter_by(id=job_id, user_id=session["user_id"]).first()
+    if not job:
+        return jsonify({"error": "Import job not found"}), 404
+    if not cancel_import_job(job):
+        return jsonify({"error": "Import job has already finished"}), 409
+    return jsonify(job.to_dict())
+
+def owned_tournament_stamp(tournament_id):
+    """ETag scope of a tournament's match list: its data stamp while the user owns it"""
+    return db.session.query(Tournament.data_stamp).filter_by(id=tournament_id, user_id=session["user_id"]).scalar()
+
 @tournament_bp.route("/api/matches/<int:tournament_id>")
 @login_required
+@conditional_json('identities', scope=owned_tournament_stamp)
 def get_matches(tournament_id):
     if "user_id" not in session:
         return jsonify({"error": "Not authorized"}), 401
@@ -307,28 +271,22 @@ def get_matches(tournament_id):
     if not tournament:
         return jsonify({"error": "Tournament not found"}), 404
 
-    matches = Match.query.filter_by(tournament_id=tournament_id).all()
-    results = []
-
-    for match in matches:
-        team1_name = match.team1.player1.name
-        if match.team1.player2:
-            team1_name += f", {match.team1.player2.name}"
-
-        team2_name = match.team2.player1.name
-        if match.team2.player2:
-            team2_name += f", {match.team2.player2.name}"
-
-        results.append({
-            "id": match.id,
-            "round": match.round_name,
-            "group": match.group_name,
-            "team1": team1_name,
-            "team2": team2_name,
-            "score1": match.score1,
-            "score2": match.score2,
-            "match_type": match.match_type,
-            "date": match.timestamp.strftime("%Y-%m-%d")
-        })
-
-    return jsonify(results)
\ No newline at end of file
+    rows = load_match_rows(Match.query.filter_by(tournament_id=tournament_id))
+    results = [{
+        "id": row["id"],
+        "round": row["round"],
+        "group": row["group"],
+        "team1": row["team1"],
+        "team2": row["team2"],
+        "score1": row["score1"],
+        "score2": row["score2"],
+        "match_type": row["match_type"],
+        "date": row["date"]
+    } for row in rows]
+
+    return jsonify(results)
+
+@tournament_bp.cli.command('recover-imports')
+def recover_imports_command():
+    """Report the queued or running imports whose worker process has stopped as failed"""
+    click.echo(f"Marked {fail_interrupted_jobs()} interrupted import jobs as failed")
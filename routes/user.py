@@ -1,7 +1,7 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session
 from flask_wtf.csrf import generate_csrf
 from models import db, User, Tournament, Match
-from utils import login_required
+from utils import login_required, load_match_rows
 
 # Create blueprint
 user_bp = Blueprint('user', __name__)
@@ -25,24 +25,18 @@ def dashboard():
     latest_tournament = Tournament.query.filter_by(user_id=user.id).order_by(Tournament.created_at.desc()).first()
     latest_date = latest_tournament.date.strftime("%b %d, %Y") if latest_tournament else "No tournaments yet"
 
+    rows = load_match_rows(
+        Match.query.join(Tournament).filter(Tournament.user_id == user.id).order_by(Match.timestamp.desc()).limit(5)
+    )
+
     recent_matches = []
-    matches = Match.query.join(Tournament).filter(Tournament.user_id == user.id).order_by(Match.timestamp.desc()).limit(5).all()
-
-    for match in matches:
-        team1_players = [match.team1.player1.name]
-        if match.team1.player2:
-            team1_players.append(match.team1.player2.name)
-        team2_players = [match.team2.player1.name]
-        if match.team2.player2:
-            team2_players.append(match.team2.player2.name)
-        winner = match.get_winner()
-        is_winner_team1 = winner.id == match.team1.id
+    for row in rows:
         recent_matches.append({
-            "team1": " vs ".join(team1_players),
-            "team2": " vs ".join(team2_players),
-            "score": f"{match.score1} · {match.timestamp.strftime('%Y-%m-%d')}",
-            "is_winner": is_winner_team1,
-            "match_date": match.timestamp.strftime('%Y-%m-%d')
+            "team1": " vs ".join(row["team1_players"]),
+            "team2": " vs ".join(row["team2_players"]),
+            "score": f"{row['score1']} · {row['date']}",
+            "is_winner": row["team1_won"],
+            "match_date": row["date"]
         })
 
     last_login = session.get("last_login")
@@ -29,11 +29,13 @@ class BadmintonManagerUnitTestCase(unittest.TestCase):
     def setUp(self):
         """Set up test environment before each test."""
         # Create a new Flask app and configure it for testing
-        self.app = create_app()
-        self.app.config['TESTING'] = True
-        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'  # Use in-memory DB for isolation
-        self.app.config['WTF_CSRF_ENABLED'] = False  # Disable CSRF for testing
-        self.app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(__file__), 'test_uploads')
+        # The database URI has to be set before create_app binds the database, so it is passed in
+        self.app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',  # Use in-memory DB for isolation
+            'WTF_CSRF_ENABLED': False,  # Disable CSRF for testing
+            'UPLOAD_FOLDER': os.path.join(os.path.dirname(__file__), 'test_uploads')
+        })
     
         # Create test upload directory if it doesn't exist
         if not os.path.exists(self.app.config['UPLOAD_FOLDER']):
@@ -93,6 +95,24 @@ class BadmintonManagerUnitTestCase(unittest.TestCase):
             'password': 'password123'
         }, follow_redirects=True)
 
+    def count_queries(self, url, method='get', status=200, **kwargs):
+        """Helper function that counts the SQL statements issued while requesting a URL."""
+        from sqlalchemy import event
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            response = getattr(self.client, method)(url, **kwargs)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        self.assertEqual(response.status_code, status)
+        return len(statements)
+
     # -------------------- Match Recording and Results Tests --------------------
 
     def test_record_single_match(self):
@@ -348,6 +368,105 @@ class BadmintonManagerUnitTestCase(unittest.TestCase):
             self.assertEqual(team1.player1.name, 'Player Three')
             self.assertEqual(team2.player1.name, 'Player Four')
 
+    def test_structured_scores_stored_on_write(self):
+        """Test that set scores, the winner and point totals are stored when a match is written."""
+        self.login()
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Structured Score Tournament',
+            'tournament_date': datetime.now().strftime('%Y-%m-%d'),
+            'round[]': ['Semi Final', 'Final'],
+            'team1[]': ['Player One', 'Player Three'],
+            'team2[]': ['Player Two', 'Player Four'],
+            'score1[]': ['21-19, 19-21, 21-18', '15-21, 10-21'],
+            'score2[]': ['19-21, 21-19, 18-21', '21-15, 21-10'],
+            'match_type[]': ["Men's Singles", "Men's Singles"]
+        }, follow_redirects=True)
+
+        # Test case 1: Set rows, winner and totals are populated
+        with self.app.app_context():
+            match = Match.query.filter_by(round_name='Semi Final').first()
+            self.assertEqual([(s.team1_points, s.team2_points) for s in match.sets], [(21, 19), (19, 21), (21, 18)])
+            self.assertEqual(match.winner_team_id, match.team1_id)
+            self.assertEqual((match.team1_points, match.team2_points, match.total_points), (61, 58, 119))
+            self.assertEqual(match.set_count, 3)
+
+            final = Match.query.filter_by(round_name='Final').first()
+            self.assertEqual(final.winner_team_id, final.team2_id)
+            tournament_id = final.tournament_id
+
+        # Test case 2: Longest and highest scoring matches come from the stored columns
+        stats = self.client.get(f'/api/tournament/{tournament_id}/stats').get_json()
+        self.assertEqual(stats['longest_match']['sets'], 3)
+        self.assertEqual(stats['highest_score']['total_points'], 119)
+
+        # Test case 3: Editing the score recomputes the stored columns
+        self.client.post(f'/matches/{final.id}/update', data={
+            'tournament_id': tournament_id,
+            'round_name': 'Final',
+            'team1': 'Player Three',
+            'team2': 'Player Four',
+            'score1': '21-15, 21-10',
+            'score2': '15-21, 10-21',
+            'match_type': "Men's Singles"
+        }, follow_redirects=True)
+        with self.app.app_context():
+            final = Match.query.filter_by(round_name='Final').first()
+            self.assertEqual(final.winner_team_id, final.team1_id)
+            self.assertEqual(len(final.sets), 2)
+
+        # Test case 4: Only sets that parse are counted
+        from models import summarize_scores
+        self.assertEqual(summarize_scores('', '')['set_count'], 0)
+        self.assertEqual(summarize_scores('21-15, walkover', '')['set_count'], 1)
+
+    def test_analytics_snapshot_matches_stats_and_rebuilds(self):
+        """Test that the columnar snapshot agrees with the stats table and is rebuilt after writes."""
+        from analytics_engine import get_snapshot
+        self.login()
+
+        def submit(name, score1, score2):
+            self.client.post('/submit_results', data={
+                'tournament_name': name,
+                'tournament_date': datetime.now().strftime('%Y-%m-%d'),
+                'round[]': ['Final', 'Final'],
+                'team1[]': ['Player One, Player Two', 'Player One'],
+                'team2[]': ['Player Three, Player Four', 'Player Three'],
+                'score1[]': [score1, '21-10, 21-12'],
+                'score2[]': [score2, '10-21, 12-21'],
+                'match_type[]': ["Men's Doubles", "Men's Singles"]
+            }, follow_redirects=True)
+
+        submit('Snapshot Tournament', '21-19, 19-21, 21-18', '19-21, 21-19, 18-21')
+
+        # Test case 1: Leaderboard rows agree with the per-player statistics
+        with self.app.app_context():
+            snapshot = get_snapshot()
+            self.assertEqual(len(snapshot), 2)
+            self.assertEqual(snapshot.match_sets(0), [(21, 19), (19, 21), (21, 18)])
+            leaderboard = snapshot.player_stats()
+        self.assertEqual(len(leaderboard), 4)
+        for row in leaderboard:
+            single = self.client.get(f"/api/player/{row['id']}/stats").get_json()
+            for field in ('matches', 'wins', 'losses', 'win_rate', 'points_scored', 'points_conceded', 'match_types'):
+                self.assertEqual(row[field], single[field])
+
+        # Test case 2: A new match gives a new snapshot, the unchanged data reuses the old one
+        with self.app.app_context():
+            self.assertIs(get_snapshot(), snapshot)
+        submit('Second Snapshot Tournament', '21-5, 21-5', '5-21, 5-21')
+        with self.app.app_context():
+            rebuilt = get_snapshot()
+            self.assertIsNot(rebuilt, snapshot)
+            self.assertEqual(len(rebuilt), 4)
+            self.assertEqual(sum(rebuilt.monthly_counts().values()), 4)
+
+        # Test case 3: Tournament filtering only counts the given tournaments
+        with self.app.app_context():
+            first_id = Tournament.query.filter_by(name='Snapshot Tournament').first().id
+            rows = {row['name']: row for row in rebuilt.player_stats({first_id})}
+        self.assertEqual(rows['Player One']['matches'], 2)
+        self.assertEqual(rows['Player One']['points_scored'], 61 + 42)
+
     # -------------------- Data Import/Export Tests --------------------
 
     def test_csv_format_validation(self):
@@ -383,6 +502,204 @@ class BadmintonManagerUnitTestCase(unittest.TestCase):
         # The app might still try to process it - we just check that the page loads
         self.assertEqual(response.status_code, 200)
 
+    def test_upload_review_shows_bounded_preview(self):
+        """Test that the review page previews only the first rows of a large results file."""
+        self.login()
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['Team 1', 'Team 2', 'Score 1', 'Score 2', 'Round', 'Match Type', 'Tournament', 'Year'])
+        for i in range(500):
+            writer.writerow(['Preview A', 'Preview B', '21-10', '10-21', 'Round %d' % i, "Men's Singles", 'Preview Open', '2024'])
+        writer.writerow([' , Preview A', 'Preview B', '21-10', '10-21', 'Bad Round', "Men's Singles", 'Preview Open', '2024'])
+
+        data = dict(post_file=(io.BytesIO(output.getvalue().encode()), 'preview.csv'))
+        response = self.client.post('/upload/post', data=data, follow_redirects=True, content_type='multipart/form-data')
+
+        # Test case 1: Only the first rows are rendered, with counts for the whole file
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Round 49\n', response.data)
+        self.assertNotIn(b'Round 50\n', response.data)
+        self.assertIn(b'Showing the first 50 of 501 rows.', response.data)
+
+        # Test case 2: Problem rows are reported before the import
+        self.assertIn(b'Row 502: Team 1 has no player', response.data)
+
+        # Test case 3: Pre-tournament player lists are imported from the stream
+        data = dict(pre_file=(io.BytesIO(b'Name\nStream One\nStream Two\nStream One\n'), 'players.csv'))
+        response = self.client.post('/upload/pre', data=data, follow_redirects=True, content_type='multipart/form-data')
+        self.assertIn(b'Successfully imported 3 players!', response.data)
+        with self.app.app_context():
+            self.assertEqual(Player.query.filter(Player.name.like('Stream %')).count(), 2)
+
+    def test_player_picker_lists_players_from_pre_tournament_upload(self):
+        """Test that cached player pickers and counts pick up players created by a pre-tournament upload."""
+        self.login()
+
+        # Test case 1: Fill the caches before the upload
+        self.assertNotIn(b'Picker Newcomer', self.client.get('/analytics/head_to_head').data)
+        players_before = self.client.get('/api/overall').get_json()['total_players']
+
+        # Test case 2: The upload creates players without touching any match
+        data = dict(pre_file=(io.BytesIO(b'Name\nPicker Newcomer\nPicker Rookie\n'), 'picker.csv'))
+        self.client.post('/upload/pre', data=data, follow_redirects=True, content_type='multipart/form-data')
+
+        # Test case 3: The picker lists them and the overall count includes them straight away
+        response = self.client.get('/analytics/head_to_head')
+        self.assertIn(b'Picker Newcomer', response.data)
+        self.assertIn(b'Picker Rookie', response.data)
+        self.assertEqual(self.client.get('/api/overall').get_json()['total_players'], players_before + 2)
+
+    def test_bulk_results_import(self):
+        """Test that a results file is imported with a bounded number of queries and reports bad rows."""
+        from player_stats import check_player_stats, check_rivalry_stats
+        self.login()
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Existing Tournament',
+            'tournament_date': datetime.now().strftime('%Y-%m-%d'),
+            'round[]': ['Final'],
+            'team1[]': ['Player One, Player Two'],
+            'team2[]': ['Player Three, Player Four'],
+            'score1[]': ['21-19, 21-15'],
+            'score2[]': ['19-21, 15-21'],
+            'match_type[]': ["Men's Doubles"]
+        }, follow_redirects=True)
+
+        names = ['Player One', 'Player Two', 'Player Three', 'Player Four'] + ['Import Player %d' % i for i in range(16)]
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['Team 1', 'Team 2', 'Score 1', 'Score 2', 'Round', 'Match Type', 'Tournament', 'Year'])
+        for i in range(300):
+            a, b, c, d = (names[(i + offset) % len(names)] for offset in (0, 1, 2, 3))
+            if i % 2:
+                writer.writerow([a, c, '21-10, 21-12', '10-21, 12-21', 'Round %d' % i, "Men's Singles", 'Bulk Open', '2024'])
+            else:
+                writer.writerow([f'{b}, {a}', f'{c}, {d}', '10-21, 21-12, 19-21', '21-10, 12-21, 21-19',
+                                 'Round %d' % i, "Men's Doubles", 'Bulk Cup', '2023'])
+        writer.writerow(['', 'Player One', '21-10', '10-21', 'Bad', "Men's Singles", 'Bulk Open', '2024'])
+        writer.writerow(['Player One, Player Two', 'Player Two, Player Three', '21-10', '10-21', 'Bad', "Men's Doubles", 'Bulk Open', '2024'])
+        with open(os.path.join(self.app.config['UPLOAD_FOLDER'], '1_bulk.csv'), 'w', newline='') as f:
+            f.write(output.getvalue())
+
+        # Test case 1: The whole file is imported with a handful of queries
+        query_count = self.count_queries('/confirm_results/bulk.csv', method='post', status=302)
+        self.assertLess(query_count, 40)
+
+        with self.app.app_context():
+            self.assertEqual(Match.query.count(), 301)
+            self.assertEqual(Player.query.filter_by(name='Player One').count(), 1)
+            self.assertEqual(Player.query.count(), 20)
+            self.assertEqual(Tournament.query.filter(Tournament.name.in_(['Bulk Open', 'Bulk Cup'])).count(), 2)
+            self.assertEqual(check_player_stats(), [])
+            self.assertEqual(check_rivalry_stats(), [])
+
+            # Existing doubles teams are reused whichever way round the names are given
+            existing = Match.query.filter_by(round_name='Final').first()
+            reused = Match.query.filter_by(round_name='Round 0').first()
+            self.assertEqual(reused.team1_id, existing.team1_id)
+            self.assertEqual(reused.winner_team_id, reused.team2_id)
+            self.assertEqual(len(reused.sets), 3)
+
+            # Every imported match got the sets of its own row
+            for match in Match.query.filter(Match.round_name.like('Round %')):
+                self.assertEqual(', '.join(f'{s.team1_points}-{s.team2_points}' for s in match.sets), match.score1)
+
+        # Test case 2: Bad rows are reported without stopping the import
+        response = self.client.get('/dashboard')
+        self.assertIn(b'Row 302 skipped', response.data)
+        self.assertIn(b'Row 303 skipped', response.data)
+        self.assertIn(b'Successfully imported 300 matches', response.data)
+
+        # Test case 3: A row the database rejects is reported on its own, and the rest of its batch is imported
+        from csv_import import import_results
+        rows = [['Team 1', 'Team 2', 'Score 1', 'Score 2', 'Round', 'Match Type', 'Tournament', 'Year']]
+        rows += [['Player One', 'Player Two', '21-10', '10-21', 'Retry %d' % i, "Men's Singles", 'Retry Open', '2024']
+                 for i in range(9)]
+        rows[5][2] = '99999999999999999999-10'
+        with self.app.app_context():
+            importer = import_results(iter(rows), 1, batch_size=20)
+            self.assertEqual(importer.match_count, 8)
+            self.assertEqual([line for line, message in importer.errors], [6])
+            self.assertEqual(Match.query.filter(Match.round_name.like('Retry %')).count(), 8)
+            self.assertEqual(check_player_stats(), [])
+
+    def test_background_import_job(self):
+        """Test that large result files are imported by a background job that reports progress and can be cancelled."""
+        from jobs import get_job_runner, run_import_job
+        from models import ImportJob
+        self.login()
+        self.app.config['BACKGROUND_IMPORT_MIN_BYTES'] = 0
+
+        def write_file(filename, count):
+            with open(os.path.join(self.app.config['UPLOAD_FOLDER'], filename), 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['Team 1', 'Team 2', 'Score 1', 'Score 2', 'Round', 'Match Type', 'Tournament', 'Year'])
+                for i in range(count):
+                    writer.writerow(['Job A', 'Job B', '21-10', '10-21', 'Round %d' % i, "Men's Singles", 'Job Open', '2024'])
+
+        # Test case 1: Confirming returns straight away with a job to follow
+        write_file('1_job.csv', 30)
+        response = self.client.post('/confirm_results/job.csv')
+        self.assertEqual(response.status_code, 302)
+        job_id = int(response.headers['Location'].rstrip('/').split('/')[-1])
+        get_job_runner(self.app).wait(job_id, timeout=30)
+
+        status = self.client.get(f'/api/imports/{job_id}').get_json()
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['rows_processed'], 30)
+        self.assertEqual(status['match_count'], 30)
+        response = self.client.get(f'/imports/{job_id}')
+        self.assertIn(b'Successfully imported 30 matches', response.data)
+
+        # Test case 2: A cancelled job stops after the batch in progress
+        write_file('cancel.csv', 2500)
+        with self.app.app_context():
+            job = ImportJob(user_id=1, filename='cancel.csv', rows_total=2500, cancel_requested=True)
+            db.session.add(job)
+            db.session.commit()
+            run_import_job(job.id)
+            job = db.session.get(ImportJob, job.id)
+            self.assertEqual(job.status, 'cancelled')
+            self.assertEqual(job.match_count, 1000)
+            self.assertEqual(Match.query.filter_by(round_name='Round 2499').count(), 0)
+
+        # Test case 3: Finished jobs cannot be cancelled and unknown jobs are not found
+        response = self.client.post(f'/api/imports/{job_id}/cancel')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.get('/api/imports/9999').status_code, 404)
+
+        # Test case 4: Another user cannot start an import of this user's upload
+        write_file('1_mine.csv', 5)
+        with self.app.app_context():
+            other = User(username="otheruser", email="other@example.com")
+            other.set_password("password123")
+            db.session.add(other)
+            db.session.commit()
+        self.client.get('/logout')
+        self.client.post('/login', data={'username': 'otheruser', 'password': 'password123'})
+        self.assertEqual(self.client.post('/api/imports', data={'filename': 'mine.csv'}).status_code, 404)
+        self.assertEqual(self.client.post('/api/imports', data={'filename': '1_mine.csv'}).status_code, 404)
+
+        # Test case 5: Only jobs whose runner stopped sending heartbeats are reported as failed
+        from datetime import timedelta
+        with self.app.app_context():
+            stale = ImportJob(user_id=1, filename='1_mine.csv', rows_total=5, status='running',
+                              runner_id='gone', heartbeat_at=datetime.utcnow() - timedelta(hours=1))
+            live = ImportJob(user_id=1, filename='1_other.csv', rows_total=5, status='running',
+                             runner_id='other-worker', heartbeat_at=datetime.utcnow())
+            db.session.add_all([stale, live])
+            db.session.commit()
+            stale_id, live_id = stale.id, live.id
+        self.client.get('/logout')
+        self.login()
+        self.assertEqual(self.client.get(f'/api/imports/{live_id}').get_json()['status'], 'running')
+        result = self.app.test_cli_runner().invoke(args=['tournament', 'recover-imports'])
+        self.assertIn('Marked 1 ', result.output)
+        with self.app.app_context():
+            stale = db.session.get(ImportJob, stale_id)
+            self.assertEqual(stale.status, 'failed')
+            self.assertIn('restart', stale.message)
+            self.assertEqual(db.session.get(ImportJob, live_id).status, 'running')
+
     def test_export_tournament_data(self):
         """Test exporting tournament data and statistics as JSON."""
         # First create tournament data to export
@@ -536,6 +853,681 @@ class BadmintonManagerUnitTestCase(unittest.TestCase):
             player = Player.query.filter_by(name='New Player').first()
             self.assertIsNotNone(player)
 
+    def test_team_pairs_are_unique_and_merged(self):
+        """Test that a pair of players has one team whatever the order, also after merging players."""
+        from sqlalchemy.exc import IntegrityError
+        self.login()
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Team Tournament',
+            'tournament_date': '2025-05-16',
+            'round[]': ['Semi Final', 'Final'],
+            'team1[]': ['Alice, Bob', 'Bob, Alice'],
+            'team2[]': ['Carol, Dave', 'Carol, Alicia'],
+            'score1[]': ['21-15', '21-15'],
+            'score2[]': ['15-21', '15-21'],
+            'match_type[]': ["Mixed Doubles", "Mixed Doubles"]
+        }, follow_redirects=True)
+
+        # Test case 1: Both orders of the same pair share a team, and the index rejects a second one
+        with self.app.app_context():
+            semi = Match.query.filter_by(round_name='Semi Final').first()
+            final = Match.query.filter_by(round_name='Final').first()
+            self.assertEqual(semi.team1_id, final.team1_id)
+
+            team = db.session.get(Team, semi.team1_id)
+            db.session.add(Team(player1_id=team.player2_id, player2_id=team.player1_id))
+            with self.assertRaises(IntegrityError):
+                db.session.flush()
+            db.session.rollback()
+
+            dave = Player.query.filter_by(name='Dave').first().id
+            alicia = Player.query.filter_by(name='Alicia').first().id
+            user = User.query.filter_by(username='testuser').first()
+            user.is_admin = True
+            db.session.commit()
+
+        # Test case 2: Merging Alicia into Dave folds the (Carol, Alicia) team into (Carol, Dave)
+        self.client.post(f'/admin/players/{dave}/merge', data={'merge_with_id': alicia}, follow_redirects=True)
+        with self.app.app_context():
+            semi = Match.query.filter_by(round_name='Semi Final').first()
+            final = Match.query.filter_by(round_name='Final').first()
+            self.assertEqual(semi.team2_id, final.team2_id)
+            self.assertEqual(final.winner_team_id, final.team1_id)
+            self.assertIsNone(db.session.get(Player, alicia))
+            self.assertEqual(Team.query.count(), 2)
+
+        # Test case 3: The merge drops cached ids, so the old name becomes a new player again
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Team Tournament 2',
+            'tournament_date': '2025-05-17',
+            'round[]': ['Final'],
+            'team1[]': ['Alice, Bob'],
+            'team2[]': ['Carol, Alicia'],
+            'score1[]': ['21-15'],
+            'score2[]': ['15-21'],
+            'match_type[]': ["Mixed Doubles"]
+        }, follow_redirects=True)
+        with self.app.app_context():
+            new_alicia = Player.query.filter_by(name='Alicia').first()
+            self.assertIsNotNone(new_alicia)
+            team = Team.query.filter((Team.player1_id == new_alicia.id) | (Team.player2_id == new_alicia.id)).first()
+            self.assertIsNotNone(team)
+
+    def test_overall_analysis_uses_one_cached_query(self):
+        """Test that the overall statistics come from one aggregate query and are cached until matches change."""
+        self.login()
+
+        def submit(team1, team2, count):
+            self.client.post('/submit_results', data={
+                'tournament_name': 'Overall Tournament',
+                'tournament_date': '2025-05-16',
+                'round[]': ['Round %d' % i for i in range(count)],
+                'team1[]': [team1] * count,
+                'team2[]': [team2] * count,
+                'score1[]': ['21-15'] * count,
+                'score2[]': ['15-21'] * count,
+                'match_type[]': ["Men's Singles"] * count
+            }, follow_redirects=True)
+
+        submit('Player Two', 'Player Three', 3)
+        submit('Player Three', 'Player Four', 2)
+
+        # Test case 1: The JSON twin reports the totals and the most active player
+        data = self.client.get('/api/overall').get_json()
+        self.assertEqual(data['total_players'], 4)
+        self.assertEqual(data['total_tournaments'], 3)
+        self.assertEqual(data['total_matches'], 5)
+        self.assertEqual(data['most_popular_player']['name'], 'Player Three')
+        self.assertEqual(data['most_popular_player']['matches_played'], 5)
+        self.assertEqual(data['most_popular_player']['win_percentage'], 40.0)
+
+        # Test case 2: A cached answer only costs the version check, and the page stays within budget
+        self.assertEqual(self.count_queries('/api/overall'), 1)
+        self.assertLessEqual(self.count_queries('/analytics/overall'), 5)
+        response = self.client.get('/analytics/overall')
+        self.assertIn(b'Player Three', response.data)
+        self.assertIn(b'Matches Played: 5', response.data)
+
+        # Test case 3: New matches invalidate the cached statistics
+        submit('Player Two', 'Player One', 4)
+        data = self.client.get('/api/overall').get_json()
+        self.assertEqual(data['total_matches'], 9)
+        self.assertEqual(data['most_popular_player']['name'], 'Player Two')
+
+    def test_analytics_pages_are_cached_until_data_changes(self):
+        """Test that analytics data is served from the response cache and refreshed by match, tournament and share writes."""
+        self.login()
+
+        def submit(name, team1, team2):
+            self.client.post('/submit_results', data={
+                'tournament_name': name,
+                'tournament_date': '2025-05-16',
+                'round[]': ['Final'],
+                'team1[]': [team1],
+                'team2[]': [team2],
+                'score1[]': ['21-15'],
+                'score2[]': ['15-21'],
+                'match_type[]': ["Men's Singles"]
+            }, follow_redirects=True)
+
+        submit('Cached Tournament', 'Player One', 'Player Two')
+        with self.app.app_context():
+            player = Player.query.filter_by(name='Player One').first().id
+            tournament = Tournament.query.filter_by(name='Cached Tournament').first().id
+            other = User(username='otheruser', email='other@example.com')
+            other.set_password('password123')
+            db.session.add(other)
+            db.session.commit()
+            other_id = other.id
+
+        # Test case 1: Repeat views only check the version stamps
+        for url in ['/analytics', f'/analytics/player/{player}', f'/analytics/tournament/{tournament}']:
+            first = self.count_queries(url)
+            self.assertLessEqual(self.count_queries(url), 2)
+            self.assertLess(self.count_queries(url), first)
+        self.assertEqual(self.client.get(f'/api/player/{player}/stats').get_json()['matches'], 1)
+
+        # Test case 2: A match write refreshes the cached statistics
+        submit('Cached Tournament 2', 'Player One', 'Player Three')
+        self.assertEqual(self.client.get(f'/api/player/{player}/stats').get_json()['matches'], 2)
+
+        # Test case 3: Each user has their own entries, and sharing refreshes them
+        self.client.get('/logout', follow_redirects=True)
+        self.client.post('/login', data={'username': 'otheruser', 'password': 'password123'}, follow_redirects=True)
+        self.assertEqual(self.client.get(f'/api/player/{player}/stats').get_json()['matches'], 0)
+        self.client.get('/logout', follow_redirects=True)
+        self.login()
+        self.client.post('/share/create', data={'tournament_id': tournament, 'user_id': other_id}, follow_redirects=True)
+        self.client.get('/logout', follow_redirects=True)
+        self.client.post('/login', data={'username': 'otheruser', 'password': 'password123'}, follow_redirects=True)
+        self.assertEqual(self.client.get(f'/api/player/{player}/stats').get_json()['matches'], 1)
+
+    def test_json_apis_answer_conditional_requests(self):
+        """Test that the stats APIs send ETags, answer If-None-Match with 304 without recomputing, and gzip large bodies."""
+        import gzip
+        import json
+        self.login()
+
+        def submit(name, count):
+            self.client.post('/submit_results', data={
+                'tournament_name': name,
+                'tournament_date': '2025-05-16',
+                'round[]': ['Round %d' % i for i in range(count)],
+                'team1[]': ['Player One'] * count,
+                'team2[]': ['Player Two'] * count,
+                'score1[]': ['21-15'] * count,
+                'score2[]': ['15-21'] * count,
+                'match_type[]': ["Men's Singles"] * count
+            }, follow_redirects=True)
+
+        submit('ETag Tournament', 30)
+        with self.app.app_context():
+            player = Player.query.filter_by(name='Player One').first().id
+            tournament = Tournament.query.filter_by(name='ETag Tournament').first().id
+
+        # Test case 1: A matching ETag gets an empty 304 after only the version check
+        url = f'/api/player/{player}/stats'
+        response = self.client.get(url)
+        etag = response.headers['ETag']
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        # The identity version, the player's tournament stamps and their rating
+        self.assertEqual(self.count_queries(url, status=304, headers={'If-None-Match': etag}), 3)
+
+        # Test case 2: Large bodies are gzipped for clients that accept it, under their own ETag
+        url = f'/api/matches/{tournament}'
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(json.loads(gzip.decompress(response.data))), 30)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        gzip_etag = response.headers['ETag']
+        self.assertNotEqual(gzip_etag, self.client.get(url).headers['ETag'])
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': gzip_etag})
+        self.assertEqual(response.status_code, 304)
+
+        # Test case 3: A match write changes the ETag
+        submit('ETag Tournament 2', 1)
+        response = self.client.get(f'/api/player/{player}/stats', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['matches'], 31)
+
+        # Test case 4: Writes to tournaments a response does not cover leave its ETag alone
+        tournament_url = f'/api/tournament/{tournament}/stats'
+        etags = {url: self.client.get(url).headers['ETag'] for url in (f'/api/player/{player}/stats', tournament_url)}
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Other Tournament',
+            'tournament_date': '2025-05-17',
+            'round[]': ['Final'],
+            'team1[]': ['Player Three'],
+            'team2[]': ['Player Four'],
+            'score1[]': ['21-15'],
+            'score2[]': ['15-21'],
+            'match_type[]': ["Men's Singles"]
+        }, follow_redirects=True)
+        for url, etag in etags.items():
+            self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        submit('ETag Tournament 3', 1)
+        self.assertEqual(self.client.get(tournament_url, headers={'If-None-Match': etags[tournament_url]}).status_code, 304)
+        self.assertEqual(self.client.get(f'/api/player/{player}/stats',
+                                         headers={'If-None-Match': etags[f'/api/player/{player}/stats']}).status_code, 200)
+
+        # Test case 5: Unknown players get a 404 without an ETag
+        response = self.client.get('/api/player/99999/stats')
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('ETag', response.headers)
+
+    def test_requests_are_profiled_when_enabled(self):
+        """Test that opt-in profiling records per-endpoint percentiles and logs requests over the thresholds."""
+        from profiling import fingerprint, get_profile_store
+        with self.app.app_context():
+            user = User.query.filter_by(username='testuser').first()
+            user.is_admin = True
+            db.session.commit()
+        self.login()
+
+        # Test case 1: Nothing is recorded while profiling is off
+        self.client.get('/matches')
+        self.assertEqual(get_profile_store(self.app).summary(), ([], []))
+
+        # Test case 2: Each endpoint gets query, SQL time and wall time percentiles
+        self.app.config['SQL_PROFILING'] = True
+        self.app.config['SQL_PROFILE_MAX_QUERIES'] = 0
+        self.client.get('/matches')
+        self.client.get('/matches?player_name=Player')
+        endpoints, slow_requests = get_profile_store(self.app).summary()
+        matches = next(row for row in endpoints if row['endpoint'] == 'match.view_matches')
+        self.assertEqual(matches['requests'], 2)
+        self.assertGreater(matches['queries_p50'], 0)
+        self.assertLessEqual(matches['queries_p50'], matches['queries_p99'])
+
+        # Test case 3: Requests over the query threshold keep their statement fingerprints
+        self.assertEqual(slow_requests[0]['path'], '/matches?player_name=Player')
+        self.assertEqual(len(slow_requests), 2)
+        self.assertTrue(all(item['count'] > 0 and 'SELECT' in item['statement'] for item in slow_requests[0]['statements']))
+        self.assertEqual(fingerprint("SELECT * FROM match WHERE id IN (?, ?, ?) AND name = 'A''s' LIMIT 10"),
+                         "SELECT * FROM match WHERE id IN (?+) AND name = ? LIMIT ?")
+        response = self.client.get('/admin/performance')
+        self.assertIn(b'match.view_matches', response.data)
+
+    def test_admins_can_profile_single_requests(self):
+        """Test that ?__profile=1 stores a cProfile report and collapsed stacks for admins only."""
+        from profiling import get_profile_reports
+        self.login()
+
+        # Test case 1: The flag is ignored for users who are not admins
+        response = self.client.get('/analytics/overall?__profile=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile-Id', response.headers)
+        self.assertEqual(get_profile_reports(self.app).recent(), [])
+
+        # Test case 2: An admin's request is profiled and its report kept
+        with self.app.app_context():
+            user = User.query.filter_by(username='testuser').first()
+            user.is_admin = True
+            db.session.commit()
+        response = self.client.get('/analytics/overall?__profile=1')
+        self.assertEqual(response.status_code, 200)
+        report_id = int(response.headers['X-Profile-Id'])
+        self.client.get('/matches', headers={'X-Profile': '1'})
+        reports = get_profile_reports(self.app).recent()
+        self.assertEqual([report['endpoint'] for report in reports], ['match.view_matches', 'analytics.overall_analysis'])
+        self.assertIn('overall_analysis', reports[1]['stats'])
+
+        # Test case 3: The admin pages list the profiles and serve the collapsed stacks
+        self.assertIn(b'/analytics/overall?__profile=1', self.client.get('/admin/profiles').data)
+        self.assertIn(b'cumulative', self.client.get(f'/admin/profiles/{report_id}').data)
+        response = self.client.get(f'/admin/profiles/{report_id}/collapsed')
+        self.assertEqual(response.status_code, 200)
+        for line in response.get_data(as_text=True).splitlines():
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(count.isdigit())
+        self.assertEqual(self.client.get('/admin/profiles/999').status_code, 404)
+
+    def test_identical_computations_are_coalesced(self):
+        """Test that concurrent callers of one computation share a single run, and that metrics count them."""
+        import threading
+        import time
+        from response_cache import SingleFlight, MemoryStore, ResponseCache
+        flights = SingleFlight(wait_seconds=5)
+        release = threading.Event()
+        runs = []
+
+        def compute():
+            runs.append(1)
+            release.wait(5)
+            return {'players': len(runs)}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flights.do('dashboard', compute))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while flights.coalesced < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        # Test case 1: One run served all five callers
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(results, [{'players': 1}] * 5)
+        self.assertEqual((flights.computed, flights.coalesced, flights.in_flight()), (1, 4, 0))
+
+        # Test case 2: Errors reach the waiting callers too, and the key can be computed again afterwards
+        def fail():
+            raise ValueError("no data")
+        self.assertRaises(ValueError, flights.do, 'dashboard', fail)
+        self.assertEqual(flights.do('dashboard', lambda: 'again'), 'again')
+
+        # Test case 3: The response cache reports hits, misses and coalesced callers
+        cache = ResponseCache(MemoryStore(10), ttl=60)
+        with self.app.test_request_context():
+            cache.get_or_compute('overall', lambda: 1)
+            cache.get_or_compute('overall', lambda: 2)
+        self.assertEqual(cache.metrics(), {'hits': 1, 'misses': 1, 'computed': 1, 'coalesced': 0, 'in_flight': 0})
+
+    def test_metrics_endpoint_exposes_prometheus_text(self):
+        """Test that /metrics reports request latency, SQL statements, imports and cache ratios."""
+        from metrics import Histogram, record_import
+        self.login()
+        self.client.get('/matches')
+        self.client.get('/api/overall')
+        self.client.get('/api/overall')
+        with self.app.app_context():
+            record_import(rows=200, matches=180, seconds=0.5)
+
+        # Test case 1: Without a token only admins can read the metrics
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with self.app.app_context():
+            user = User.query.filter_by(username='testuser').first()
+            user.is_admin = True
+            db.session.commit()
+
+        # Test case 2: Latency histograms and query counts are kept per blueprint and endpoint
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain; version=0.0.4'))
+        text = response.get_data(as_text=True)
+        labels = 'blueprint="match",endpoint="match.view_matches",method="GET"'
+        self.assertIn('badminton_request_duration_seconds_count{%s} 1' % labels, text)
+        self.assertIn('badminton_request_duration_seconds_bucket{%s,le="+Inf"} 1' % labels, text)
+        self.assertIn('badminton_requests_total{%s,status="200"} 1' % labels, text)
+        self.assertIn('badminton_request_sql_statements_count{%s} 1' % labels, text)
+        self.assertIn('badminton_sql_statements_total{blueprint="match"}', text)
+        self.assertIn('badminton_requests_in_flight 1', text)
+
+        # Test case 3: Imports and cache hit ratios are exported
+        self.assertIn('badminton_import_rows_total 200', text)
+        self.assertIn('badminton_import_rows_per_second 400.0', text)
+        self.assertIn('badminton_cache_hits_total{cache="analytics"} 1', text)
+        self.assertIn('badminton_cache_hit_ratio{cache="analytics"} 0.5', text)
+
+        # Test case 4: Buckets are cumulative and values equal to a bound fall in its bucket
+        histogram = Histogram('latency', 'Latency', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        self.assertEqual(histogram.expose()[2:], [
+            'latency_bucket{le="0.1"} 2', 'latency_bucket{le="1"} 3', 'latency_bucket{le="+Inf"} 4',
+            'latency_sum 3.65', 'latency_count 4'
+        ])
+
+        # Test case 5: A configured token is required
+        self.app.config['METRICS_TOKEN'] = 'scrape-secret'
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer scrape-secret'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_response_cache_file_store(self):
+        """Test that the file-backed store keeps, expires and evicts entries."""
+        import tempfile
+        import time
+        from response_cache import FileStore
+        with tempfile.TemporaryDirectory() as directory:
+            store = FileStore(directory, max_entries=2)
+            store.set('a', {'value': 1}, ttl=60)
+            self.assertEqual(store.get('a'), {'value': 1})
+            store.set('b', 2, ttl=-1)
+            self.assertIsNone(store.get('b'))
+            time.sleep(0.01)
+            store.set('c', 3, ttl=60)
+            time.sleep(0.01)
+            store.set('d', 4, ttl=60)
+            self.assertEqual(len(os.listdir(directory)), 2)
+            self.assertEqual(store.get('d'), 4)
+
+    def test_shared_tournaments_are_visible_read_only(self):
+        """Test that shared tournaments appear in the match listing and charts, read-only, until they are unshared."""
+        self.login()
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Visible Tournament',
+            'tournament_date': '2025-05-16',
+            'round[]': ['Final'],
+            'team1[]': ['Player One'],
+            'team2[]': ['Player Two'],
+            'score1[]': ['21-15'],
+            'score2[]': ['15-21'],
+            'match_type[]': ["Men's Singles"]
+        }, follow_redirects=True)
+        with self.app.app_context():
+            tournament = Tournament.query.filter_by(name='Visible Tournament').first().id
+            match_id = Match.query.filter_by(tournament_id=tournament).first().id
+            other = User(username='otheruser', email='other@example.com')
+            other.set_password('password123')
+            db.session.add(other)
+            db.session.commit()
+            other_id = other.id
+
+        def as_other(f):
+            self.client.get('/logout', follow_redirects=True)
+            self.client.post('/login', data={'username': 'otheruser', 'password': 'password123'}, follow_redirects=True)
+            result = f()
+            self.client.get('/logout', follow_redirects=True)
+            self.login()
+            return result
+
+        # Test case 1: Nothing is visible before sharing
+        self.assertEqual(as_other(lambda: self.client.get('/api/matches').get_json()['matches']), [])
+
+        # Test case 2: Shared matches are listed but cannot be edited
+        self.client.post('/share/create', data={'tournament_id': tournament, 'user_id': other_id}, follow_redirects=True)
+        matches = as_other(lambda: self.client.get('/api/matches').get_json()['matches'])
+        self.assertEqual([(row['id'], row['editable']) for row in matches], [(match_id, False)])
+        self.assertTrue(self.client.get('/api/matches').get_json()['matches'][0]['editable'])
+        as_other(lambda: self.client.post(f'/matches/{match_id}/delete', follow_redirects=True))
+        with self.app.app_context():
+            self.assertIsNotNone(db.session.get(Match, match_id))
+
+        # Test case 3: The distribution chart counts shared matches, and unsharing hides them again
+        from routes.analytics import get_match_distribution_by_type
+        with self.app.test_request_context():
+            self.assertEqual(get_match_distribution_by_type(other_id)['data'], [1])
+        self.client.post('/share/delete', data={'tournament_id': tournament, 'user_id': other_id}, follow_redirects=True)
+        self.assertEqual(as_other(lambda: self.client.get('/api/matches').get_json()['matches']), [])
+
+        # Test case 4: The visibility filter binds the user id only, whatever the number of tournaments
+        from visibility import visible_to
+        with self.app.app_context():
+            for index in range(5):
+                db.session.add(Tournament(name=f'Extra {index}', date=datetime.now().date(), user_id=other_id))
+            db.session.commit()
+            predicate = visible_to(Match.tournament_id, other_id).compile()
+        self.assertEqual(list(predicate.params.values()), [other_id, other_id])
+
+    def test_tournament_stats_are_computed_in_grouped_queries(self):
+        """Test that every tournament's statistics come from the same few queries, however many tournaments there are."""
+        from sqlalchemy import event
+        from routes.analytics import get_tournament_stats
+        self.login()
+
+        def submit(name, count):
+            self.client.post('/submit_results', data={
+                'tournament_name': name,
+                'tournament_date': '2025-05-16',
+                'round[]': ['Group'] * (count - 1) + ['Final'],
+                'team1[]': ['Player One'] * (count - 1) + ['Player Three, Player One'],
+                'team2[]': ['Player Two'] * (count - 1) + ['Player Four, Player Two'],
+                'score1[]': ['21-15'] * (count - 1) + ['21-19, 19-21, 21-18'],
+                'score2[]': ['15-21'] * (count - 1) + ['19-21, 21-19, 18-21'],
+                'match_type[]': ["Men's Singles"] * (count - 1) + ["Men's Doubles"]
+            }, follow_redirects=True)
+
+        def stats_and_queries():
+            statements = []
+            record = lambda conn, cursor, statement, *args: statements.append(statement)
+            with self.app.test_request_context():
+                event.listen(db.engine, 'before_cursor_execute', record)
+                try:
+                    stats = get_tournament_stats(user_id=1)
+                finally:
+                    event.remove(db.engine, 'before_cursor_execute', record)
+            return stats, len(statements)
+
+        submit('Grouped Tournament 1', 3)
+        _, few_queries = stats_and_queries()
+        for number in range(2, 6):
+            submit(f'Grouped Tournament {number}', number + 1)
+
+        # Test case 1: More tournaments do not mean more queries
+        stats, many_queries = stats_and_queries()
+        self.assertEqual(many_queries, few_queries)
+
+        # Test case 2: Counts, rounds, players and extreme matches are filled in per tournament
+        stats = {tournament['name']: tournament for tournament in stats}
+        grouped = stats['Grouped Tournament 5']
+        self.assertEqual(grouped['match_count'], 6)
+        self.assertEqual(grouped['match_types'], {"Men's Singles": 5, "Men's Doubles": 1})
+        self.assertEqual(grouped['rounds'], {'Group': 5, 'Final': 1})
+        self.assertEqual([player['name'] for player in grouped['players']],
+                         ['Player Four', 'Player One', 'Player Three', 'Player Two'])
+        self.assertEqual(grouped['player_count'], 4)
+        self.assertEqual(grouped['longest_match']['sets'], 3)
+        self.assertEqual(grouped['highest_score']['team1'], 'Player Three, Player One')
+        self.assertEqual(stats['Test Tournament']['match_count'], 0)
+
+    def test_ratings_follow_match_writes_incrementally(self):
+        """Test that Elo ratings are updated on every write, replaying only from the changed match on."""
+        from models import PlayerRating, TeamRating, RatingHistory
+        from ratings import replay_ratings
+        self.login()
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Rated Tournament',
+            'tournament_date': '2025-05-16',
+            'round[]': ['Round 1', 'Round 2', 'Round 3', 'Final'],
+            'team1[]': ['Player One', 'Player One', 'Player Three', 'Player One, Player Two'],
+            'team2[]': ['Player Two', 'Player Three', 'Player Two', 'Player Three, Player Four'],
+            'score1[]': ['21-15', '21-15', '15-21', '21-15'],
+            'score2[]': ['15-21', '15-21', '21-15', '15-21'],
+            'match_type[]': ["Men's Singles"] * 3 + ["Men's Doubles"]
+        }, follow_redirects=True)
+
+        def ratings():
+            return (
+                {row.player_id: (round(row.rating, 6), row.matches) for row in PlayerRating.query},
+                {row.team_id: (round(row.rating, 6), row.matches) for row in TeamRating.query},
+                sorted((row.match_id, row.player_id or 0, row.team_id or 0, round(row.rating, 6)) for row in RatingHistory.query)
+            )
+
+        def assert_matches_full_replay():
+            with self.app.app_context():
+                incremental = ratings()
+                replay_ratings()
+                self.assertEqual(incremental, ratings())
+                db.session.rollback()
+
+        # Test case 1: Winners gain what losers lose, and doubles pairs get their own rating
+        with self.app.app_context():
+            players = {player.name: player.id for player in Player.query}
+            matches = {match.round_name: match.id for match in Match.query}
+            tournament_id = Tournament.query.filter_by(name='Rated Tournament').first().id
+            player_ratings, team_ratings, history = ratings()
+            self.assertGreater(player_ratings[players['Player One']][0], 1500)
+            self.assertEqual(player_ratings[players['Player One']][1], 3)
+            self.assertEqual(len(team_ratings), 2)
+            self.assertEqual(len(history), 12)
+        assert_matches_full_replay()
+        self.assertEqual(self.client.get('/api/ratings').get_json()['ratings'][0]['name'], 'Player One')
+        self.assertEqual(len(self.client.get(f"/api/player/{players['Player One']}/ratings").get_json()['history']), 3)
+
+        # Test case 2: Editing a past match replays it and the later matches only
+        from sqlalchemy import event
+        inserted = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT INTO rating_history'):
+                inserted.extend(parameters if executemany else [parameters])
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record)
+        self.client.post(f"/matches/{matches['Round 2']}/update", data={
+            'tournament_id': tournament_id,
+            'round_name': 'Round 2',
+            'team1': 'Player One',
+            'team2': 'Player Three',
+            'score1': '15-21',
+            'score2': '21-15',
+            'match_type': "Men's Singles"
+        }, follow_redirects=True)
+        event.remove(engine, 'before_cursor_execute', record)
+        self.assertEqual(len(inserted), 10)
+        with self.app.app_context():
+            self.assertLess(RatingHistory.query.filter_by(
+                match_id=matches['Round 2'], player_id=players['Player One']
+            ).one().change, 0)
+        assert_matches_full_replay()
+
+        # Test case 3: Deleting a match takes it out of everyone's rating
+        self.client.post(f"/matches/{matches['Round 3']}/delete", follow_redirects=True)
+        with self.app.app_context():
+            self.assertEqual(PlayerRating.query.get(players['Player Three']).matches, 2)
+            self.assertFalse(RatingHistory.query.filter_by(match_id=matches['Round 3']).count())
+        assert_matches_full_replay()
+
+        # Test case 4: Merging players replays from the earliest match of either of them, not from the start
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Rated Tournament 2',
+            'tournament_date': '2025-05-17',
+            'round[]': ['Final'],
+            'team1[]': ['Player 4'],
+            'team2[]': ['Player Three'],
+            'score1[]': ['21-15'],
+            'score2[]': ['15-21'],
+            'match_type[]': ["Men's Singles"]
+        }, follow_redirects=True)
+        with self.app.app_context():
+            User.query.filter_by(username='testuser').first().is_admin = True
+            db.session.commit()
+            duplicate = Player.query.filter_by(name='Player 4').first().id
+        inserted.clear()
+        event.listen(engine, 'before_cursor_execute', record)
+        self.client.post(f"/admin/players/{players['Player Four']}/merge", data={'merge_with_id': duplicate},
+                         follow_redirects=True)
+        event.remove(engine, 'before_cursor_execute', record)
+        # The doubles final (four players and two pairs) and the new match; the singles rounds before it are kept
+        self.assertEqual(len(inserted), 8)
+        with self.app.app_context():
+            self.assertEqual(PlayerRating.query.get(players['Player Four']).matches, 2)
+            self.assertIsNone(PlayerRating.query.get(duplicate))
+        assert_matches_full_replay()
+
+    def test_identity_map_resolves_names_once(self):
+        """Test that player and team ids are cached by normalized name and reused by later submissions."""
+        from sqlalchemy import event
+        self.login()
+
+        def submit(team1, team2, count=1):
+            self.client.post('/submit_results', data={
+                'tournament_name': 'Identity Tournament',
+                'tournament_date': '2025-05-16',
+                'round[]': ['Round %d' % i for i in range(count)],
+                'team1[]': [team1] * count,
+                'team2[]': [team2] * count,
+                'score1[]': ['21-15'] * count,
+                'score2[]': ['15-21'] * count,
+                'match_type[]': ["Men's Doubles"] * count
+            }, follow_redirects=True)
+
+        # Test case 1: The first submission fills the map once it commits
+        submit('Player One, Player Two', 'Player Three, Player Four')
+        identities = self.app.extensions['identity_map']
+        self.assertEqual(set(identities.player_ids),
+                         {'Player One', 'Player Two', 'Player Three', 'Player Four'})
+        self.assertEqual(len(identities.team_ids), 2)
+
+        # Test case 2: Later submissions with differently spaced names skip the name and team lookups
+        statements = []
+        with self.app.app_context():
+            engine = db.engine
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            submit(' Player  One ,Player Two', 'Player Four, Player Three', count=5)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        self.assertFalse([s for s in statements if 'player.name IN' in s or 'INSERT INTO team (' in s])
+        with self.app.app_context():
+            self.assertEqual(Player.query.count(), 4)
+            self.assertEqual(Team.query.count(), 2)
+            self.assertEqual(Match.query.count(), 6)
+
+        # Test case 3: Names saved with irregular whitespace are normalized, and then found by later submissions
+        from identity_map import normalize_stored_names
+        from analytics_engine import get_snapshot
+        with self.app.app_context():
+            db.session.add(Player(name=' John  Smith\t'))
+            db.session.commit()
+            self.assertIn(' John  Smith\t', get_snapshot().player_names)
+            self.assertEqual(normalize_stored_names(batch_size=2), 1)
+            db.session.commit()
+            self.assertEqual(Player.query.filter_by(name='John Smith').count(), 1)
+            # The analytics snapshot picks up the rewritten name without waiting for a match write
+            self.assertIn('John Smith', get_snapshot().player_names)
+        submit('John Smith', 'Player Three')
+        with self.app.app_context():
+            self.assertEqual(Player.query.count(), 5)
+
     def test_player_duplicate_check(self):
         """Test that duplicate player names are handled gracefully (no duplicate records)."""
         self.login()
@@ -567,6 +1559,177 @@ class BadmintonManagerUnitTestCase(unittest.TestCase):
             players = Player.query.filter_by(name='Duplicate Player').all()
             self.assertEqual(len(players), 1)
 
+    def test_player_search_index_follows_player_writes(self):
+        """Test that typeahead and duplicate lookups use the name index and see inserts, merges and deletes."""
+        self.login()
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Search Tournament',
+            'tournament_date': '2025-05-16',
+            'round[]': ['Final', 'Semi Final'],
+            'team1[]': ['Lee Chong Wei', 'Lee Chong-Wei'],
+            'team2[]': ['Lin Dan', 'Chen Long'],
+            'score1[]': ['21-15', '21-15'],
+            'score2[]': ['15-21', '15-21'],
+            'match_type[]': ["Men's Singles", "Men's Singles"]
+        }, follow_redirects=True)
+
+        def names(query):
+            return [player['name'] for player in self.client.get('/api/players/search?q=' + query).get_json()['players']]
+
+        # Test case 1: Names starting with the text come first, then names containing it
+        self.assertEqual(names('Lee'), ['Lee Chong Wei', 'Lee Chong-Wei'])
+        self.assertEqual(names('long'), ['Chen Long'])
+        self.assertEqual(names('Li'), ['Lin Dan'])
+        self.assertEqual(names('xyz'), [])
+
+        # Test case 2: Short prefixes match regardless of case
+        self.assertEqual(names('li'), ['Lin Dan'])
+        self.assertEqual(names('l'), ['Lee Chong Wei', 'Lee Chong-Wei', 'Lin Dan'])
+        self.assertEqual(names('cH'), ['Chen Long'])
+
+        # Test case 3: The nearest name is ranked first among possible duplicates
+        from player_search import similar_players
+        with self.app.app_context():
+            user = User.query.filter_by(username='testuser').first()
+            user.is_admin = True
+            db.session.commit()
+            player = Player.query.filter_by(name='Lee Chong Wei').first().id
+            duplicate = Player.query.filter_by(name='Lee Chong-Wei').first().id
+            similar = similar_players('Lee Chong Wei', exclude_id=player)
+            self.assertEqual(similar[0]['id'], duplicate)
+            self.assertNotIn('Lin Dan', [candidate['name'] for candidate in similar])
+
+        response = self.client.get(f'/admin/players/{player}/merge')
+        self.assertIn(b'Lee Chong-Wei', response.data)
+        self.assertNotIn(b'High', response.data)
+
+        # Test case 4: Merged away and new players leave and join the index
+        self.client.post(f'/admin/players/{player}/merge', data={'merge_with_id': duplicate}, follow_redirects=True)
+        self.assertEqual(names('Chong'), ['Lee Chong Wei'])
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Search Tournament 2',
+            'tournament_date': '2025-05-17',
+            'round[]': ['Final'],
+            'team1[]': ['Viktor Axelsen'],
+            'team2[]': ['Chen Long'],
+            'score1[]': ['21-15'],
+            'score2[]': ['15-21'],
+            'match_type[]': ["Men's Singles"]
+        }, follow_redirects=True)
+        self.assertEqual(names('axel'), ['Viktor Axelsen'])
+
+    def test_duplicate_players_are_clustered_and_merged_in_bulk(self):
+        """Test that likely duplicates are grouped, players who met are kept apart, and groups merge in one go."""
+        from player_stats import check_player_stats, check_rivalry_stats
+        self.login()
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Duplicate Tournament',
+            'tournament_date': '2025-05-16',
+            'round[]': ['R1', 'R2', 'R3', 'R4', 'R5'],
+            'team1[]': ['Lee Chong Wei, Tan Boon Heong', 'Lee Chong-Wei, Tan Boon Heong', 'lee chong wei',
+                        'Lee Chong Wei', 'Lin Dan'],
+            'team2[]': ['Lin Dan, Cai Yun', 'Lin Dan, Cai Yun', 'Cai Yun', 'Cai Yun', 'Lin Dann'],
+            'score1[]': ['21-15', '15-21', '21-15', '21-15', '21-15'],
+            'score2[]': ['15-21', '21-15', '15-21', '15-21', '15-21'],
+            'match_type[]': ["Men's Doubles", "Men's Doubles", "Men's Singles", "Men's Singles", "Men's Singles"]
+        }, follow_redirects=True)
+
+        with self.app.app_context():
+            user = User.query.filter_by(username='testuser').first()
+            user.is_admin = True
+            db.session.commit()
+            ids = {player.name: player.id for player in Player.query.all()}
+
+        # Test case 1: The spellings of Lee Chong Wei form one cluster; Lin Dan and Lin Dann met, so they do not
+        from player_merge import find_duplicate_clusters
+        with self.app.app_context():
+            clusters = find_duplicate_clusters()
+            self.assertEqual(len(clusters), 1)
+            self.assertEqual(clusters[0]['keep']['name'], 'Lee Chong Wei')
+            self.assertEqual({duplicate['name'] for duplicate in clusters[0]['duplicates']},
+                             {'Lee Chong-Wei', 'lee chong wei'})
+        response = self.client.get('/admin/players/duplicates')
+        self.assertIn(b'Lee Chong-Wei', response.data)
+
+        # Test case 2: Merging the cluster rewrites teams and matches and folds the duplicate doubles team
+        keep = ids['Lee Chong Wei']
+        self.client.post('/admin/players/duplicates', data={
+            'merge': ['%d:%d' % (keep, ids['Lee Chong-Wei']), '%d:%d' % (keep, ids['lee chong wei'])]
+        }, follow_redirects=True)
+        with self.app.app_context():
+            self.assertIsNone(db.session.get(Player, ids['Lee Chong-Wei']))
+            self.assertIsNone(db.session.get(Player, ids['lee chong wei']))
+            r1 = Match.query.filter_by(round_name='R1').first()
+            r2 = Match.query.filter_by(round_name='R2').first()
+            self.assertEqual(r1.team1_id, r2.team1_id)
+            self.assertEqual(r2.winner_team_id, r2.team2_id)
+            self.assertEqual(Team.query.filter((Team.player1_id == keep) | (Team.player2_id == keep)).count(), 2)
+            self.assertEqual(check_player_stats(), [])
+            self.assertEqual(check_rivalry_stats(), [])
+            self.assertEqual(find_duplicate_clusters(), [])
+
+        # Test case 3: Players who faced each other are not merged
+        response = self.client.post(f"/admin/players/{ids['Lin Dan']}/merge",
+                                    data={'merge_with_id': ids['Lin Dann']}, follow_redirects=True)
+        self.assertIn(b'have played with or against each other', response.data)
+        with self.app.app_context():
+            self.assertIsNotNone(db.session.get(Player, ids['Lin Dann']))
+
+    def test_maintenance_cleanup_is_set_based(self):
+        """Test that maintenance counts unused rows, dry runs change nothing, and chunked cleanups delete them all."""
+        from models import SharedTournament
+        from maintenance import maintenance_counts
+        self.login()
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Kept Tournament',
+            'tournament_date': '2025-05-16',
+            'round[]': ['Final'],
+            'team1[]': ['Player One'],
+            'team2[]': ['Player Two'],
+            'score1[]': ['21-15'],
+            'score2[]': ['15-21'],
+            'match_type[]': ["Men's Singles"]
+        }, follow_redirects=True)
+        with self.app.app_context():
+            user = User.query.filter_by(username='testuser').first()
+            user.is_admin = True
+            players = [Player(name='Unused %d' % i) for i in range(5)]
+            db.session.add_all(players)
+            db.session.flush()
+            db.session.add_all([Team(player1_id=players[i].id, player2_id=players[i + 1].id) for i in range(0, 4, 2)])
+            empty = Tournament(name='Empty', date=datetime(2025, 5, 1).date(), user_id=user.id)
+            db.session.add(empty)
+            db.session.flush()
+            db.session.add(SharedTournament(tournament_id=empty.id, owner_id=user.id, shared_with_id=user.id))
+            db.session.commit()
+
+            # Test case 1: The page counts come from one statement
+            self.assertEqual(maintenance_counts(), {
+                'orphaned_teams': 2, 'inactive_players': 3, 'empty_tournaments': 2, 'users_without_tournaments': 0
+            })
+        response = self.client.get('/admin/maintenance')
+        self.assertIn(b'Delete 2 Orphaned Teams', response.data)
+
+        # Test case 2: A dry run only counts
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['admin', 'cleanup', 'orphaned_teams', '--dry-run'])
+        self.assertIn('2 orphaned teams would be deleted', result.output)
+        with self.app.app_context():
+            self.assertEqual(Team.query.count(), 4)
+
+        # Test case 3: Cleanups delete every unused row in chunks and leave used ones alone
+        result = runner.invoke(args=['admin', 'cleanup', 'orphaned_teams', '--chunk-size', '1'])
+        self.assertIn('Deleted 2 orphaned teams', result.output)
+        self.client.post('/admin/maintenance/cleanup', data={'action': 'inactive_players'}, follow_redirects=True)
+        response = self.client.post('/admin/maintenance/cleanup', data={'action': 'empty_tournaments'},
+                                    follow_redirects=True)
+        self.assertIn(b'Deleted 2 empty tournaments', response.data)
+        with self.app.app_context():
+            self.assertEqual(Team.query.count(), 2)
+            self.assertEqual(Player.query.count(), 2)
+            self.assertEqual([tournament.name for tournament in Tournament.query.all()], ['Kept Tournament'])
+            self.assertEqual(SharedTournament.query.count(), 0)
+
     def test_team_creation(self):
         """Test that singles and doubles teams are created correctly."""
         self.login()
@@ -634,6 +1797,250 @@ class BadmintonManagerUnitTestCase(unittest.TestCase):
 
         self.assertIn(b'Tournament shared with recipient successfully!', response.data)
 
+    # -------------------- Analytics --------------------
+
+    def test_player_stats_table_tracks_match_writes(self):
+        """Test that the player statistics table follows match inserts, updates and deletes."""
+        from player_stats import check_player_stats, check_rivalry_stats
+        self.login()
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Stats Tournament',
+            'tournament_date': datetime.now().strftime('%Y-%m-%d'),
+            'round[]': ['Semi Final', 'Final'],
+            'team1[]': ['Player One', 'Player One'],
+            'team2[]': ['Player Two', 'Player Three'],
+            'score1[]': ['21-19, 21-15', '15-21, 18-21'],
+            'score2[]': ['19-21, 15-21', '21-15, 21-18'],
+            'match_type[]': ["Men's Singles", "Men's Singles"]
+        }, follow_redirects=True)
+
+        # Test case 1: Stats are aggregated when matches are submitted
+        with self.app.app_context():
+            player_id = Player.query.filter_by(name='Player One').first().id
+            match_id = Match.query.filter_by(round_name='Final').first().id
+            tournament_id = Match.query.get(match_id).tournament_id
+            self.assertEqual(check_player_stats(), [])
+            self.assertEqual(check_rivalry_stats(), [])
+
+        stats = self.client.get(f'/api/player/{player_id}/stats').get_json()
+        self.assertEqual(stats['matches'], 2)
+        self.assertEqual(stats['wins'], 1)
+        self.assertEqual(stats['points_scored'], 42 + 33)
+        self.assertEqual(stats['match_types']["Men's Singles"]['matches'], 2)
+
+        # Test case 2: Updating a match moves its contribution
+        self.client.post(f'/matches/{match_id}/update', data={
+            'tournament_id': tournament_id,
+            'round_name': 'Final',
+            'team1': 'Player One',
+            'team2': 'Player Three',
+            'score1': '21-15, 21-18',
+            'score2': '15-21, 18-21',
+            'match_type': "Men's Singles"
+        }, follow_redirects=True)
+        stats = self.client.get(f'/api/player/{player_id}/stats').get_json()
+        self.assertEqual(stats['wins'], 2)
+        self.assertEqual(stats['losses'], 0)
+
+        # Test case 3: Deleting a match removes it from the aggregates
+        self.client.post(f'/matches/{match_id}/delete', follow_redirects=True)
+        stats = self.client.get(f'/api/player/{player_id}/stats').get_json()
+        self.assertEqual(stats['matches'], 1)
+        with self.app.app_context():
+            self.assertEqual(check_player_stats(), [])
+            self.assertEqual(check_rivalry_stats(), [])
+
+    def test_match_listing_query_count_is_bounded(self):
+        """Test that match listings load teams and players without a query per row."""
+        self.login()
+        names = ['Player One', 'Player Two', 'Player Three', 'Player Four']
+
+        def submit(count):
+            self.client.post('/submit_results', data={
+                'tournament_name': 'Query Count Tournament',
+                'tournament_date': datetime.now().strftime('%Y-%m-%d'),
+                'round[]': ['Round %d' % i for i in range(count)],
+                'team1[]': ['%s, %s' % (names[0], names[1])] * count,
+                'team2[]': ['%s, %s' % (names[2], names[3])] * count,
+                'score1[]': ['21-19, 21-15'] * count,
+                'score2[]': ['19-21, 15-21'] * count,
+                'match_type[]': ["Men's Doubles"] * count
+            }, follow_redirects=True)
+
+        # Test case 1: A handful of matches
+        submit(3)
+        small_counts = [self.count_queries('/matches'), self.count_queries('/dashboard')]
+        with self.app.app_context():
+            tournament_id = Tournament.query.filter_by(name='Query Count Tournament').first().id
+        small_counts.append(self.count_queries(f'/api/matches/{tournament_id}'))
+
+        # Test case 2: Many more matches issue the same number of queries
+        submit(30)
+        large_counts = [
+            self.count_queries('/matches'),
+            self.count_queries('/dashboard'),
+            self.count_queries(f'/api/matches/{tournament_id}')
+        ]
+        self.assertEqual(small_counts, large_counts)
+
+        # Test case 3: The listing stays within a small fixed budget
+        self.assertLessEqual(large_counts[0], 5)
+
+    def test_match_listing_is_keyset_paged_and_filtered(self):
+        """Test that the match listing pages by cursor and applies its filters in SQL."""
+        self.login()
+        count = 60
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Paged Tournament',
+            'tournament_date': datetime.now().strftime('%Y-%m-%d'),
+            'round[]': ['Final' if i % 10 == 0 else 'Round %d' % i for i in range(count)],
+            'team1[]': ['Player One' if i % 2 else 'Player Three' for i in range(count)],
+            'team2[]': ['Player Two' if i % 2 else 'Player Four' for i in range(count)],
+            'score1[]': ['21-15'] * count,
+            'score2[]': ['15-21'] * count,
+            'match_type[]': ["Men's Singles" if i % 2 else "Women's Singles" for i in range(count)]
+        }, follow_redirects=True)
+
+        # Test case 1: Walking the cursor visits every match once, newest first
+        walked = []
+        before_id = ''
+        while before_id is not None:
+            data = self.client.get('/api/matches?per_page=25&before_id=%s' % before_id).get_json()
+            walked += [match['id'] for match in data['matches']]
+            before_id = data['next_before_id']
+        self.assertEqual(len(walked), count)
+        self.assertEqual(len(set(walked)), count)
+        self.assertEqual(walked, sorted(walked, reverse=True))
+
+        # Test case 2: Filters narrow the listing
+        def ids(query):
+            return [match['id'] for match in self.client.get('/api/matches?per_page=200&' + query).get_json()['matches']]
+
+        self.assertEqual(len(ids('player_name=One')), 30)
+        self.assertEqual(len(ids('match_type=Women%27s+Singles')), 30)
+        self.assertEqual(len(ids('round=Final')), 6)
+        self.assertEqual(len(ids('round=Final&player_name=Three')), 6)
+        self.assertEqual(len(ids('date_from=2000-01-01&date_to=2000-12-31')), 0)
+
+        # Test case 3: The page links to the next one, keeping the filters
+        response = self.client.get('/matches?per_page=10&player_name=One')
+        self.assertIn(b'Older', response.data)
+        self.assertIn(b'player_name=One', response.data)
+        self.assertEqual(self.count_queries('/matches?per_page=10&before_id=%d' % walked[30]),
+                         self.count_queries('/matches?per_page=10'))
+
+    def test_head_to_head_is_paged_in_sql(self):
+        """Test that head-to-head totals and pages come from SQL and deep pages cost the same as the first."""
+        self.login()
+        count = 25
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Rivalry Tournament',
+            'tournament_date': datetime.now().strftime('%Y-%m-%d'),
+            'round[]': ['Round %d' % i for i in range(count + 1)],
+            'team1[]': ['Player One'] * count + ['Player One, Player Two'],
+            'team2[]': ['Player Two'] * count + ['Player Three, Player Four'],
+            'score1[]': ['21-10, 21-12' if i % 5 else '10-21, 12-21' for i in range(count)] + ['21-0, 21-0'],
+            'score2[]': ['10-21, 12-21' if i % 5 else '21-10, 21-12' for i in range(count)] + ['0-21, 0-21'],
+            'match_type[]': ["Men's Singles"] * count + ["Men's Doubles"]
+        }, follow_redirects=True)
+
+        with self.app.app_context():
+            player1_id = Player.query.filter_by(name='Player One').first().id
+            player2_id = Player.query.filter_by(name='Player Two').first().id
+        url = f'/api/head_to_head/{player1_id}/{player2_id}'
+
+        # Test case 1: Totals ignore the doubles match where the two were partners
+        data = self.client.get(url + '?per_page=10').get_json()
+        self.assertEqual(data['total_matches'], count)
+        self.assertEqual(data['player1']['wins'], 20)
+        self.assertEqual(data['player2']['wins'], 5)
+        self.assertEqual(data['player1']['total_points_scored'], 20 * 42 + 5 * 22)
+        self.assertEqual(data['total_pages'], 3)
+
+        # Test case 2: Numbered pages and cursor pages walk the same matches
+        pages = [self.client.get(url + '?per_page=10&page=%d' % page).get_json()['matches'] for page in (1, 2, 3)]
+        numbered = [match['id'] for page in pages for match in page]
+        self.assertEqual(len(set(numbered)), count)
+
+        walked = []
+        before_id = ''
+        while before_id is not None:
+            data = self.client.get(url + '?per_page=10&before_id=%s' % before_id).get_json()
+            walked += [match['id'] for match in data['matches']]
+            before_id = data['next_before_id']
+        self.assertEqual(walked, numbered)
+
+        # Test case 3: A deep page issues the same number of queries as the first
+        self.assertEqual(self.count_queries(url + '?per_page=10&page=1'),
+                         self.count_queries(url + '?per_page=10&page=3'))
+        response = self.client.get(f'/analytics/head_to_head?player1={player1_id}&player2={player2_id}&page=2')
+        self.assertIn(b'Page 2 of 3', response.data)
+
+    def test_rival_lists_are_cached_and_follow_match_writes(self):
+        """Test the rival list API, its LRU cache and its invalidation on match writes."""
+        from head_to_head import get_rivalry_cache
+        self.login()
+        self.client.post('/submit_results', data={
+            'tournament_name': 'Rivals Tournament',
+            'tournament_date': datetime.now().strftime('%Y-%m-%d'),
+            'round[]': ['Round 1', 'Round 2', 'Round 3', 'Round 4'],
+            'team1[]': ['Player One', 'Player One', 'Player One, Player Four', 'Player Two'],
+            'team2[]': ['Player Two', 'Player Two', 'Player Two, Player Three', 'Player Three'],
+            'score1[]': ['21-19, 21-15', '15-21, 18-21', '21-10, 21-10', '21-10, 21-10'],
+            'score2[]': ['19-21, 15-21', '21-15, 21-18', '10-21, 10-21', '10-21, 10-21'],
+            'match_type[]': ["Men's Singles", "Men's Singles", "Men's Doubles", "Men's Singles"]
+        }, follow_redirects=True)
+
+        with self.app.app_context():
+            player_id = Player.query.filter_by(name='Player One').first().id
+            match_id = Match.query.filter_by(round_name='Round 1').first().id
+
+        # Test case 1: Rivals are sorted by meetings with the player's record against each
+        rivals = self.client.get(f'/api/player/{player_id}/rivals').get_json()['rivals']
+        self.assertEqual([(rival['name'], rival['matches'], rival['wins']) for rival in rivals],
+                         [('Player Two', 3, 2), ('Player Three', 1, 1)])
+
+        # Test case 2: Repeat lookups are served from the cache
+        cache = get_rivalry_cache(self.app)
+        hits = cache.hits
+        self.client.get(f'/api/player/{player_id}/rivals')
+        self.assertEqual(cache.hits, hits + 1)
+
+        # Test case 3: Deleting a match evicts the lists of its players only
+        with self.app.app_context():
+            bystander_id = Player.query.filter_by(name='Player Four').first().id
+        self.client.get(f'/api/player/{bystander_id}/rivals')
+        self.client.post(f'/matches/{match_id}/delete', follow_redirects=True)
+        self.assertNotIn(player_id, cache.entries)
+        self.assertIn(bystander_id, cache.entries)
+        rivals = self.client.get(f'/api/player/{player_id}/rivals').get_json()['rivals']
+        self.assertEqual(rivals[0]['matches'], 2)
+        self.assertEqual(rivals[0]['wins'], 1)
+        hits = cache.hits
+        self.client.get(f'/api/player/{bystander_id}/rivals')
+        self.assertEqual(cache.hits, hits + 1)
+
+        # Test case 4: The cache keeps at most the configured number of players
+        cache.max_players = 2
+        with self.app.app_context():
+            for player in Player.query.all():
+                self.client.get(f'/api/player/{player.id}/rivals')
+        self.assertEqual(len(cache.entries), 2)
+
+        # Test case 5: Other users only see meetings in tournaments visible to them, with an ETag
+        with self.app.app_context():
+            other = User(username='otheruser', email='other@example.com')
+            other.set_password('password123')
+            db.session.add(other)
+            db.session.commit()
+        self.client.get('/logout', follow_redirects=True)
+        self.client.post('/login', data={'username': 'otheruser', 'password': 'password123'}, follow_redirects=True)
+        response = self.client.get(f'/api/player/{player_id}/rivals')
+        self.assertEqual(response.get_json()['rivals'], [])
+        response = self.client.get(f'/api/player/{player_id}/rivals',
+                                   headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
 #################
 # SELENIUM TESTS
 #################
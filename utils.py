@@ -1,7 +1,12 @@
 from functools import wraps
-from flask import session, redirect, url_for, flash
+from flask import session, redirect, url_for, flash, g, current_app, request, has_request_context
+import gzip
+import hashlib
 import re
-from models import db, Player, Team
+import uuid
+from sqlalchemy import func, event, select, tuple_
+from sqlalchemy.orm import Session, joinedload
+from models import db, Player, Team, Match, Tournament, DataVersion
 
 def login_required(f):
     """Decorator to require login for routes"""
@@ -13,6 +18,14 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def is_admin_session():
+    """Whether the logged in user of this request is an admin"""
+    if 'user_id' not in session:
+        return False
+    from models import User
+    user = User.query.get(session['user_id'])
+    return bool(user and user.is_admin)
+
 def admin_required(f):
     """Decorator to require admin privileges for routes"""
     @wraps(f)
@@ -21,15 +34,28 @@ def admin_required(f):
             flash('Please log in to access this page')
             return redirect(url_for('auth.login'))
 
-        from models import User
-        user = User.query.get(session['user_id'])
-        if not user or not user.is_admin:
+        if not is_admin_session():
             flash('You do not have permission to access this page')
             return redirect(url_for('user.dashboard'))
 
         return f(*args, **kwargs)
     return decorated_function
 
+def query_budget(limit):
+    """Decorator that logs a warning when a route issues more than limit SQL statements"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            from profiling import request_query_count
+            start = request_query_count()
+            response = f(*args, **kwargs)
+            used = request_query_count() - start
+            if used > limit:
+                current_app.logger.warning(f"{f.__name__} issued {used} SQL statements, over its budget of {limit}")
+            return response
+        return decorated_function
+    return decorator
+
 def validate_password(password):
     """
     Validate password strength
@@ -62,39 +88,143 @@ def validate_password(password):
 
     return True, "Password is strong"
 
+def get_data_version(name='matches'):
+    """Get the current version stamp of a data set (None until it is first written)"""
+    return db.session.query(DataVersion.stamp).filter_by(name=name).scalar()
+
+def get_data_versions(*names):
+    """Get the version stamps of several data sets with one query, in the order given"""
+    # Within a request each stamp is read once, however many caches check it
+    known = g.setdefault('data_versions', {}) if has_request_context() else {}
+    missing = [name for name in names if name not in known]
+    if missing:
+        stamps = dict(db.session.query(DataVersion.name, DataVersion.stamp).filter(DataVersion.name.in_(missing)))
+        known.update((name, stamps.get(name)) for name in missing)
+    return tuple(known[name] for name in names)
+
+def bump_data_version(name='matches'):
+    """Give a data set a new version stamp so in-memory copies of it get rebuilt"""
+    # A fresh random stamp is never reused, even when the bumping transaction is rolled back
+    stamp = uuid.uuid4().hex
+    if not DataVersion.query.filter_by(name=name).update({'stamp': stamp}):
+        db.session.add(DataVersion(name=name, stamp=stamp))
+    if has_request_context():
+        g.setdefault('data_versions', {})[name] = stamp
+
+def touch_tournaments(tournament_ids):
+    """Give tournaments new data stamps when this transaction commits, after their matches changed"""
+    db.session.info.setdefault('touched_tournaments', set()).update(tournament_ids)
+
+@event.listens_for(Session, 'before_commit')
+def _stamp_touched_tournaments(session):
+    tournament_ids = session.info.pop('touched_tournaments', None)
+    if tournament_ids:
+        session.query(Tournament).filter(Tournament.id.in_(tournament_ids)).update(
+            {Tournament.data_stamp: uuid.uuid4().hex}, synchronize_session=False
+        )
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_touched_tournaments(session, previous_transaction):
+    session.info.pop('touched_tournaments', None)
+
+def compress_json(response):
+    """Gzip a JSON response when the client accepts it and the body is large enough to gain from it"""
+    if (response.status_code != 200 or response.direct_passthrough
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.accept_encodings or \
+            response.content_length < current_app.config.get('JSON_COMPRESS_MIN_BYTES', 1024):
+        return response
+
+    response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def conditional_json(*data_sets, scope=None):
+    """Decorator that answers If-None-Match with 304 Not Modified, without running the route, while data_sets keep their versions
+
+    scope is called with the route's arguments and returns the stamps of the rows the response is built from,
+    so writes elsewhere leave the ETag alone.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            versions = get_data_versions(*data_sets)
+            if scope:
+                versions += (scope(**kwargs),)
+            etag = hashlib.sha1(repr((request.full_path, session.get('user_id'), versions)).encode()).hexdigest()
+            # Strong ETags name one exact body, so the compressed body gets its own
+            gzip_etag = etag + '-gzip'
+
+            matched = next((tag for tag in (etag, gzip_etag) if request.if_none_match.contains(tag)), None)
+            if matched:
+                response = current_app.response_class(status=304)
+                response.set_etag(matched)
+            else:
+                response = compress_json(current_app.make_response(f(*args, **kwargs)))
+                if response.status_code != 200:
+                    return response
+                response.set_etag(gzip_etag if response.headers.get('Content-Encoding') == 'gzip' else etag)
+
+            # Clients keep the body but check back with the ETag every time
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.vary.add('Accept-Encoding')
+            return response
+        return decorated_function
+    return decorator
+
+def on_match_saved(match):
+    """Update derived match data after a match has been added or changed"""
+    from player_stats import apply_match
+    from ratings import rate_new_matches
+    match.update_score_columns()
+    apply_match(match)
+    rate_new_matches()
+    touch_tournaments([match.tournament_id])
+    bump_data_version()
+
+def on_match_removed(match):
+    """Update derived match data before a match is deleted or changed"""
+    from player_stats import revert_match
+    from ratings import unrate_matches
+    revert_match(match)
+    unrate_matches([match.id])
+    touch_tournaments([match.tournament_id])
+    bump_data_version()
+
 def get_or_create_player(name):
     """Find or create a player by name"""
-    player = Player.query.filter_by(name=name.strip()).first()
-    if not player:
-        player = Player(name=name.strip())
-        db.session.add(player)
-        db.session.flush()  # Flush to get the ID without committing
-    return player
+    from identity_map import resolve_player_ids, normalize_player_name
+    return db.session.get(Player, resolve_player_ids([name])[normalize_player_name(name)])
 
 def process_team(team_names):
     """Process team names and create team"""
-    players = [name.strip() for name in team_names.split(',')]
-    player1 = get_or_create_player(players[0])
+    from identity_map import resolve_teams
+    return resolve_teams([team_names])[team_names]
 
-    player2 = None
-    if len(players) > 1 and players[1]:
-        player2 = get_or_create_player(players[1])
+def fold_team(team_id, into_team_id):
+    """Move a duplicate team's matches onto another team and delete it"""
+    for column in (Match.team1_id, Match.team2_id, Match.winner_team_id):
+        Match.query.filter(column == team_id).update({column: into_team_id}, synchronize_session=False)
+    Team.query.filter_by(id=team_id).delete()
 
-    # Check if this team already exists
-    if player2:
-        team = Team.query.filter(
-            ((Team.player1_id == player1.id) & (Team.player2_id == player2.id)) |
-            ((Team.player1_id == player2.id) & (Team.player2_id == player1.id))
-        ).first()
-    else:
-        team = Team.query.filter_by(player1_id=player1.id, player2_id=None).first()
+def merge_duplicate_teams():
+    """Fold teams made up of the same players into the oldest of them, returning the number of teams removed"""
+    low, high = Team.pair_key()
+    duplicates = db.session.query(low, high, func.min(Team.id)).group_by(low, high).having(func.count(Team.id) > 1).all()
 
-    if not team:
-        team = Team(player1_id=player1.id, player2_id=player2.id if player2 else None)
-        db.session.add(team)
-        db.session.flush()  # Flush to get the ID without committing
+    removed = 0
+    for player_low, player_high, keep_id in duplicates:
+        team_ids = [team_id for team_id, in db.session.query(Team.id).filter(
+            low == player_low, high == player_high, Team.id != keep_id
+        )]
+        for team_id in team_ids:
+            fold_team(team_id, keep_id)
+        removed += len(team_ids)
 
-    return team
+    return removed
 
 def validate_match_players(team1, team2):
     """Validate that no player appears on both sides of the match"""
@@ -110,4 +240,56 @@ def validate_match_players(team1, team2):
     if team1_players.intersection(team2_players):
         return False  # Players appearing on both sides
 
-    return True  # No duplicates
\ No newline at end of file
+    return True  # No duplicates
+
+def eager_match_options():
+    """Loader options that fetch a match's tournament, teams and players in the same query"""
+    return (
+        joinedload(Match.tournament),
+        joinedload(Match.team1).joinedload(Team.player1),
+        joinedload(Match.team1).joinedload(Team.player2),
+        joinedload(Match.team2).joinedload(Team.player1),
+        joinedload(Match.team2).joinedload(Team.player2),
+    )
+
+def team_player_names(team):
+    """List the names of the players in a team"""
+    names = [team.player1.name]
+    if team.player2:
+        names.append(team.player2.name)
+    return names
+
+def match_display_row(match):
+    """Format an eagerly loaded match as a ready-to-render dictionary"""
+    team1_players = team_player_names(match.team1)
+    team2_players = team_player_names(match.team2)
+    team1_won = match.get_winner() is match.team1
+
+    return {
+        'id': match.id,
+        'tournament': match.tournament.name,
+        'tournament_id': match.tournament_id,
+        'date': match.timestamp.strftime('%Y-%m-%d'),
+        'round': match.round_name,
+        'group': match.group_name,
+        'team1': ', '.join(team1_players),
+        'team2': ', '.join(team2_players),
+        'team1_players': team1_players,
+        'team2_players': team2_players,
+        'score1': match.score1,
+        'score2': match.score2,
+        'match_type': match.match_type,
+        'team1_won': team1_won,
+        'winner': ', '.join(team1_players) if team1_won else ', '.join(team2_players)
+    }
+
+def before_match(before_id):
+    """Filter for the matches listed after the given one in newest-first (timestamp, id) order"""
+    before_timestamp = select(Match.timestamp).where(Match.id == before_id).scalar_subquery()
+    return tuple_(Match.timestamp, Match.id) < tuple_(before_timestamp, before_id)
+
+def load_match_rows(query):
+    """Run a Match query with eager loading and return display rows for every match"""
+    matches = query.options(*eager_match_options()).all()
+    return [match_display_row(match) for match in matches]
+
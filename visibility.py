@@ -0,0 +1,82 @@
+"""
+Visibility - App-wide cache of the tournaments each user owns or has been shared
+"""
+from threading import Lock
+
+from flask import current_app
+from sqlalchemy import literal, select
+
+from models import db, Tournament, SharedTournament
+from utils import get_data_versions
+from response_cache import TOURNAMENT_DATA, SHARE_DATA
+
+# Data sets whose writes change which tournaments a user can see
+VISIBILITY_DATA = (TOURNAMENT_DATA, SHARE_DATA)
+
+
+class VisibilityCache:
+    """Owned and shared tournament ids by user, valid while tournaments and shares keep their versions"""
+
+    def __init__(self):
+        self.entries = {}
+        self.version = None
+        self.lock = Lock()
+
+    def get(self, version, user_id):
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+            return self.entries.get(user_id)
+
+    def set(self, version, user_id, entry):
+        with self.lock:
+            if version == self.version:
+                self.entries[user_id] = entry
+
+
+def get_visibility_cache(app=None):
+    """Get the visibility cache of the application"""
+    app = app or current_app._get_current_object()
+    return app.extensions.setdefault('visibility', VisibilityCache())
+
+
+def _load_tournament_ids(user_id):
+    """Read the ids of the tournaments a user owns and those shared with them in one query"""
+    owned = db.session.query(Tournament.id, literal(True)).filter(Tournament.user_id == user_id)
+    shared = db.session.query(SharedTournament.tournament_id, literal(False)).filter(
+        SharedTournament.shared_with_id == user_id
+    )
+    rows = owned.union_all(shared).all()
+    return (
+        frozenset(tournament_id for tournament_id, is_owner in rows if is_owner),
+        frozenset(tournament_id for tournament_id, is_owner in rows if not is_owner)
+    )
+
+
+def tournament_access(user_id):
+    """The (owned, shared with them) tournament id sets of a user"""
+    version = get_data_versions(*VISIBILITY_DATA)
+    cache = get_visibility_cache()
+    entry = cache.get(version, user_id)
+    if entry is None:
+        entry = _load_tournament_ids(user_id)
+        cache.set(version, user_id, entry)
+    return entry
+
+
+def visible_tournament_ids(user_id, include_shared=True):
+    """Ids of the tournaments a user owns and, unless told otherwise, those shared with them"""
+    owned, shared = tournament_access(user_id)
+    return owned | shared if include_shared else owned
+
+
+def visible_to(column, user_id, include_shared=True):
+    """Filter a tournament id column down to the tournaments a user can see, with an indexed IN subquery"""
+    # The statement only binds the user id, so it stays the same size and cacheable however many tournaments there are
+    tournament_ids = select(Tournament.id).where(Tournament.user_id == user_id)
+    if include_shared:
+        tournament_ids = tournament_ids.union_all(
+            select(SharedTournament.tournament_id).where(SharedTournament.shared_with_id == user_id)
+        )
+    return column.in_(tournament_ids)